@@ -0,0 +1,233 @@
+"""
+This module contains code for choosing the fastest backend of an operation by timing the candidates on a sample
+"""
+import json
+import math
+import os
+import threading
+import time
+from enum import Enum
+
+import numpy as np
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import device, torch
+
+from napari_cool_tools_img_proc._axes import BatchView
+from napari_cool_tools_img_proc._scheduler import CPU_COUNT
+
+
+class Backend(Enum):
+    auto = "auto"
+    torch = "torch"
+    fft = "fft"
+
+class AutotunedOp(Enum):
+    dog = "dog"
+    gaussian_blur = "gaussian_blur"
+    unsharp = "unsharp"
+
+# slices of the input every candidate is timed on
+SAMPLE_SLICES = 2
+
+# timed runs per candidate after one warm up run, the fastest run counts
+TUNE_REPEATS = 2
+
+# file winners are stored in so later sessions skip tuning
+DEFAULT_TUNE_FILE = os.path.join(os.path.expanduser("~"),".cache","napari-cool-tools-img-proc","autotune.json")
+
+def size_class(n:int)->int:
+    """Smallest power of 2 not below n, sizes in the same class share a tuning decision."""
+    return 1 << max(int(n) - 1,0).bit_length()
+
+def param_class(value):
+    """Key parameters are bucketed by rounding their base 2 logarithm, e.g. kernel sizes 9 to 12 share a bucket."""
+    value = getattr(value,"value",value)
+    if isinstance(value,bool) or not isinstance(value,(int,float)):
+        return str(value)
+    if value <= 0:
+        return value
+    return round(2 ** round(math.log2(value)),6)
+
+def tune_key(op:str,data,key_params:dict=None,channel_axis:int=None)->str:
+    """Decision key of an operation: op, slice size class, batch size class, dtype, bucketed key parameters, device
+    and core count."""
+    vol = BatchView(data,channel_axis)
+    params = ",".join(f"{k}={param_class(v)}" for k, v in sorted((key_params or {}).items()))
+    return (f"{op}|{size_class(vol.shape[1])}x{size_class(vol.shape[2])}|n{size_class(min(vol.shape[0],64))}"
+            f"|{np.dtype(vol.dtype).name}|{params}|{torch.device(device).type}|{CPU_COUNT}cpu")
+
+class Autotuner:
+    """Decisions of the fastest backend per tuning key, kept in memory and in a json file.
+
+    Args:
+        path (str or None): json file holding decisions across sessions, None keeps them in memory only
+    """
+
+    def __init__(self,path:str=DEFAULT_TUNE_FILE):
+        self.path = path
+        self.enabled = True
+        self.overrides = {}
+        self._decisions = None
+        self._lock = threading.Lock()
+
+    def _load(self)->dict:
+        if self._decisions is None:
+            self._decisions = {}
+            if self.path and os.path.exists(self.path):
+                try:
+                    with open(self.path) as f:
+                        self._decisions = json.load(f)
+                except (OSError,ValueError) as e:
+                    show_info(f"Autotune: ignoring unreadable decision file {self.path} ({e})")
+        return self._decisions
+
+    def get(self,key:str)->dict:
+        with self._lock:
+            return self._load().get(key)
+
+    def put(self,key:str,winner:str,timings:dict):
+        with self._lock:
+            decisions = self._load()
+            decisions[key] = {"winner": winner,"timings_ms": timings,"tuned": time.strftime("%Y-%m-%d %H:%M:%S")}
+            if self.path:
+                os.makedirs(os.path.dirname(self.path) or ".",exist_ok=True)
+                with open(self.path,"w") as f:
+                    json.dump(decisions,f,indent=2,sort_keys=True)
+
+    def clear(self):
+        """Forget all decisions, including the ones stored on disk."""
+        with self._lock:
+            self._decisions = {}
+            if self.path and os.path.exists(self.path):
+                os.remove(self.path)
+
+    def report(self)->list:
+        """One record per decision: key fields, winner and the time of every candidate per slice in ms."""
+        with self._lock:
+            records = []
+            for key, decision in sorted(self._load().items()):
+                op, shape, batch, dtype, params, dev, cpus = key.split("|")
+                override = self.overrides.get(op)
+                records.append({"op": op,"shape": shape,"slices": batch[1:],"dtype": dtype,"params": params,
+                                "device": dev,"cpus": cpus,"winner": decision["winner"],"override": override or "",
+                                "timings_ms": decision["timings_ms"],"tuned": decision["tuned"]})
+            return records
+
+_tuner = Autotuner()
+
+def configure_autotune(enabled:bool=None,path:str=None,overrides:dict=None):
+    """Configure the shared autotuner.
+
+    Args:
+        enabled (bool or None): time candidates on first use, disabled uses the first candidate of every operation
+        path (str or None): json file holding decisions, empty string keeps decisions in memory only
+        overrides (dict or None): op name to backend name always used for that op, a backend of 'auto' or None
+                                  removes the override
+    """
+    with _tuner._lock:
+        if enabled is not None:
+            _tuner.enabled = enabled
+        if path is not None:
+            _tuner.path = path or None
+            _tuner._decisions = None
+        for op, backend in (overrides or {}).items():
+            op, backend = getattr(op,"value",op), getattr(backend,"value",backend)
+            if backend in (None,"auto"):
+                _tuner.overrides.pop(op,None)
+            else:
+                _tuner.overrides[op] = backend
+
+def autotune_report()->list:
+    """Recorded backend decisions of the shared autotuner."""
+    return _tuner.report()
+
+def time_candidates(candidates:dict,sample:np.ndarray)->dict:
+    """Time every candidate on sample, returns milliseconds per slice, failing candidates are left out."""
+    timings = {}
+    for name, func in candidates.items():
+        try:
+            # the warm up run builds kernels and compiles, which later calls don't pay for again
+            func(sample)
+            best = math.inf
+            for _ in range(TUNE_REPEATS):
+                start = time.perf_counter()
+                func(sample)
+                if torch.device(device).type == "cuda":
+                    torch.cuda.synchronize()
+                best = min(best,time.perf_counter() - start)
+            timings[name] = round(1000 * best / len(sample),3)
+        except (RuntimeError,ValueError,MemoryError) as e:
+            show_info(f"Autotune: candidate {name} failed on the sample ({type(e).__name__}: {e})")
+    return timings
+
+def torch_candidate(batch_func):
+    """Candidate running a batched torch function on an ndarray sample, including the copies iter_chunks makes."""
+    def run(sample):
+        batch = torch.as_tensor(sample,device=device)
+        if not torch.is_floating_point(batch):
+            batch = batch.float()
+        return batch_func(batch).detach().cpu().numpy()
+    return run
+
+def select_backend(op:str,data,candidates:dict,key_params:dict=None,backend:str="auto",channel_axis:int=None)->str:
+    """Backend of an operation, the fastest candidate for data like this one unless a backend is requested.
+
+    The first call for a tuning key times every candidate on SAMPLE_SLICES slices of data and records the winner,
+    later calls with the same key return it without timing. Candidates must be implementations of the same
+    computation, e.g. direct and FFT convolution with the same kernel, so the choice never changes the result.
+
+    Args:
+        op (str): operation name, also used for overrides
+        data (ndarray): input data with any number of leading batch axes
+        candidates (dict): backend name to function taking a (B,H,W) ndarray sample and returning its result
+        key_params (dict or None): parameters the best backend depends on e.g. kernel size
+        backend (str): requested backend, 'auto' to use the override or tuned decision
+        channel_axis (int or None): axis of data holding color channels
+
+    Returns:
+        Name of the chosen backend, a key of candidates.
+    """
+    backend = getattr(backend,"value",backend)
+    if backend not in (None,"auto"):
+        assert backend in candidates, f"{op} is not available with backend {backend}, use one of {list(candidates)}"
+        return backend
+    override = _tuner.overrides.get(op)
+    if override in candidates:
+        return override
+    default = next(iter(candidates))
+    if len(candidates) == 1 or not _tuner.enabled:
+        return default
+
+    key = tune_key(op,data,key_params,channel_axis)
+    decision = _tuner.get(key)
+    if decision is not None and decision["winner"] in candidates:
+        return decision["winner"]
+
+    vol = BatchView(data,channel_axis)
+    sample = np.asarray(vol[0:min(SAMPLE_SLICES,len(vol))])
+    timings = time_candidates(candidates,sample)
+    if not timings:
+        return default
+    winner = min(timings,key=timings.get)
+    _tuner.put(key,winner,timings)
+    show_info(f"Autotune {op}: {winner} is fastest ({', '.join(f'{k} {v} ms' for k, v in timings.items())} per slice)")
+    return winner
+
+def autotune(op:AutotunedOp=AutotunedOp.dog,override:Backend=Backend.auto,enabled:bool=True,decision_file:str=DEFAULT_TUNE_FILE,clear:bool=False):
+    """Configure automatic backend selection and report the recorded decisions.
+
+    Args:
+        op (AutotunedOp): operation the override applies to
+        override (Backend): backend always used for op, auto dispatches to the fastest one
+        enabled (bool): time candidates on first use of an operation with new data shapes or parameters
+        decision_file (str): json file holding decisions across sessions, leave empty to keep them in memory
+        clear (bool): forget all decisions so operations are timed again
+    """
+    configure_autotune(enabled=enabled,path=decision_file,overrides={op.value: override.value})
+    if clear:
+        _tuner.clear()
+    records = autotune_report()
+    lines = [f"{r['op']} {r['shape']} x{r['slices']} {r['dtype']} {r['params']}: {r['winner']}"
+             + (f" (override {r['override']})" if r['override'] else "") for r in records]
+    overrides = ", ".join(f"{k}={v}" for k, v in _tuner.overrides.items()) or "none"
+    show_info(f"Autotune: {len(records)} decisions, overrides: {overrides}" + "".join(f"\n{line}" for line in lines))
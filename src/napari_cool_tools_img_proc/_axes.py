@@ -0,0 +1,87 @@
+"""
+This module contains code for processing data with arbitrary leading batch axes as one stack of 2D slices
+"""
+import numpy as np
+from numpy import ndarray
+
+# every operation works on the last 2 axes (rows, columns), all axes in front of them are batch axes
+SPATIAL_DIMS = 2
+
+def channel_axis_of(img)->int:
+    """Channel axis of an Image layer, the last axis of RGB(A) layers and None for grayscale layers."""
+    return -1 if getattr(img,"rgb",False) else None
+
+def normalize_axis(channel_axis:int,ndim:int)->int:
+    """Non negative channel axis of data with ndim dimensions."""
+    if channel_axis is None:
+        return None
+    channel_axis = channel_axis + ndim if channel_axis < 0 else channel_axis
+    assert 0 <= channel_axis < ndim, f"channel_axis {channel_axis} is out of range for data of {ndim} dimensions"
+    return channel_axis
+
+class BatchView:
+    """(B,H,W) view of an N-D array with every leading axis and the optional channel axis flattened into B.
+
+    Slices along B are read and written through a numpy view when the flattened axes can be merged without a copy
+    (any C-contiguous array without channel axis), otherwise one slice at a time, so neither the input nor the
+    output is ever copied as a whole.
+
+    Args:
+        data (ndarray): array with at least SPATIAL_DIMS + item_dims - 2 dimensions
+        channel_axis (int or None): axis of data holding color channels, moved in front of the spatial axes
+        item_dims (int): trailing axes making up one item of the stack, 2 for (H,W) slices or more for arrays
+                         with extra trailing axes such as (H,W,outputs)
+    """
+
+    def __init__(self,data:ndarray,channel_axis:int=None,item_dims:int=SPATIAL_DIMS):
+        self.data = data
+        self.channel_axis = normalize_axis(channel_axis,data.ndim)
+        moved = data if self.channel_axis is None else np.moveaxis(data,self.channel_axis,0)
+        n_batch_dims = moved.ndim - item_dims
+        assert n_batch_dims >= 0, f"Only works for data of at least {item_dims} dimensions"
+        self.batch_shape = moved.shape[:n_batch_dims]
+        self.shape = (int(np.prod(self.batch_shape)),) + moved.shape[n_batch_dims:]
+        self.dtype = moved.dtype
+        self.ndim = len(self.shape)
+        self._moved = moved
+        try:
+            flat = moved.view()
+            # assigning the shape raises instead of silently copying when the axes can't be merged
+            flat.shape = self.shape
+        except AttributeError:
+            flat = None
+        self.flat = flat
+
+    def __len__(self)->int:
+        return self.shape[0]
+
+    def _split_key(self,key):
+        key = key if isinstance(key,tuple) else (key,)
+        first, rest = key[0], key[1:]
+        if isinstance(first,slice):
+            return range(*first.indices(self.shape[0])), rest, False
+        return [int(first)], rest, True
+
+    def __getitem__(self,key)->ndarray:
+        if self.flat is not None:
+            return self.flat[key]
+        indices, rest, single = self._split_key(key)
+        items = [self._moved[np.unravel_index(i,self.batch_shape)][rest] for i in indices]
+        return items[0] if single else np.stack(items)
+
+    def __setitem__(self,key,value):
+        if self.flat is not None:
+            self.flat[key] = value
+            return
+        indices, rest, single = self._split_key(key)
+        value = np.asarray(value)
+        for n, i in enumerate(indices):
+            self._moved[np.unravel_index(i,self.batch_shape)][rest] = value if single else value[n]
+
+    def shares_memory(self,other)->bool:
+        """Check whether this view and another BatchView or array may overlap in memory."""
+        other = other.data if isinstance(other,BatchView) else other
+        # lazy arrays (dask, zarr) would be read as a whole to be compared, they never share memory with an output
+        if not isinstance(self.data,np.ndarray) or not isinstance(other,np.ndarray):
+            return False
+        return np.may_share_memory(self.data,other)
@@ -0,0 +1,317 @@
+"""
+This module contains code for memoizing operation results keyed by input content and parameters
+"""
+import hashlib
+import inspect
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from functools import wraps
+
+import numpy as np
+from napari.layers import Layer
+from napari.utils.notifications import show_info
+from numpy import ndarray
+
+from napari_cool_tools_img_proc._memory import get_memory_budget
+from napari_cool_tools_img_proc._profiling import stage
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# bytes of input hashed per update call
+HASH_CHUNK_BYTES = 16 * 2**20
+
+# largest result stored, as a fraction of the memory budget of a single operation
+MAX_ENTRY_FRACTION = 0.25
+
+def content_hash(data:ndarray)->str:
+    """Fast hash of array contents, shape and dtype.
+
+    Uses xxhash when it is installed and blake2b otherwise. Data is hashed in chunks along axis 0 so
+    non contiguous and lazy arrays are never copied as a whole.
+
+    Args:
+        data (ndarray): array to be hashed
+
+    Returns:
+        Hex digest string.
+    """
+    h = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    h.update(f"{data.shape}{np.dtype(data.dtype).str}".encode())
+    if data.ndim == 0 or data.size == 0:
+        h.update(np.ascontiguousarray(data).tobytes())
+        return h.hexdigest()
+
+    slice_bytes = max(data.nbytes // len(data),1)
+    step = max(HASH_CHUNK_BYTES // slice_bytes,1)
+    for i in range(0,len(data),step):
+        h.update(np.ascontiguousarray(data[i:i + step]).data)
+    return h.hexdigest()
+
+def make_key(op:str,data_hash:str,params:dict)->str:
+    """Cache key for an operation applied to data with the given content hash and parameters."""
+    param_str = json.dumps({k: getattr(v,"value",v) for k, v in params.items()},sort_keys=True,default=repr)
+    return hashlib.blake2b(f"{op}|{data_hash}|{param_str}".encode(),digest_size=16).hexdigest()
+
+class ResultCache:
+    """Two tier result cache, a size bounded in-memory LRU and an optional size bounded on-disk store.
+
+    Files of the on-disk tier are written to temporary files and renamed into place, so concurrent readers never see
+    a partial entry. Failures of the on-disk tier are treated as misses and never fail an operation.
+    """
+
+    def __init__(self,memory_limit:int=2**30,disk_dir:str=None,disk_limit:int=10 * 2**30):
+        self.memory_limit = memory_limit
+        self.disk_dir = disk_dir
+        self.disk_limit = disk_limit
+        self.enabled = False
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+        self.hits_memory = 0
+        self.hits_disk = 0
+        self.misses = 0
+
+    def get(self,key:str):
+        """Cached (data, name_suffix, layer_type, metadata) for key or None, data is a copy safe to modify."""
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self.hits_memory += 1
+                data, suffix, layer_type, metadata = entry
+                return data.copy(), suffix, layer_type, metadata
+
+        entry = self._disk_get(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits_disk += 1
+        data, suffix, layer_type, metadata = entry
+        self._memory_put(key,data,suffix,layer_type,metadata)
+        return data.copy(), suffix, layer_type, metadata
+
+    def put(self,key:str,data:ndarray,suffix:str,layer_type:str,metadata:dict=None):
+        """Store an operation result and the metadata of its layer in both tiers."""
+        data = np.asarray(data)
+        metadata = dict(metadata or {})
+        self._memory_put(key,data.copy(),suffix,layer_type,metadata)
+        self._disk_put(key,data,suffix,layer_type,metadata)
+
+    def clear(self):
+        """Remove all entries from both tiers and reset statistics."""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self.hits_memory = self.hits_disk = self.misses = 0
+        with self._disk_lock:
+            for path in self._disk_files():
+                self._disk_remove(path)
+
+    def stats(self)->dict:
+        """Hit/miss counts, hit rate and size of each tier."""
+        with self._lock:
+            requests = self.hits_memory + self.hits_disk + self.misses
+            return {
+                "hits_memory": self.hits_memory,
+                "hits_disk": self.hits_disk,
+                "misses": self.misses,
+                "hit_rate": (self.hits_memory + self.hits_disk) / requests if requests else 0.0,
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_bytes,
+                "disk_bytes": sum(size for _path, _mtime, size in self._disk_entries()),
+            }
+
+    def _memory_put(self,key,data,suffix,layer_type,metadata):
+        if data.nbytes > self.memory_limit:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory_bytes -= self._memory.pop(key)[0].nbytes
+            self._memory[key] = (data,suffix,layer_type,metadata)
+            self._memory_bytes += data.nbytes
+        self._evict_memory()
+
+    def _evict_memory(self):
+        with self._lock:
+            while self._memory_bytes > self.memory_limit:
+                _key, (old, *_info) = self._memory.popitem(last=False)
+                self._memory_bytes -= old.nbytes
+
+    def _disk_files(self)->list:
+        if not self.disk_dir or not os.path.isdir(self.disk_dir):
+            return []
+        try:
+            return [os.path.join(self.disk_dir,f) for f in os.listdir(self.disk_dir) if f.endswith(".npy")]
+        except OSError:
+            return []
+
+    def _disk_entries(self)->list:
+        """(path, mtime, size) of the stored arrays, skipping files removed by another thread meanwhile."""
+        entries = []
+        for path in self._disk_files():
+            with suppress(OSError):
+                entries.append((path,os.path.getmtime(path),os.path.getsize(path)))
+        return entries
+
+    def _disk_remove(self,path):
+        for p in (path,path[:-4] + ".json"):
+            with suppress(OSError):
+                os.remove(p)
+
+    def _disk_get(self,key):
+        if not self.disk_dir:
+            return None
+        path = os.path.join(self.disk_dir,f"{key}.npy")
+        try:
+            with open(os.path.join(self.disk_dir,f"{key}.json")) as f:
+                meta = json.load(f)
+            data = np.load(path)
+            os.utime(path)
+        except (OSError,ValueError,KeyError):
+            # missing, partially evicted or corrupt entries are misses
+            return None
+        return data,meta["suffix"],meta["layer_type"],meta.get("metadata",{})
+
+    def _write_atomic(self,path:str,write):
+        """Write a file through write(file) into a temporary file renamed to path once complete."""
+        fd, tmp = tempfile.mkstemp(dir=self.disk_dir,suffix=".tmp")
+        try:
+            with os.fdopen(fd,"wb") as f:
+                write(f)
+            os.replace(tmp,path)
+        except BaseException:
+            with suppress(OSError):
+                os.remove(tmp)
+            raise
+
+    def _disk_put(self,key,data,suffix,layer_type,metadata):
+        if not self.disk_dir or data.nbytes > self.disk_limit:
+            return
+        try:
+            meta = json.dumps({"suffix": suffix,"layer_type": layer_type,"metadata": metadata})
+        except TypeError:
+            # metadata that does not round trip through json is only kept in memory
+            return
+        path = os.path.join(self.disk_dir,f"{key}.npy")
+        try:
+            os.makedirs(self.disk_dir,exist_ok=True)
+            # the array is renamed into place last, an entry is only visible once its metadata exists
+            self._write_atomic(path[:-4] + ".json",lambda f: f.write(meta.encode()))
+            self._write_atomic(path,lambda f: np.save(f,data))
+        except OSError as e:
+            show_info(f"Result cache: could not write to {self.disk_dir} ({e})")
+            return
+
+        # evict least recently used files until the store fits its limit
+        with self._disk_lock:
+            entries = sorted(self._disk_entries(),key=lambda entry: entry[1])
+            total = sum(size for _path, _mtime, size in entries)
+            while total > self.disk_limit and entries:
+                old, _mtime, size = entries.pop(0)
+                total -= size
+                self._disk_remove(old)
+
+_cache = ResultCache()
+
+def configure_cache(memory_limit:int=None,disk_dir:str=None,disk_limit:int=None,enabled:bool=None):
+    """Configure the shared result cache.
+
+    Args:
+        memory_limit (int or None): maximum bytes held by the in-memory tier
+        disk_dir (str or None): directory of the on-disk tier, empty string disables the on-disk tier
+        disk_limit (int or None): maximum bytes held by the on-disk tier
+        enabled (bool or None): enable or disable result caching
+    """
+    if memory_limit is not None:
+        _cache.memory_limit = memory_limit
+        _cache._evict_memory()
+    if disk_dir is not None:
+        _cache.disk_dir = disk_dir or None
+    if disk_limit is not None:
+        _cache.disk_limit = disk_limit
+    if enabled is not None:
+        _cache.enabled = enabled
+
+def cache_stats()->dict:
+    """Statistics of the shared result cache."""
+    return _cache.stats()
+
+def clear_cache():
+    """Remove all entries from the shared result cache."""
+    _cache.clear()
+
+def cached(op:str):
+    """Decorator memoizing a streaming operation generator whose first argument is the input Image layer.
+
+    Caching is opt-in, while the shared cache is disabled or the operation is requested in place the generator runs
+    unchanged without hashing its input. Results are keyed by the content hash of the input data, op and the remaining
+    arguments. On a hit the generator yields and returns a new layer holding the cached result and the metadata of the
+    original result layer without running the operation. Results that are not arrays in memory or larger than
+    MAX_ENTRY_FRACTION of the memory budget are not stored.
+
+    Args:
+        op (str): operation name used in the cache key
+    """
+    def decorator(gen_func):
+        signature = inspect.signature(gen_func)
+
+        @wraps(gen_func)
+        def wrapper(*args,**kwargs):
+            if not _cache.enabled:
+                return (yield from gen_func(*args,**kwargs))
+
+            bound = signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            img = params.pop("img")
+            # results written into the input are neither worth a copy in the cache nor served from it
+            if params.pop("in_place",False):
+                return (yield from gen_func(*args,**kwargs))
+            with stage("hash",nbytes=img.data.nbytes):
+                key = make_key(op,content_hash(img.data),params)
+
+            entry = _cache.get(key)
+            if entry is not None:
+                data, suffix, layer_type, metadata = entry
+                layer = Layer.create(data,{"name": f"{img.name}{suffix}","metadata": dict(metadata)},layer_type)
+                show_info(f"{op}: returned cached result (hit rate {_cache.stats()['hit_rate']:.0%})")
+                yield layer
+                return layer
+
+            layer = yield from gen_func(*args,**kwargs)
+            if (layer is not None and layer is not img and isinstance(layer.data,ndarray)
+                    and layer.data.nbytes <= MAX_ENTRY_FRACTION * get_memory_budget()):
+                suffix = layer.name[len(img.name):] if layer.name.startswith(img.name) else f"_{layer.name}"
+                _cache.put(key,layer.data,suffix,type(layer).__name__.lower(),layer.metadata)
+            return layer
+        return wrapper
+    return decorator
+
+def result_cache(enabled:bool=False,memory_limit_mb:int=1024,disk_cache_dir:str="",disk_limit_mb:int=10240,clear:bool=False):
+    """Configure the result cache and report its hit rate.
+
+    Args:
+        enabled (bool): cache operation results, every cached operation then hashes its input
+        memory_limit_mb (int): maximum size of the in-memory tier in MiB
+        disk_cache_dir (str): directory of the on-disk tier, leave empty to disable it
+        disk_limit_mb (int): maximum size of the on-disk tier in MiB
+        clear (bool): remove all cached results
+    """
+    configure_cache(memory_limit=memory_limit_mb * 2**20,disk_dir=disk_cache_dir,disk_limit=disk_limit_mb * 2**20,enabled=enabled)
+    if clear:
+        clear_cache()
+    stats = cache_stats()
+    show_info(
+        f"Result cache {'enabled' if enabled else 'disabled'}: {stats['hit_rate']:.0%} hit rate "
+        f"({stats['hits_memory']} memory hits, {stats['hits_disk']} disk hits, {stats['misses']} misses), "
+        f"{stats['memory_bytes'] / 2**20:.0f} MiB in memory, {stats['disk_bytes'] / 2**20:.0f} MiB on disk"
+    )
@@ -1,15 +1,29 @@
 """
 This module contains code for denoising images
 """
-
-from torchvision.transforms.functional import gaussian_blur
+import numpy as np
+from functools import partial
 from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.types import ImageData
 from napari.qt.threading import thread_worker
-from napari_cool_tools_io import torch,viewer,device,memory_stats
+from torch.nn import functional as F
+from napari_cool_tools_io import torch,device,memory_stats
+from napari_cool_tools_img_proc._autotune import Backend, select_backend, torch_candidate
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
+from napari_cool_tools_img_proc._incremental import incremental
+from napari_cool_tools_img_proc._kernels import box_filter_batch, fft_gaussian_blur_batch, gaussian_blur_batch, torchvision_sigma
 from napari_cool_tools_img_proc._normalization import normalize_data_in_range_pt_func
-from tqdm import tqdm
+from napari_cool_tools_img_proc._lazy import can_display_lazily, lazy_result_gen
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._pointwise import PointwiseChain
+from napari_cool_tools_img_proc._pool import apply_to_selected
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._roi import roi_restricted
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._statistics import value_range
+from napari_cool_tools_img_proc._streaming import iter_slices, run_generator, stream_to_viewer
 
 def torchvision_diff_of_gaus_2d_data_func(data:ImageData, low_sigma:float=1.0, high_sigma:float=20.0, truncate=4.0):
     """Implementation of median filter function
@@ -29,18 +43,43 @@ def torchvision_diff_of_gaus_2d_data_func(data:ImageData, low_sigma:float=1.0, h
     kernel_low = 2 * radius_low + 1
     kernel_high = 2 * radius_high + 1
 
-    data_ten = torch.unsqueeze(torch.unsqueeze(torch.tensor(data,device=device),0),0)
-    blur_low = gaussian_blur(data_ten,kernel_low)
-    blur_high = gaussian_blur(data_ten,kernel_high)
+    # same kernels as torchvision gaussian_blur with sigma derived from the kernel size, built once per size
+    data_ten = torch.unsqueeze(torch.tensor(data,device=device),0)
+    blur_low = gaussian_blur_batch(data_ten,kernel_low,torchvision_sigma(kernel_low))
+    blur_high = gaussian_blur_batch(data_ten,kernel_high,torchvision_sigma(kernel_high))
     diff_gaus = blur_low - blur_high
-    output = diff_gaus.detach().squeeze().cpu().numpy()
-    norm_out = normalize_data_in_range_pt_func(output,0.0,1.0,numpy_out=True)
+    # rescale on device in one fused pass instead of copying the difference back to the host first
+    norm_out = PointwiseChain().normalize(diff_gaus.min(),diff_gaus.max(),0.0,1.0)(diff_gaus)
+
+    return norm_out.detach().squeeze().cpu().numpy()
+
+def torchvision_diff_of_gaus_batch(batch, low_sigma:float=1.0, high_sigma:float=20.0, truncate=4.0, fft:bool=False):
+    """Batched version of torchvision_diff_of_gaus_2d_data_func
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        low_sigma (float): standard deviation for lower intensity gaussian filter
+        high_sigma (float): standard deviation for higher intensity gaussian filter
+        truncate (float): number of standard deviations to filter
+        fft (bool): compute the blurs in the frequency domain, faster for large sigmas
 
-    return norm_out
+    Returns:
+        (B,H,W) tensor with difference of gaussians applied and each slice normalized to range 0-1
+    """
+    radius_low = round(truncate * low_sigma)
+    radius_high = round(truncate * high_sigma)
+    kernel_low = 2 * radius_low + 1
+    kernel_high = 2 * radius_high + 1
 
+    blur = fft_gaussian_blur_batch if fft else gaussian_blur_batch
+    blur_low = blur(batch,kernel_low,torchvision_sigma(kernel_low))
+    blur_high = blur(batch,kernel_high,torchvision_sigma(kernel_high))
+    diff_gaus = blur_low - blur_high
+    d_min = diff_gaus.amin(dim=(-2,-1),keepdim=True)
+    d_max = diff_gaus.amax(dim=(-2,-1),keepdim=True)
 
+    return PointwiseChain().normalize(d_min,d_max)(diff_gaus)
 
-def diff_of_gaus(img:Image, low_sigma:float=1.0, high_sigma:float=20.0, mode='nearest',cval=0, channel_axis=None, truncate=4.0, pt=False) -> Layer:
+def diff_of_gaus(img:Image, low_sigma:float=1.0, high_sigma:float=20.0, mode='nearest',cval=0, channel_axis=None, truncate=4.0, pt=False, backend:Backend=Backend.auto,all_selected:bool=False,roi:Layer=None) -> Layer:
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -53,15 +92,22 @@ def diff_of_gaus(img:Image, low_sigma:float=1.0, high_sigma:float=20.0, mode='ne
         channel_axis (int or none): optional if None image assumed to be grayscale otherwise indicates axis that denotes color channels
         truncate (float): number of standard deviations to filter 
         pt (bool): flag indicatiing whether to use pytorch implementation
+        backend (Backend): pytorch implementation computing the blurs by 'torch' direct convolution, 'fft' convolution in the frequency domain or 'auto' for the faster one
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has had difference of gaussians applied to it  with '_Band-pass' suffix added to name.
     """
 
-    diff_of_gaus_thread(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt)
+    if all_selected:
+        apply_to_selected(diff_of_gaus_auto_gen,"Difference of Gaussian",low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt,backend=backend.value,roi=roi)
+        return
+    worker = diff_of_gaus_thread(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt,backend=backend.value,roi=roi)
+    stream_to_viewer(worker,"Difference of Gaussian")
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def diff_of_gaus_thread(img:Image, low_sigma, high_sigma=None, mode='nearest',cval=0, channel_axis=None, truncate=4.0, pt=False) -> Layer:
+@thread_worker(progress=True)
+def diff_of_gaus_thread(img:Image, low_sigma, high_sigma=None, mode='nearest',cval=0, channel_axis=None, truncate=4.0, pt=False, backend:str='auto',roi:Layer=None) -> Layer:
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -74,16 +120,18 @@ def diff_of_gaus_thread(img:Image, low_sigma, high_sigma=None, mode='nearest',cv
         channel_axis (int or none): optional if None image assumed to be grayscale otherwise indicates axis that denotes color channels
         truncate (float): number of standard deviations to filter
         pt (bool): flag indicatiing whether to use pytorch implementation
+        backend (str): blurs of the pytorch implementation by 'torch' direct convolution, 'fft' or 'auto' for the faster one
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has had difference of gaussians applied to it  with '_Band-pass' suffix added to name.
     """
     show_info("Difference of Gaussian thread has started")
-    output = diff_of_gaus_func(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt)
+    output = yield from diff_of_gaus_auto_gen(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt,backend=backend,roi=roi)
     show_info("Difference of Gaussian thread has completed")
     return output
 
-def diff_of_gaus_func(img:Image, low_sigma, high_sigma=None, mode='nearest', cval=0, channel_axis=None, truncate=4.0, pt=False) -> Layer:
+def diff_of_gaus_func(img:Image, low_sigma, high_sigma=None, mode='nearest', cval=0, channel_axis=None, truncate=4.0, pt=False, fft=False) -> Layer:
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -96,75 +144,380 @@ def diff_of_gaus_func(img:Image, low_sigma, high_sigma=None, mode='nearest', cva
         channel_axis (int or none): optional if None image assumed to be grayscale otherwise indicates axis that denotes color channels
         truncate (float): number of standard deviations to filter
         pt (bool): flag indicatiing whether to use pytorch implementation
+        fft (bool): compute the blurs of the pytorch implementation in the frequency domain
         
+    Returns:
+        Image Layer that has had difference of gaussians applied to it  with '_Band-pass' suffix added to name.
+    """
+    return run_generator(diff_of_gaus_gen(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,pt=pt,fft=fft))
+
+def diff_of_gaus_auto_gen(img:Image, low_sigma, high_sigma=None, mode='nearest', cval=0, channel_axis=None, truncate=4.0, pt=False, backend:str='auto', roi:Layer=None):
+    """diff_of_gaus_gen with the blurs of the pytorch implementation computed by direct or FFT convolution, chosen by
+    name or, for 'auto', by timing both on a sample of img. Both convolve with the same kernels.
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+    """
+    fft = False
+    if pt and img.data.ndim >= SPATIAL_DIMS:
+        candidates = {
+            "torch": torch_candidate(partial(torchvision_diff_of_gaus_batch,low_sigma=low_sigma,high_sigma=high_sigma,truncate=truncate)),
+            "fft": torch_candidate(partial(torchvision_diff_of_gaus_batch,low_sigma=low_sigma,high_sigma=high_sigma,truncate=truncate,fft=True)),
+        }
+        axis = channel_axis_of(img) if channel_axis is None else channel_axis
+        fft = select_backend("dog",img.data,candidates,{"high_sigma": high_sigma,"truncate": truncate},backend,axis) == "fft"
+    return (yield from diff_of_gaus_gen(img=img,low_sigma=low_sigma,high_sigma=high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate,
+                                        pt=pt,fft=fft,roi=roi))
+
+@profiled("Band-pass (DoG)")
+@roi_restricted(lambda args: round(args["truncate"] * (args["high_sigma"] or 1.6 * args["low_sigma"])),"Band-pass (DoG)")
+@cached("dog")
+@scheduled(lambda args: "torch" if args["pt"] else "skimage","Band-pass (DoG)")
+@incremental("dog")
+def diff_of_gaus_gen(img:Image, low_sigma, high_sigma=None, mode='nearest', cval=0, channel_axis=None, truncate=4.0, pt=False, fft=False):
+    """Implementation of median filter function
+    Args:
+        img (Image): Image/Volume to be segmented.
+        low_sigma (float): standard deviation for lower intensity gaussian filter
+        high_sigma (float): standard deviation for higher intensity gaussian filter
+        mode (str): how input array is extended when filter overlaps border 
+                    reflect, constant, nearest, mirror, wrap, grid-constant, grid-mirror, grid-wrap
+                    for option descriptions refer to https://docs.scipy.org/doc/scipy/reference/generated/scipy.ndimage.gaussian_filter.html
+        cval (int): value to fill past edges in "constant" mode
+        channel_axis (int or none): optional if None image assumed to be grayscale otherwise indicates axis that denotes color channels
+        truncate (float): number of standard deviations to filter
+        pt (bool): flag indicatiing whether to use pytorch implementation
+        fft (bool): compute the blurs of the pytorch implementation in the frequency domain
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
     Returns:
         Image Layer that has had difference of gaussians applied to it  with '_Band-pass' suffix added to name.
     """
     from skimage.filters import difference_of_gaussians
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
+        # channels are filtered as separate slices
+        channel_axis = channel_axis_of(img) if channel_axis is None else channel_axis
         name = f"{img.name}_Band-pass"
         add_kwargs = {"name":f"{name}"}
         layer_type = 'image'
 
-        if data.ndim == 2:
-            if pt:
-                filtered_image = torchvision_diff_of_gaus_2d_data_func(data,low_sigma,high_sigma)
-            else:
-                dog_image = difference_of_gaussians(data,low_sigma,high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate)
-                filtered_image = normalize_data_in_range_pt_func(dog_image,0.0,1.0,True)
-            layer = Layer.create(filtered_image,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(data)),desc="Band-pass(DoG)"):
-                if pt:
-                    data[i] = torchvision_diff_of_gaus_2d_data_func(data[i],low_sigma,high_sigma)
-                else:
-                    dog_image = difference_of_gaussians(data[i],low_sigma,high_sigma,mode=mode,cval=cval,channel_axis=channel_axis,truncate=truncate)
-                    data[i] = normalize_data_in_range_pt_func(dog_image,0.0,1.0,True)
-
-            layer = Layer.create(data,add_kwargs,layer_type)
+        out_data = np.empty(data.shape,dtype=np.result_type(data.dtype,np.float32))
+        with stage("layer"):
+            layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
+
+        if pt:
+            def dog_batch(batch):
+                return torchvision_diff_of_gaus_batch(batch,low_sigma,high_sigma,truncate=truncate,fft=fft)
+
+            kernel_high = 2 * round(truncate * high_sigma) + 1
+            chunks = iter_chunks(data,dog_batch,"dog",out_data,kernel_size=kernel_high,desc="Band-pass(DoG)(PT)",channel_axis=channel_axis)
+        else:
+            def dog_slice(image):
+                dog_image = difference_of_gaussians(image,low_sigma,high_sigma,mode=mode,cval=cval,truncate=truncate)
+                return normalize_data_in_range_pt_func(dog_image,0.0,1.0,True)
+
+            chunks = iter_slices(data,dog_slice,out_data,desc="Band-pass(DoG)",channel_axis=channel_axis)
+
+        for _ in chunks:
+            yield layer
 
         return layer
     
-def denoise_tv(img:Image, weight:float=0.1) -> Layer:
+# pixels of context around regions of interest denoised with total variation, which is not local but barely
+# changes with context further away
+TV_ROI_HALO = 16
+
+def denoise_tv(img:Image, weight:float=0.1,all_selected:bool=False,lazy:bool=False,roi:Layer=None) -> Layer:
     ''''''
-    denoise_tv_thread(img=img,weight=weight)
+    if all_selected:
+        apply_to_selected(denoise_tv_gen,"Denoise Total Variation",weight=weight,roi=roi)
+        return
+    worker = denoise_tv_thread(img=img,weight=weight,lazy=lazy,roi=roi)
+    stream_to_viewer(worker,"Denoise Total Variation")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def denoise_tv_thread(img:Image, weight:float=0.1) -> Layer:
+@thread_worker(progress=True)
+def denoise_tv_thread(img:Image, weight:float=0.1,lazy:bool=False,roi:Layer=None) -> Layer:
     ''''''
     show_info(f'Denoise Total Variation thread has started')
-    denoise_data = denoise_tv_func(data=img.data,weight=weight)
-    print("\n\nWe MADE IT HERE!!\n\n")
-    name = f"{img.name}_TV"
-    add_kwargs = {"name":f"{name}"}
-    layer_type = 'image'
-    layer = Layer.create(denoise_data,add_kwargs,layer_type)
+    if lazy and roi is None and can_display_lazily(img,desc="Denoise Total Variation"):
+        output = yield from denoise_tv_lazy_gen(img=img,weight=weight)
+    else:
+        output = yield from denoise_tv_gen(img=img,weight=weight,roi=roi)
     show_info(f'Denoise Total Variation thread has completed')
-    return layer
+    return output
+
+@profiled("Denoise (TV)")
+@roi_restricted(TV_ROI_HALO,"Denoise (TV)")
+@cached("denoise_tv")
+@scheduled("skimage","Denoise (TV)")
+@incremental("denoise_tv")
+def denoise_tv_gen(img:Image, weight:float=0.1):
+    """Streaming total variation denoising (Chambolle) of an Image layer
+    Args:
+        img (Image): Image/Volume to be denoised.
+        weight (float): denoising weight, greater weight results in more denoising
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed slice.
+
+    Returns:
+        Image Layer that has been denoised with '_TV' suffix added to name.
+    """
+    data = img.data
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        name = f"{img.name}_TV"
+        add_kwargs = {"name":f"{name}"}
+        layer_type = 'image'
+        denoise_data = np.empty(data.shape,dtype=np.result_type(data.dtype,np.float32))
+        with stage("layer"):
+            layer = Layer.create(denoise_data,add_kwargs,layer_type)
+        yield layer
+
+        for _ in iter_denoise_tv(data=data,out=denoise_data,weight=weight,channel_axis=channel_axis_of(img)):
+            yield layer
+
+        return layer
+
+@profiled("Denoise (TV) (lazy)")
+@scheduled("skimage","Denoise (TV) (lazy)")
+def denoise_tv_lazy_gen(img:Image, weight:float=0.1):
+    """Total variation denoising (Chambolle) of an Image layer computing the displayed slice on demand
+    Args:
+        img (Image): Volume to be denoised.
+        weight (float): denoising weight, greater weight results in more denoising
+
+    Yields:
+        Output layer, first when it is created and again after every slice completed in the background.
+
+    Returns:
+        Image Layer that has been denoised with '_TV' suffix added to name.
+    """
+    data = img.data
+    # the result stays within the range of the input, which skimage scales to 0-1 or -1-1 for integer data
+    with stage("statistics",nbytes=data.nbytes):
+        low, high = value_range(data)
+    if np.issubdtype(data.dtype,np.integer):
+        low, high = low / np.iinfo(data.dtype).max, high / np.iinfo(data.dtype).max
+    return (yield from lazy_result_gen(img,denoise_tv_slice_func(weight),f"{img.name}_TV",np.result_type(data.dtype,np.float32),"Denoise(TV) (lazy)",
+                                       (low,high),"skimage"))
 
 def denoise_tv_func(data:ImageData, weight:float=0.1): #-> ImageData:
     """"""
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        tvd = np.empty(data.shape,dtype=np.result_type(data.dtype,np.float32))
+        for _ in iter_denoise_tv(data=data,out=tvd,weight=weight):
+            pass
+
+        return tvd
+
+def iter_denoise_tv(data:ImageData, out:ImageData, weight:float=0.1,channel_axis:int=None):
+    """Streaming total variation denoising (Chambolle)
+    Args:
+        data (ImageData): Image/Volume to be denoised.
+        out (ImageData): array with the same shape as data the result is written to
+        weight (float): denoising weight, greater weight results in more denoising
+        channel_axis (int or None): axis of data holding color channels, every channel is denoised separately
+
+    Yields:
+        (start, stop) range of slices that have been written to out.
+    """
+    yield from iter_slices(data,denoise_tv_slice_func(weight),out,desc="Denoise(TV)",channel_axis=channel_axis)
+
+def denoise_tv_slice_func(weight:float=0.1):
+    """2D total variation denoising (Chambolle) used by iter_denoise_tv and denoise_tv_lazy_gen."""
     from skimage.restoration import denoise_tv_chambolle
 
+    def tv_slice(image):
+        return denoise_tv_chambolle(image, weight=weight,eps =0.0002)
+    return tv_slice
+
+def denoise_nl_means(img:Image, patch_size:int=5, patch_distance:int=6, h:float=0.1, sigma:float=0.0, patch_slices:int=1, pt:bool=True,all_selected:bool=False,roi:Layer=None) -> Layer:
+    """Non-local means denoising, every pixel is replaced by the mean of the pixels in its search window weighted by
+    the similarity of the patches around them.
+
+    Args:
+        img (Image): Image/Volume to be denoised.
+        patch_size (int): rows and columns of the patches compared, odd
+        patch_distance (int): largest shift in pixels between compared patches, the search window is
+                              2 * patch_distance + 1 pixels wide
+        h (float): cut-off distance in units of the data, greater h results in more denoising
+        sigma (float): standard deviation of the noise, subtracted from patch distances
+        patch_slices (int): neighbouring B-scans the patches extend over, odd, 1 compares 2D patches and larger values
+                            need a 3D volume and the pytorch implementation
+        pt (bool): flag indicating whether to use the batched pytorch implementation instead of skimage denoise_nl_means per slice
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
+
+    Returns:
+        Image Layer that has been denoised with '_NLM' suffix added to name.
+    """
+    if all_selected:
+        apply_to_selected(denoise_nl_means_gen,"Non-local Means",patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,patch_slices=patch_slices,pt=pt,roi=roi)
+        return
+    worker = denoise_nl_means_thread(img=img,patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,patch_slices=patch_slices,pt=pt,roi=roi)
+    stream_to_viewer(worker,"Non-local Means")
+    return
+
+@thread_worker(progress=True)
+def denoise_nl_means_thread(img:Image, patch_size:int=5, patch_distance:int=6, h:float=0.1, sigma:float=0.0, patch_slices:int=1, pt:bool=True,roi:Layer=None) -> Layer:
+    ''''''
+    show_info('Non-local Means thread has started')
+    output = yield from denoise_nl_means_gen(img=img,patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,patch_slices=patch_slices,pt=pt,roi=roi)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info('Non-local Means thread has completed')
+    return output
+
+def denoise_nl_means_func(img:Image, patch_size:int=5, patch_distance:int=6, h:float=0.1, sigma:float=0.0, patch_slices:int=1, pt:bool=True) -> Layer:
+    """Non streaming version of denoise_nl_means_gen"""
+    return run_generator(denoise_nl_means_gen(img=img,patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,patch_slices=patch_slices,pt=pt))
+
+def slice_mean_batch(batch,size:int):
+    """Mean over size neighbouring slices of a (B,H,W) tensor, reflected at its first and last slice."""
+    half, n_slices = size // 2, batch.shape[0]
+    index = torch.arange(-half,n_slices + half,device=batch.device).abs()
+    index = (n_slices - 1 - (n_slices - 1 - index).abs()).clamp_(0,n_slices - 1)
+    padded = batch[index]
+    return sum(padded[k:k + n_slices] for k in range(size)) / size
+
+def nl_means_batch(batch,patch_size:int=5,patch_distance:int=6,h:float=0.1,sigma:float=0.0,patch_slices:int=1):
+    """Non-local means of every slice of a (B,H,W) tensor, vectorized over the slices and pixels of the batch.
+
+    For every shift within the search window the squared differences between the slices and their shifted copy are
+    averaged over patches with box_filter_batch, so the cost per pixel grows with the number of shifts but not with
+    the patch size. Patch distances are symmetric, the weights of a shift also weigh the pixels it points to, so
+    only half of the shifts are computed. Weights are exp(-max(d - 2 * sigma**2,0) / h**2) of the mean squared patch
+    difference d like skimage denoise_nl_means in fast mode. 3D patches average d over patch_slices neighbouring
+    slices of the batch, which have to be consecutive B-scans of a volume.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        patch_size (int): rows and columns of the patches, odd
+        patch_distance (int): largest shift between compared patches
+        h (float): cut-off distance in units of the data
+        sigma (float): standard deviation of the noise
+        patch_slices (int): slices the patches extend over, odd
+
+    Returns:
+        (B,H,W) denoised tensor.
+    """
+    half, reach = patch_size // 2, patch_distance
+    height, width = batch.shape[-2:]
+    context, pad = half + reach, half + 2 * reach
+    mode = 'reflect' if context < min(height,width) else 'replicate'
+    # only pixels within context of the slices reach the result, the outer padding keeps the shapes of all shifts equal
+    padded = F.pad(batch.unsqueeze(1),(context,context,context,context),mode=mode)
+    padded = F.pad(padded,(reach,reach,reach,reach),mode='replicate').squeeze(1)
+    # weights are computed for the slices grown by patch_distance, the pixels whose shifts reach into the slices
+    rows, cols = height + 2 * reach + 2 * half, width + 2 * reach + 2 * half
+    centre = padded[:,reach:reach + rows,reach:reach + cols]
+    core = padded[:,pad:pad + height,pad:pad + width]
+    offset = 2 * sigma**2
+    # the zero shift has weight 1
+    numerator = core.clone()
+    weights = torch.ones_like(batch)
+    for dy in range(reach + 1):
+        for dx in range(-reach,reach + 1):
+            if dy == 0 and dx <= 0:
+                continue
+            shifted = padded[:,reach + dy:reach + dy + rows,reach + dx:reach + dx + cols]
+            distance = box_filter_batch((centre - shifted).square(),patch_size,None)
+            if patch_slices > 1:
+                distance = slice_mean_batch(distance,patch_slices)
+            weight = torch.exp(-(distance - offset).clamp_(min=0) / h**2)
+            forward = weight[:,reach:reach + height,reach:reach + width]
+            numerator += forward * padded[:,pad + dy:pad + dy + height,pad + dx:pad + dx + width]
+            backward = weight[:,reach - dy:reach - dy + height,reach - dx:reach - dx + width]
+            numerator += backward * padded[:,pad - dy:pad - dy + height,pad - dx:pad - dx + width]
+            weights += forward + backward
+    return numerator / weights
+
+def nl_means_slice_func(patch_size:int=5,patch_distance:int=6,h:float=0.1,sigma:float=0.0):
+    """2D non-local means with skimage denoise_nl_means in fast mode, in units of the data."""
+    from skimage.restoration import denoise_nl_means
+
+    def nl_means_slice(image):
+        return denoise_nl_means(np.asarray(image,dtype=np.float32),patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,fast_mode=True)
+    return nl_means_slice
+
+@profiled("Denoise (NL-means)")
+@roi_restricted(lambda args: args["patch_size"] // 2 + args["patch_distance"],"Denoise (NL-means)",lambda args: args["patch_slices"] // 2 if args["pt"] else 0)
+@cached("nl_means")
+@scheduled(lambda args: "torch" if args["pt"] else "skimage","Denoise (NL-means)")
+def denoise_nl_means_gen(img:Image, patch_size:int=5, patch_distance:int=6, h:float=0.1, sigma:float=0.0, patch_slices:int=1, pt:bool=True):
+    """Streaming non-local means denoising of an Image layer
+
+    The torch implementation processes batches of slices and splits slices into row tiles overlapping by the patch
+    radius plus patch_distance when a slice does not fit the memory budget. Batches of 3D patches are read with
+    patch_slices // 2 neighbouring slices on each side.
+
+    Args:
+        img (Image): Image/Volume to be denoised.
+        patch_size (int): rows and columns of the patches compared, odd
+        patch_distance (int): largest shift in pixels between compared patches
+        h (float): cut-off distance in units of the data, greater h results in more denoising
+        sigma (float): standard deviation of the noise, subtracted from patch distances
+        patch_slices (int): neighbouring B-scans the patches extend over, odd, only used by the torch implementation
+                            of 3D grayscale volumes
+        pt (bool): flag indicating whether to use the pytorch implementation
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Image Layer that has been denoised with '_NLM' suffix added to name.
+    """
+    data = img.data
+
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert patch_size % 2 == 1 and patch_slices % 2 == 1, "patch_size and patch_slices must be odd"
+        assert h > 0, "h must be positive"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
-        tvd = data.copy()
+        channel_axis = channel_axis_of(img)
+        if patch_slices > 1 and (not pt or data.ndim != 3 or channel_axis is not None):
+            show_info("Non-local Means: 3D patches need a grayscale volume of 3 dimensions and the torch backend, comparing 2D patches instead")
+            patch_slices = 1
+        name = f"{img.name}_NLM"
+        add_kwargs = {"name":f"{name}"}
+        layer_type = 'image'
 
-        if data.ndim == 2:
-            tvd = denoise_tv_chambolle(tvd, weight=weight,eps =0.0002)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(data)),desc="Denoise(TV)"):
-                tvd[i] = denoise_tv_chambolle(tvd[i], weight=weight,eps =0.0002)
+        out_data = np.empty(data.shape,dtype=np.result_type(data.dtype,np.float32))
+        with stage("layer"):
+            layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
 
-        return tvd
\ No newline at end of file
+        if pt:
+            nl_means = partial(nl_means_batch,patch_size=patch_size,patch_distance=patch_distance,h=h,sigma=sigma,patch_slices=patch_slices)
+            radius = patch_size // 2 + patch_distance
+            chunks = iter_chunks(data,nl_means,"nl_means",out_data,kernel_size=2 * radius + 1,halo=radius,desc="Non-local Means(PT)",
+                                 channel_axis=channel_axis,slice_halo=patch_slices // 2)
+        else:
+            chunks = iter_slices(data,nl_means_slice_func(patch_size,patch_distance,h,sigma),out_data,desc="Non-local Means",channel_axis=channel_axis)
+
+        for _ in chunks:
+            yield layer
+
+        return layer
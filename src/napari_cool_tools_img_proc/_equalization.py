@@ -2,34 +2,85 @@
 This module contains code for equalizing image values
 """
 import numpy as np
-from tqdm import tqdm
 from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.qt.threading import thread_worker
-from napari_cool_tools_io import torch,viewer,device,memory_stats
+from napari_cool_tools_io import torch,viewer,memory_stats
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
 from napari_cool_tools_img_proc._normalization import normalize_in_range_pt_func
-
-def clahe(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,pt_K:bool=True) -> Layer:
+from napari_cool_tools_img_proc._lazy import can_display_lazily, lazy_result_gen, torch_slice_func
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._pointwise import PointwiseChain
+from napari_cool_tools_img_proc._pool import apply_to_selected
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._roi import roi_restricted
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._statistics import value_range
+from napari_cool_tools_img_proc._streaming import can_process_in_place, iter_slices, run_generator, stream_to_viewer
+
+def clahe(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,pt_K:bool=True,all_selected:bool=False,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0,lazy:bool=False,roi:Layer=None) -> Layer:
     ''''''
-    clahe_thread(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,pt_K=pt_K)
+    if all_selected:
+        apply_to_selected(clahe_pt_gen if pt_K else clahe_gen,"Autocontrast (CLAHE)",kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile,roi=roi)
+        return
+    worker = clahe_thread(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,pt_K=pt_K,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile,lazy=lazy,roi=roi)
+    stream_to_viewer(worker,"Autocontrast (CLAHE)")
 
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def clahe_thread(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,pt_K:bool=True) -> Layer:
+@thread_worker(progress=True)
+def clahe_thread(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,pt_K:bool=True,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0,lazy:bool=False,roi:Layer=None) -> Layer:
     ''''''
     show_info(f'Autocontrast (CLAHE) thread has started')
-    if pt_K:
-        output = clahe_pt_func(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max)
-        torch.cuda.empty_cache()
-        memory_stats()
+    if lazy and roi is None and can_display_lazily(img,in_place,"Autocontrast (CLAHE)"):
+        output = yield from clahe_lazy_gen(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,low_quantile=low_quantile,high_quantile=high_quantile,pt_K=pt_K)
     else:
-        output = clahe_func(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max)
+        gen_func = clahe_pt_gen if pt_K else clahe_gen
+        output = yield from gen_func(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile,roi=roi)
+    torch.cuda.empty_cache()
+    memory_stats()
     show_info(f'Autocontrast (CLAHE) thread has completed')
     return output
 
-def clahe_func(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1) -> Layer:
+@profiled("CLAHE (lazy)")
+@scheduled(lambda args: "torch" if args["pt_K"] else "skimage","CLAHE (lazy)")
+def clahe_lazy_gen(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,low_quantile:float=0.0,high_quantile:float=1.0,pt_K:bool=True):
+    """clahe_pt_gen or clahe_gen equalizing the displayed slice on demand and the remaining slices in the background"""
+    from kornia.enhance import equalize_clahe
+    from skimage.exposure import equalize_adapthist
+
+    data = img.data
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        # slices are normalized with the bounds of the whole volume like normalize_in_range_pt_func does
+        with stage("statistics",nbytes=data.nbytes):
+            data_min, data_max = value_range(data,low_quantile,high_quantile)
+        normalize = PointwiseChain().normalize(data_min,data_max,norm_min,norm_max,low_quantile > 0 or high_quantile < 1)
+
+        def clahe_batch(batch):
+            return equalize_clahe(normalize(batch).unsqueeze(1),clip_limit).squeeze(1)
+
+        def clahe_slice(image):
+            return equalize_adapthist(normalize.apply(image),kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins)
+
+        slice_func = torch_slice_func(clahe_batch) if pt_K else clahe_slice
+        return (yield from lazy_result_gen(img,slice_func,f"{img.name}_CLAHE",np.float32,"CLAHE (lazy)",(norm_min,norm_max),"torch" if pt_K else "skimage"))
+
+def clahe_func(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0) -> Layer:
     ''''''
+    return run_generator(clahe_gen(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile))
+
+@profiled("CLAHE")
+@roi_restricted(lambda args: int(np.max(args["kernel_size"] or 0)),"CLAHE")
+@cached("clahe")
+@scheduled("skimage","CLAHE")
+def clahe_gen(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_min=0,norm_max=1,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0):
+    """Streaming version of clahe_func, yields the output layer when allocated and after every completed slice"""
     from skimage.exposure import equalize_adapthist
 
     name = img.name
@@ -40,39 +91,44 @@ def clahe_func(img:Image, kernel_size=None,clip_limit:float=0.01,nbins=256,norm_
     # optional layer type argument
     layer_type = "image"
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
 
-        dtype_in = data.dtype
-        norm_img = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=False)
-        norm_data = norm_img.data
-
-        if data.ndim == 2:
-            init_out = equalize_adapthist(norm_data,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins)
-            img_out = init_out.astype(dtype_in)
-            layer = Layer.create(img_out,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(data)),desc="CLAHE"):
-                norm_data[i] = equalize_adapthist(norm_data[i],kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins)
-            
-            img_out = norm_data.astype(dtype_in)
-            layer = Layer.create(img_out,add_kwargs,layer_type)
+        if in_place and can_process_in_place(data,np.float32,"CLAHE"):
+            norm_data = img_out = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=True,low_quantile=low_quantile,high_quantile=high_quantile).data
+            layer = img
+        else:
+            norm_img = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=False,low_quantile=low_quantile,high_quantile=high_quantile)
+            norm_data = norm_img.data
 
-        #init_out = equalize_adapthist(norm_data,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins)
+            img_out = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(img_out,add_kwargs,layer_type)
+        yield layer
 
-        #img_out = init_out.astype(dtype_in)
+        def clahe_slice(image):
+            return equalize_adapthist(image,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins)
 
-        #layer = Layer.create(img_out,add_kwargs,layer_type)
+        for _ in iter_slices(norm_data,clahe_slice,img_out,desc="CLAHE",channel_axis=channel_axis_of(img)):
+            yield layer
 
         return layer
     
-def clahe_pt_func(img:Image, kernel_size=None,clip_limit:float=40.0,nbins=256,norm_min=0,norm_max=1) -> Layer:
+def clahe_pt_func(img:Image, kernel_size=None,clip_limit:float=40.0,nbins=256,norm_min=0,norm_max=1,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0) -> Layer:
     """"""
+    return run_generator(clahe_pt_gen(img=img,kernel_size=kernel_size,clip_limit=clip_limit,nbins=nbins,norm_min=norm_min,norm_max=norm_max,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile))
+
+@profiled("CLAHE(PT)")
+@roi_restricted(lambda args: int(np.max(args["kernel_size"] or 0)),"CLAHE(PT)")
+@cached("clahe_pt")
+@scheduled("torch","CLAHE(PT)")
+def clahe_pt_gen(img:Image, kernel_size=None,clip_limit:float=40.0,nbins=256,norm_min=0,norm_max=1,in_place:bool=False,low_quantile:float=0.0,high_quantile:float=1.0):
+    """Streaming version of clahe_pt_func, yields the output layer when allocated and after every completed batch"""
 
     from kornia.enhance import equalize_clahe
 
@@ -80,32 +136,35 @@ def clahe_pt_func(img:Image, kernel_size=None,clip_limit:float=40.0,nbins=256,no
     layer_type = "image"
     add_kwargs = {"name": f"{name}"}
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
 
-        dtype_in = data.dtype
-        norm_img = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=False)
+        in_place = in_place and can_process_in_place(data,np.float32,"CLAHE(PT)")
+        norm_img = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile)
         norm_data = norm_img.data
-        pt_data = torch.tensor(norm_data,device=device)
-
-        if data.ndim == 2:
-            equalized = equalize_clahe(pt_data,clip_limit)
-            out_data = equalized.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(pt_data)),desc="CLAHE(PT)"):
-                pt_data[i] = equalize_clahe(pt_data[i],clip_limit)
-            
-            out_data = pt_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
+
+        def clahe_batch(batch):
+            return equalize_clahe(batch.unsqueeze(1),clip_limit).squeeze(1)
+
+        # equalized slices overwrite the normalized copy as they complete
+        if in_place:
+            layer = img
+        else:
+            with stage("layer"):
+                layer = Layer.create(norm_data,add_kwargs,layer_type)
+        yield layer
+
+        for _ in iter_chunks(norm_data,clahe_batch,"clahe",norm_data,desc="CLAHE(PT)",channel_axis=channel_axis_of(img)):
+            yield layer
 
         return layer
     
+@profiled("Match Histograms")
 def match_histogram(target_histogram:Image,debug:bool=False):
     """"""
     from skimage.exposure import match_histograms
@@ -114,6 +173,8 @@ def match_histogram(target_histogram:Image,debug:bool=False):
     current_selection = list(viewer.layers.selection)
     
     for layer in current_selection:
-        matched = match_histograms(layer.data,target_data,channel_axis=-1)
-        layer.data[:] = matched[:]
+        with stage("compute"):
+            matched = match_histograms(layer.data,target_data,channel_axis=-1)
+        with stage("copy",nbytes=matched.nbytes):
+            layer.data[:] = matched[:]
     return layer
\ No newline at end of file
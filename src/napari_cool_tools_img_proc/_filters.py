@@ -1,13 +1,28 @@
 """
 This module contains code for filtering images
 """
-from tqdm import tqdm
+import numpy as np
 from enum import Enum
+from functools import partial
 from numpy import ndarray
 from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.qt.threading import thread_worker
-from napari_cool_tools_io import torch,viewer,device,memory_stats
+from torch.nn import functional as F
+from napari_cool_tools_io import torch,memory_stats
+from napari_cool_tools_img_proc._autotune import Backend, select_backend, torch_candidate
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
+from napari_cool_tools_img_proc._incremental import incremental
+from napari_cool_tools_img_proc._kernels import fft_gaussian_blur_batch, gaussian_blur_batch, gaussian_kernel
+from napari_cool_tools_img_proc._lazy import can_display_lazily, lazy_result_gen, torch_slice_func
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._pool import apply_to_selected
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._roi import roi_restricted
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._statistics import value_range
+from napari_cool_tools_img_proc._streaming import can_process_in_place, run_generator, stream_to_viewer
 
 def filter_bilateral(img:Image,kernel_size:int=1,s0:int=10,s1:int=10) -> Image:
     ''''''
@@ -28,7 +43,7 @@ def sharpen_um(img:Image, radius:float=1.0, amount:float=1.0, preserve_range=Fal
     sharp_img = unsharp_mask(img, radius=radius,amount=amount, preserve_range=preserve_range, channel_axis=channel_axis)
     return sharp_img
 
-def filter_bilateral(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10):
+def filter_bilateral(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,all_selected:bool=False,in_place:bool=False,lazy:bool=False,roi:Layer=None):
     """Implementation of bilateral filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -36,15 +51,23 @@ def filter_bilateral(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=1
         sc (float): sigma_color Standard deviation for grayvalue/color distance (radiometric similarity). A larger value results in averaging of pixels with larger radiometric differences
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        lazy (bool): filter the displayed slice when it is shown and the remaining slices in the background
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has been bilaterally filtered  with '_Bilat_(kernel_size)' suffix added to name.
     """
-    filter_bilateral_thread(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1)
+    if all_selected:
+        apply_to_selected(filter_bilateral_pt_gen,"Bilateral Filter",kernel_size=kernel_size,sc=sc,s0=s0,s1=s1,in_place=in_place,roi=roi)
+        return
+    worker = filter_bilateral_thread(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1,in_place=in_place,lazy=lazy,roi=roi)
+    stream_to_viewer(worker,"Bilateral Filter")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def filter_bilateral_thread(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10) -> Image:
+@thread_worker(progress=True)
+def filter_bilateral_thread(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,in_place:bool=False,lazy:bool=False,roi:Layer=None) -> Image:
     """Implementation of bilateral filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -52,12 +75,18 @@ def filter_bilateral_thread(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s
         sc (float): sigma_color Standard deviation for grayvalue/color distance (radiometric similarity). A larger value results in averaging of pixels with larger radiometric differences
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        lazy (bool): filter the displayed slice when it is shown and the remaining slices in the background
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has been bilaterally filtered  with '_Bilat_(kernel_size)' suffix added to name.
     """
     show_info(f'Bilateral Filter thread has started')
-    output = filter_bilateral_pt_func(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1)
+    if lazy and roi is None and can_display_lazily(img,in_place,"Bilateral Filter"):
+        output = yield from filter_bilateral_lazy_gen(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1)
+    else:
+        output = yield from filter_bilateral_pt_gen(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1,in_place=in_place,roi=roi)
     torch.cuda.empty_cache()
     memory_stats()
     show_info(f'Bilateral Filter thread has completed')
@@ -65,7 +94,7 @@ def filter_bilateral_thread(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s
     return output
 
 
-def filter_bilateral_pt_func(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,border_type:str='reflect',color_distance_type:str='l1') -> Image:
+def filter_bilateral_pt_func(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,border_type:str='reflect',color_distance_type:str='l1',in_place:bool=False) -> Image:
     """Implementation of bilateral filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -73,13 +102,59 @@ def filter_bilateral_pt_func(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,
         sc (float): sigma_color Standard deviation for grayvalue/color distance (radiometric similarity). A larger value results in averaging of pixels with larger radiometric differences
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
         
     Returns:
         Image Layer that has been bilaterally filtered  with '_Bilat_(kernel_size)' suffix added to name.
     """
-    
-    from kornia.filters import bilateral_blur
-    
+    return run_generator(filter_bilateral_pt_gen(img=img,kernel_size=kernel_size,sc=sc,s0=s0,s1=s1,border_type=border_type,color_distance_type=color_distance_type,in_place=in_place))
+
+def bilateral_blur_batch(batch,kernel_size:int,sigma_color:float,sigma_space:tuple,border_type:str='reflect',color_distance_type:str='l1'):
+    """Bilateral blur of every slice of a (B,H,W) tensor with a registry spatial kernel, matches kornia bilateral_blur.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        kernel_size (int): dimension of symmetrical kernel, should be odd number
+        sigma_color (float): standard deviation for grayvalue distance
+        sigma_space (tuple): standard deviation of the spatial kernel per axis (rows, columns)
+        border_type (str): padding mode applied prior to filtering
+        color_distance_type (str): 'l1' or 'l2', identical for grayscale slices
+
+    Returns:
+        (B,H,W) filtered tensor.
+    """
+    space_kernel = gaussian_kernel(kernel_size,sigma_space,2,batch.dtype,batch.device).reshape(-1)
+    pad = kernel_size // 2
+    padded = F.pad(batch.unsqueeze(1),(pad,pad,pad,pad),mode=border_type).squeeze(1)
+    # (B,H,W,kernel_size**2) neighbourhood of every pixel
+    neighbours = padded.unfold(1,kernel_size,1).unfold(2,kernel_size,1).flatten(-2)
+    # l1 and l2 color distances of single channel slices are both the absolute difference
+    color_distance_sq = (neighbours - batch.unsqueeze(-1)).square()
+    kernel = space_kernel * torch.exp(-0.5 / sigma_color**2 * color_distance_sq)
+    return (neighbours * kernel).sum(-1) / kernel.sum(-1)
+
+@profiled("Bilateral Filter")
+@roi_restricted(lambda args: args["kernel_size"] // 2,"Bilateral Filter")
+@cached("bilateral")
+@scheduled("torch","Bilateral Filter")
+@incremental("bilateral")
+def filter_bilateral_pt_gen(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,border_type:str='reflect',color_distance_type:str='l1',in_place:bool=False):
+    """Implementation of bilateral filter function
+    Args:
+        img (Image): Image/Volume to be segmented.
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        sc (float): sigma_color Standard deviation for grayvalue/color distance (radiometric similarity). A larger value results in averaging of pixels with larger radiometric differences
+        s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Image Layer that has been bilaterally filtered  with '_Bilat_(kernel_size)' suffix added to name.
+    """
+
     name = img.name
 
     # optional kwargs for viewer.add_* method
@@ -88,77 +163,136 @@ def filter_bilateral_pt_func(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,
     # optional layer type argument
     layer_type = "image"
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
 
-        pt_data = torch.tensor(data,device=device)
+        def bilateral_batch(batch):
+            return bilateral_blur_batch(batch,kernel_size,sc,(s0,s1),border_type,color_distance_type)
 
-        if data.ndim == 2:
-            in_data = pt_data.unsqueeze(0).unsqueeze(0)
-            blur_data = bilateral_blur(in_data,(kernel_size,kernel_size),sc,(s0,s1)).squeeze()
-            out_data = blur_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(pt_data)),desc="Bilateral Blur"):
-                in_data = pt_data[i].unsqueeze(0).unsqueeze(0)
-                pt_data[i] = bilateral_blur(in_data,(kernel_size,kernel_size),sc,(s0,s1)).squeeze()
+        if in_place and can_process_in_place(data,data.dtype,"Bilateral Filter"):
+            out_data, layer = data, img
+        else:
+            out_data = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
 
-            out_data = pt_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
+        for _ in iter_chunks(data,bilateral_batch,"bilateral",out_data,kernel_size=kernel_size,halo=kernel_size//2,desc="Bilateral Blur",channel_axis=channel_axis_of(img)):
+            yield layer
 
         return layer
+
+@profiled("Bilateral Filter (lazy)")
+@scheduled("torch","Bilateral Filter (lazy)")
+def filter_bilateral_lazy_gen(img:Image,kernel_size:int=5,sc:float=0.1,s0:int=10,s1:int=10,border_type:str='reflect',color_distance_type:str='l1'):
+    """Bilateral filter of a volume computing the displayed slice on demand and the remaining slices in the background
+    Args:
+        img (Image): Volume to be filtered.
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        sc (float): sigma_color Standard deviation for grayvalue/color distance (radiometric similarity)
+        s0 (int): standard deviation of fist dimension of the kernel for range distance
+        s1 (int): standard deviation of the 2nd dimension of the kernel for range distance
+        border_type (str): padding mode applied prior to filtering
+        color_distance_type (str): 'l1' or 'l2', identical for grayscale slices
+
+    Yields:
+        Output layer, first when it is created and again after every slice completed in the background.
+
+    Returns:
+        Image Layer that has been bilaterally filtered  with '_Bilat_(kernel_size)' suffix added to name.
+    """
+    bilateral_batch = partial(bilateral_blur_batch,kernel_size=kernel_size,sigma_color=sc,sigma_space=(s0,s1),border_type=border_type,color_distance_type=color_distance_type)
+    # filtered values are weighted means of input values
+    with stage("statistics",nbytes=img.data.nbytes):
+        contrast_limits = value_range(img.data)
+    return (yield from lazy_result_gen(img,torch_slice_func(bilateral_batch),f"{img.name}_Bilat_{kernel_size}",img.data.dtype,"Bilateral Blur (lazy)",
+                                       contrast_limits,"torch"))
     
-def sharpen_um(img:Image,kernel_size:int=3,s0:int=10,s1:int=10):
+def sharpen_um(img:Image,kernel_size:int=3,s0:int=10,s1:int=10,all_selected:bool=False,in_place:bool=False,backend:Backend=Backend.auto,roi:Layer=None):
     """Implementation of Unsharm Mask function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (Backend): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has been sharpened  with '_UM_(kernel_size)' suffix added to name.
     """
-    sharpen_um_thread(img=img,kernel_size=kernel_size,s0=s0,s1=s1)
+    if all_selected:
+        apply_to_selected(sharpen_um_pt_gen,"Unsharp Mask Filter",kernel_size=kernel_size,s0=s0,s1=s1,in_place=in_place,backend=backend.value,roi=roi)
+        return
+    worker = sharpen_um_thread(img=img,kernel_size=kernel_size,s0=s0,s1=s1,in_place=in_place,backend=backend.value,roi=roi)
+    stream_to_viewer(worker,"Unsharp Mask Filter")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def sharpen_um_thread(img:Image,kernel_size:int=3,s0:int=10,s1:int=10)-> Image:
+@thread_worker(progress=True)
+def sharpen_um_thread(img:Image,kernel_size:int=3,s0:int=10,s1:int=10,in_place:bool=False,backend:str='auto',roi:Layer=None)-> Image:
     """Implementation of Unsharm Mask function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has been sharpened  with '_UM_(kernel_size)' suffix added to name.
     """
     show_info(f'Unsharp Mask Filter thread has started')
-    output = sharpen_um_pt_func(img=img,kernel_size=kernel_size,s0=s0,s1=s1)
+    output = yield from sharpen_um_pt_gen(img=img,kernel_size=kernel_size,s0=s0,s1=s1,in_place=in_place,backend=backend,roi=roi)
     torch.cuda.empty_cache()
     memory_stats()
     show_info(f'Unsharp Mask Filter thread has completed')
     return output
 
-def sharpen_um_pt_func(img:Image,kernel_size:int=3,s0:int=10,s1:int=10)-> Image:
+def sharpen_um_pt_func(img:Image,kernel_size:int=3,s0:int=10,s1:int=10,in_place:bool=False,backend:str='auto')-> Image:
     """Implementation of Unsharm Mask function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
         s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
         s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
         
     Returns:
         Image Layer that has been sharpened  with '_UM_(kernel_size)' suffix added to name.
     """
-    from kornia.filters import unsharp_mask
-    
+    return run_generator(sharpen_um_pt_gen(img=img,kernel_size=kernel_size,s0=s0,s1=s1,in_place=in_place,backend=backend))
+
+@profiled("Unsharp Mask")
+@roi_restricted(lambda args: args["kernel_size"] // 2,"Unsharp Mask")
+@cached("unsharp")
+@scheduled("torch","Unsharp Mask")
+@incremental("unsharp")
+def sharpen_um_pt_gen(img:Image,kernel_size:int=3,s0:int=10,s1:int=10,in_place:bool=False,backend:str='auto'):
+    """Implementation of Unsharm Mask function
+    Args:
+        img (Image): Image/Volume to be segmented.
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        s0 (int): standard deviation of fist dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        s1 (int): standard deviation of the 2nd dimension of the kernel for range distance. A larger value results in averaging of pixels with larger spatial differences.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Image Layer that has been sharpened  with '_UM_(kernel_size)' suffix added to name.
+    """
     name = img.name
 
     # optional kwargs for viewer.add_* method
@@ -167,66 +301,100 @@ def sharpen_um_pt_func(img:Image,kernel_size:int=3,s0:int=10,s1:int=10)-> Image:
     # optional layer type argument
     layer_type = "image"
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
 
-        pt_data = torch.tensor(data,device=device)
+        def unsharp_batch(batch,blur=gaussian_blur_batch):
+            return 2 * batch - blur(batch,kernel_size,(s0,s1),'reflect')
 
-        if data.ndim == 2:
-            in_data = pt_data.unsqueeze(0).unsqueeze(0)
-            um_data = unsharp_mask(in_data,(kernel_size,kernel_size),(s0,s1)).squeeze()
-            out_data = um_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(pt_data)),desc="Unsharp Mask"):
-                in_data = pt_data[i].unsqueeze(0).unsqueeze(0)
-                pt_data[i] = unsharp_mask(in_data,(kernel_size,kernel_size),(s0,s1)).squeeze()
+        blur_funcs = {"torch": gaussian_blur_batch,"fft": fft_gaussian_blur_batch}
+        candidates = {k: torch_candidate(partial(unsharp_batch,blur=f)) for k, f in blur_funcs.items()}
+        backend = select_backend("unsharp",data,candidates,{"kernel_size": kernel_size},backend,channel_axis_of(img))
+        unsharp_batch = partial(unsharp_batch,blur=blur_funcs[backend])
 
-            out_data = pt_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
+        if in_place and can_process_in_place(data,data.dtype,"Unsharp Mask"):
+            out_data, layer = data, img
+        else:
+            out_data = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
+
+        for _ in iter_chunks(data,unsharp_batch,"unsharp",out_data,kernel_size=kernel_size,halo=kernel_size//2,desc="Unsharp Mask",channel_axis=channel_axis_of(img)):
+            yield layer
 
         return layer
     
-def filter_median(img:Image,kernel_size:int=3):
+def filter_median(img:Image,kernel_size:int=3,all_selected:bool=False,in_place:bool=False,roi:Layer=None):
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has median blur  with '_Med_(kernel_size)' suffix added to name.
     """
-    filter_median_thread(img=img,kernel_size=kernel_size)
+    if all_selected:
+        apply_to_selected(filter_median_pt_gen,"Median Filter",kernel_size=kernel_size,in_place=in_place,roi=roi)
+        return
+    worker = filter_median_thread(img=img,kernel_size=kernel_size,in_place=in_place,roi=roi)
+    stream_to_viewer(worker,"Median Filter")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def filter_median_thread(img:Image,kernel_size:int=3)-> Image:
+@thread_worker(progress=True)
+def filter_median_thread(img:Image,kernel_size:int=3,in_place:bool=False,roi:Layer=None)-> Image:
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has median blur  with '_Med_(kernel_size)' suffix added to name.
     """
     show_info(f'Median Filter thread has started')
-    output = filter_median_pt_func(img=img,kernel_size=kernel_size)
+    output = yield from filter_median_pt_gen(img=img,kernel_size=kernel_size,in_place=in_place,roi=roi)
     torch.cuda.empty_cache()
     memory_stats()
     show_info(f'Median Filter thread has completed')
     return output
 
-def filter_median_pt_func(img:Image,kernel_size:int=3)-> Image:
+def filter_median_pt_func(img:Image,kernel_size:int=3,in_place:bool=False)-> Image:
     """Implementation of median filter function
     Args:
         img (Image): Image/Volume to be segmented.
         kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        in_place (bool): overwrite the data of img instead of creating a new layer
         
+    Returns:
+        Image Layer that has median blur  with '_Med_(kernel_size)' suffix added to name.
+    """
+    return run_generator(filter_median_pt_gen(img=img,kernel_size=kernel_size,in_place=in_place))
+
+@profiled("Median Filter")
+@roi_restricted(lambda args: args["kernel_size"] // 2,"Median Filter")
+@cached("median")
+@scheduled("torch","Median Filter")
+@incremental("median")
+def filter_median_pt_gen(img:Image,kernel_size:int=3,in_place:bool=False):
+    """Implementation of median filter function
+    Args:
+        img (Image): Image/Volume to be segmented.
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
     Returns:
         Image Layer that has median blur  with '_Med_(kernel_size)' suffix added to name.
     """
@@ -240,28 +408,27 @@ def filter_median_pt_func(img:Image,kernel_size:int=3)-> Image:
     # optional layer type argument
     layer_type = "image"
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
 
-        pt_data = torch.tensor(data,device=device)
+        def median_batch(batch):
+            return median_blur(batch.unsqueeze(1),(kernel_size,kernel_size)).squeeze(1)
 
-        if data.ndim == 2:
-            in_data = pt_data.unsqueeze(0).unsqueeze(0)
-            um_data = median_blur(in_data,(kernel_size,kernel_size)).squeeze()
-            out_data = um_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(pt_data)),desc="Median Filter"):
-                in_data = pt_data[i].unsqueeze(0).unsqueeze(0)
-                pt_data[i] = median_blur(in_data,(kernel_size,kernel_size)).squeeze()
+        if in_place and can_process_in_place(data,data.dtype,"Median Filter"):
+            out_data, layer = data, img
+        else:
+            out_data = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
 
-            out_data = pt_data.detach().cpu().numpy()
-            layer = Layer.create(out_data,add_kwargs,layer_type)
+        for _ in iter_chunks(data,median_batch,"median",out_data,kernel_size=kernel_size,halo=kernel_size//2,desc="Median Filter",channel_axis=channel_axis_of(img)):
+            yield layer
 
         return layer
 
@@ -272,7 +439,7 @@ class KnBorderType(Enum):
     replicate = 'replicate'
     circular = 'circular'
 
-def filter_gaussian_blur_plg(img:Image,kernel_size:int=3,sigma:float=1,border_type:KnBorderType=KnBorderType.reflect,separable:bool=True):
+def filter_gaussian_blur_plg(img:Image,kernel_size:int=3,sigma:float=1,border_type:KnBorderType=KnBorderType.reflect,separable:bool=True,all_selected:bool=False,in_place:bool=False,backend:Backend=Backend.auto,roi:Layer=None):
     """Implementation of Kornia's gausian blur filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -280,17 +447,25 @@ def filter_gaussian_blur_plg(img:Image,kernel_size:int=3,sigma:float=1,border_ty
         sigma (int): standard deviation of the kernel
         border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
         separable (bool): run as composition of 2 1D convolutions
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (Backend): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has gaussian blur  with '_GB_(kernel_size)' suffix added to name.
     """
 
-    filter_gaussian_blur_thread(img=img,kernel_size=kernel_size,sigma=sigma,border_type=border_type.value,separable=separable)
+    if all_selected:
+        apply_to_selected(filter_gaussian_blur_gen,"Gaussian Blur Filter",kernel_size=kernel_size,sigma=sigma,border_type=border_type.value,separable=separable,in_place=in_place,backend=backend.value,roi=roi)
+        return
+    worker = filter_gaussian_blur_thread(img=img,kernel_size=kernel_size,sigma=sigma,border_type=border_type.value,separable=separable,in_place=in_place,backend=backend.value,roi=roi)
+    stream_to_viewer(worker,"Gaussian Blur Filter")
 
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def filter_gaussian_blur_thread(img:Image,kernel_size:int=3,sigma:float=1,border_type:str='reflect',separable:bool=True)->Image:
+@thread_worker(progress=True)
+def filter_gaussian_blur_thread(img:Image,kernel_size:int=3,sigma:float=1,border_type:str='reflect',separable:bool=True,in_place:bool=False,backend:str='auto',roi:Layer=None)->Image:
     """Implementation of Kornia's gausian blur filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -298,12 +473,43 @@ def filter_gaussian_blur_thread(img:Image,kernel_size:int=3,sigma:float=1,border
         sigma (int): standard deviation of the kernel
         border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
         separable (bool): run as composition of 2 1D convolutions
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Image Layer that has gaussian blur  with '_GB_(kernel_size)' suffix added to name.
     """
     show_info(f'Gaussian Blur Filter thread has started')
+    output = yield from filter_gaussian_blur_gen(img=img,kernel_size=kernel_size,sigma=sigma,border_type=border_type,separable=separable,in_place=in_place,backend=backend,roi=roi)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info(f'Gaussian Blur Filter thread has completed')
+
+    return output
+
+@profiled("Gaussian Blur")
+@roi_restricted(lambda args: args["kernel_size"] // 2,"Gaussian Blur")
+@cached("gaussian_blur")
+@scheduled("torch","Gaussian Blur")
+@incremental("gaussian_blur")
+def filter_gaussian_blur_gen(img:Image,kernel_size:int=3,sigma:float=1,border_type:str='reflect',separable:bool=True,in_place:bool=False,backend:str='auto'):
+    """Implementation of Kornia's gausian blur filter function
+    Args:
+        img (Image): Image/Volume to be segmented.
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        sigma (int): standard deviation of the kernel
+        border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
+        separable (bool): run as composition of 2 1D convolutions
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
 
+    Returns:
+        Image Layer that has gaussian blur  with '_GB_(kernel_size)' suffix added to name.
+    """
     name = img.name
 
     # optional kwargs for viewer.add_* method
@@ -311,18 +517,22 @@ def filter_gaussian_blur_thread(img:Image,kernel_size:int=3,sigma:float=1,border
 
     # optional layer type argument
     layer_type = "image"
-    data = img.data.copy()
-    out_data = filter_gaussian_blur_kn(data=data,kernel_size=kernel_size,sigma=sigma,border_type=border_type,separable=separable)
-    output = Layer.create(out_data,add_kwargs,layer_type)
+    data = img.data
+    if in_place and can_process_in_place(data,data.dtype,"Gaussian Blur"):
+        out_data, output = data, img
+    else:
+        out_data = np.empty_like(data)
+        with stage("layer"):
+            output = Layer.create(out_data,add_kwargs,layer_type)
+    yield output
 
-    torch.cuda.empty_cache()
-    memory_stats()
-    show_info(f'Gaussian Blur Filter thread has completed')
+    for _ in iter_gaussian_blur_kn(data=data,out=out_data,kernel_size=kernel_size,sigma=sigma,border_type=border_type,separable=separable,channel_axis=channel_axis_of(img),backend=backend):
+        yield output
 
     return output
 
 
-def filter_gaussian_blur_kn(data:ndarray,kernel_size:int=3,sigma:float=1.0,border_type:str='reflect',separable:bool=True)-> ndarray:
+def filter_gaussian_blur_kn(data:ndarray,kernel_size:int=3,sigma:float=1.0,border_type:str='reflect',separable:bool=True,channel_axis:int=None,backend:str='auto')-> ndarray:
     """Implementation of Kornia's gausian blur filter function
     Args:
         img (Image): Image/Volume to be segmented.
@@ -330,45 +540,47 @@ def filter_gaussian_blur_kn(data:ndarray,kernel_size:int=3,sigma:float=1.0,borde
         sigma (float): standard deviation of the kernel
         border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
         separable (bool): run as composition of 2 1D convolutions
+        channel_axis (int or None): axis of data holding color channels, every channel is filtered separately
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
         
     Returns:
         Image Layer that has gaussian blur  with '_GB_(kernel_size)' suffix added to name.
     """
-    from kornia.filters import gaussian_blur2d
-    
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
-
-        pt_data = torch.tensor(data,device=device)
-
-        if data.ndim == 2:
-            in_data = pt_data.unsqueeze(0).unsqueeze(0)
-            blur_data = gaussian_blur2d(in_data,(kernel_size,kernel_size),(sigma,sigma),border_type,separable).squeeze()
-            out_data = blur_data.detach().cpu().numpy()
-            
-        elif data.ndim == 3:
-            for i in tqdm(range(len(pt_data)),desc="Gaussian Blur Filter"):
-                in_data = pt_data[i].unsqueeze(0).unsqueeze(0)
-                pt_data[i] = gaussian_blur2d(in_data,(kernel_size,kernel_size),(sigma,sigma),border_type,separable).squeeze()
-
-            out_data = pt_data.detach().cpu().numpy()
+        out_data = np.empty_like(data)
+        for _ in iter_gaussian_blur_kn(data=data,out=out_data,kernel_size=kernel_size,sigma=sigma,border_type=border_type,separable=separable,channel_axis=channel_axis,backend=backend):
+            pass
 
         return out_data
-        
 
-        '''''
-        name = img.name
+def iter_gaussian_blur_kn(data:ndarray,out:ndarray,kernel_size:int=3,sigma:float=1.0,border_type:str='reflect',separable:bool=True,channel_axis:int=None,backend:str='auto'):
+    """Streaming implementation of Kornia's gausian blur filter function
+    Args:
+        data (ndarray): Image/Volume to be blurred.
+        out (ndarray): array with the same shape as data the result is written to
+        kernel_size (int): Dimension of symmetrical kernel for Kornia implementation kernel should be odd number
+        sigma (float): standard deviation of the kernel
+        border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
+        separable (bool): run as composition of 2 1D convolutions
+        channel_axis (int or None): axis of data holding color channels, every channel is filtered separately
+        backend (str): 'torch' for direct convolution, 'fft' for convolution in the frequency domain or 'auto' for the faster one
 
-        # optional kwargs for viewer.add_* method
-        add_kwargs = {"name": f"{name}_Med_{kernel_size}"}
+    Yields:
+        (start, stop) range of slices that have been written to out.
+    """
+    def gaussian_batch(batch):
+        return gaussian_blur_batch(batch,kernel_size,sigma,border_type,separable)
 
-        # optional layer type argument
-        layer_type = "image"
+    def fft_batch(batch):
+        return fft_gaussian_blur_batch(batch,kernel_size,sigma,border_type)
 
-        data = img.data.copy()
+    batch_funcs = {"torch": gaussian_batch,"fft": fft_batch}
+    candidates = {name: torch_candidate(func) for name, func in batch_funcs.items()}
+    backend = select_backend("gaussian_blur",data,candidates,{"kernel_size": kernel_size},backend,channel_axis)
+    gaussian_batch = batch_funcs[backend]
 
-        layer = Layer.create(out_data,add_kwargs,layer_type)
-        '''
\ No newline at end of file
+    yield from iter_chunks(data,gaussian_batch,"gaussian_blur",out,kernel_size=kernel_size,halo=kernel_size//2,desc="Gaussian Blur Filter",channel_axis=channel_axis)
@@ -0,0 +1,135 @@
+"""
+This module contains code for recomputing only the slices of a volume whose input changed since the last run
+"""
+import inspect
+import threading
+import weakref
+from contextlib import contextmanager
+from functools import wraps
+
+from napari.layers import Image
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import viewer
+
+from napari_cool_tools_img_proc._axes import BatchView, channel_axis_of
+from napari_cool_tools_img_proc._cache import content_hash, make_key
+from napari_cool_tools_img_proc._profiling import stage
+from napari_cool_tools_img_proc._streaming import run_generator
+
+# input layer -> {operation key: _LastRun}, entries disappear together with their input layer
+_runs = weakref.WeakKeyDictionary()
+
+_local = threading.local()
+
+class _LastRun:
+    """Per slice input fingerprints of the last run of an operation and the output layer it produced."""
+
+    def __init__(self,hashes:list,out):
+        self.hashes = hashes
+        self.out = weakref.ref(out)
+
+def slice_hashes(data)->list:
+    """Content hash of every slice along axis 0 of a volume or BatchView."""
+    return [content_hash(data[i]) for i in range(len(data))]
+
+def dirty_ranges(dirty:list,halo:int,n_slices:int)->list:
+    """Merge changed slice indices, grown by halo slices on each side, into (start, stop) ranges.
+
+    Args:
+        dirty (list): sorted indices of slices whose input changed
+        halo (int): slices on each side whose output depends on a changed slice
+        n_slices (int): number of slices of the volume
+
+    Returns:
+        List of non overlapping (start, stop) ranges of output slices to recompute.
+    """
+    ranges = []
+    for i in dirty:
+        start, stop = max(i - halo,0), min(i + halo + 1,n_slices)
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0],max(ranges[-1][1],stop))
+        else:
+            ranges.append((start,stop))
+    return ranges
+
+def forget_runs(img=None):
+    """Discard recorded fingerprints for one input layer or for all layers if img is None."""
+    if img is None:
+        _runs.clear()
+    else:
+        _runs.pop(img,None)
+
+@contextmanager
+def untracked():
+    """Start operations on the calling thread inside the block without hashing their input or recording their runs,
+    for temporary inputs such as the regions processed by roi_restricted."""
+    previous = getattr(_local,"untracked",False)
+    _local.untracked = True
+    try:
+        yield
+    finally:
+        _local.untracked = previous
+
+def incremental(op:str,halo:int=0):
+    """Decorator recomputing only changed slices for a streaming operation generator whose first argument is the input Image layer.
+
+    Per slice fingerprints of the input are recorded after every run. When the operation is run again with the same
+    parameters on the same layer and the output layer of the last run is still in the viewer, only slices whose
+    fingerprint changed (plus halo neighbouring slices) are recomputed and written into that layer in place.
+    Data with more than one leading axis is treated as a flat stack of slices, halo only applies to 3D volumes.
+    Layers with a channel axis, operations run in place and operations started inside untracked() are always
+    recomputed completely.
+    Only suitable for operations whose output slices depend on nothing but the input slices within halo, operations
+    using statistics of the whole volume (e.g. normalization to its range) must not be decorated.
+
+    Args:
+        op (str): operation name used to key the recorded runs
+        halo (int): slices along axis 0 on each side that contribute to an output slice, 0 for 2D operations
+    """
+    def decorator(gen_func):
+        signature = inspect.signature(gen_func)
+
+        @wraps(gen_func)
+        def wrapper(*args,**kwargs):
+            bound = signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            img = params.pop("img")
+            data = img.data
+            if (getattr(_local,"untracked",False) or data.ndim < 3 or (halo and data.ndim > 3) or params.get("in_place")
+                    or params.get("channel_axis") is not None or channel_axis_of(img) is not None):
+                return (yield from gen_func(*args,**kwargs))
+            stack = BatchView(data)
+
+            key = make_key(op,"",params)
+            with stage("hash",nbytes=data.nbytes):
+                hashes = slice_hashes(stack)
+
+            runs = _runs.setdefault(img,{})
+            last = runs.get(key)
+            out = last.out() if last is not None else None
+            if (out is None or out not in viewer.layers or out.data.shape != data.shape
+                    or len(last.hashes) != len(hashes)):
+                layer = yield from gen_func(*args,**kwargs)
+                if layer is not None:
+                    runs[key] = _LastRun(hashes,layer)
+                return layer
+
+            dirty = [i for i, (old, new) in enumerate(zip(last.hashes,hashes)) if old != new]
+            show_info(f"{op}: recomputing {len(dirty)} of {len(hashes)} slices whose input changed")
+            yield out
+
+            n_slices = len(hashes)
+            out_stack = BatchView(out.data)
+            for start, stop in dirty_ranges(dirty,halo,n_slices):
+                read_start, read_stop = max(start - halo,0), min(stop + halo,n_slices)
+                bound.arguments["img"] = Image(stack[read_start:read_stop],name=img.name)
+                sub_layer = run_generator(gen_func(*bound.args,**bound.kwargs))
+                with stage("copy",nbytes=sub_layer.data[start - read_start:stop - read_start].nbytes):
+                    out_stack[start:stop] = sub_layer.data[start - read_start:stop - read_start]
+                yield out
+
+            runs[key] = _LastRun(hashes,out)
+            return out
+        return wrapper
+    return decorator
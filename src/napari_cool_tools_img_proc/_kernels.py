@@ -0,0 +1,250 @@
+"""
+This module contains code for building filter kernels once and sharing them across calls, slices, tiles and backends
+"""
+import threading
+from collections import OrderedDict
+
+from napari_cool_tools_io import device, torch
+from scipy.fft import next_fast_len
+from torch.nn import functional as F
+
+# number of kernels kept before the least recently used one is evicted
+KERNEL_CACHE_SIZE = 128
+
+class KernelRegistry:
+    """Least recently used store of filter kernels keyed by kind, size, sigma, dtype and device.
+
+    Kernels are read only, callers convolve with them directly and must not modify them in place.
+
+    Args:
+        max_entries (int): number of kernels kept before the least recently used one is evicted
+    """
+
+    def __init__(self,max_entries:int=KERNEL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._kernels = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self,key:tuple,build):
+        """Kernel stored under key, built by calling build() on a miss."""
+        with self._lock:
+            kernel = self._kernels.get(key)
+            if kernel is not None:
+                self._kernels.move_to_end(key)
+                self.hits += 1
+                return kernel
+            self.misses += 1
+
+        kernel = build()
+        with self._lock:
+            self._kernels[key] = kernel
+            self._kernels.move_to_end(key)
+        self._evict()
+        return kernel
+
+    def clear(self):
+        """Remove all kernels and reset statistics."""
+        with self._lock:
+            self._kernels.clear()
+            self.hits = self.misses = 0
+
+    def stats(self)->dict:
+        """Hit/miss counts, hit rate and number of stored kernels."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "entries": len(self._kernels),
+            }
+
+    def _evict(self):
+        with self._lock:
+            while len(self._kernels) > self.max_entries:
+                self._kernels.popitem(last=False)
+
+_registry = KernelRegistry()
+
+def configure_kernel_cache(max_entries:int=None,clear:bool=False):
+    """Configure the shared kernel registry.
+
+    Args:
+        max_entries (int or None): number of kernels kept before the least recently used one is evicted
+        clear (bool): remove all stored kernels
+    """
+    if max_entries is not None:
+        _registry.max_entries = max_entries
+        _registry._evict()
+    if clear:
+        _registry.clear()
+
+def kernel_cache_stats()->dict:
+    """Statistics of the shared kernel registry."""
+    return _registry.stats()
+
+def _as_tuple(value,ndim:int)->tuple:
+    return tuple(value) if isinstance(value,(tuple,list)) else (value,) * ndim
+
+def torchvision_sigma(kernel_size:int)->float:
+    """Sigma torchvision gaussian_blur derives from the kernel size when none is given."""
+    return 0.3 * ((kernel_size - 1) * 0.5 - 1) + 0.8
+
+def truncate_size(sigma:float,truncate:float=4.0)->int:
+    """Kernel size with radius round(truncate * sigma) like scipy.ndimage.gaussian_filter."""
+    return 2 * max(int(truncate * sigma + 0.5),1) + 1
+
+def gaussian_kernel1d(kernel_size:int,sigma:float,dtype=torch.float32,device=device)->torch.Tensor:
+    """Normalized 1D gaussian kernel sampled at integer offsets from the center, as built by kornia and torchvision.
+
+    Args:
+        kernel_size (int): number of taps
+        sigma (float): standard deviation in pixels
+        dtype (torch.dtype): dtype of the kernel
+        device (torch.device): device holding the kernel
+
+    Returns:
+        (kernel_size,) tensor shared by every caller asking for the same kernel.
+    """
+    kernel_size, sigma = int(kernel_size), float(sigma)
+
+    def build():
+        x = torch.arange(kernel_size,dtype=torch.float64,device=device) - (kernel_size - 1) / 2
+        kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+        return (kernel / kernel.sum()).to(dtype)
+
+    return _registry.get(("gaussian",kernel_size,sigma,dtype,str(device)),build)
+
+def gaussian_kernel(kernel_size,sigma,ndim:int=2,dtype=torch.float32,device=device)->torch.Tensor:
+    """Normalized 1D, 2D or 3D gaussian kernel, the outer product of 1D kernels along every axis.
+
+    Args:
+        kernel_size (int or tuple): number of taps per axis
+        sigma (float or tuple): standard deviation in pixels per axis
+        ndim (int): number of axes of the kernel
+        dtype (torch.dtype): dtype of the kernel
+        device (torch.device): device holding the kernel
+
+    Returns:
+        Tensor of shape kernel_size shared by every caller asking for the same kernel.
+    """
+    sizes = tuple(int(k) for k in _as_tuple(kernel_size,ndim))
+    sigmas = tuple(float(s) for s in _as_tuple(sigma,ndim))
+    assert len(sizes) == len(sigmas) == ndim, "kernel_size and sigma need one entry per axis"
+    if ndim == 1:
+        return gaussian_kernel1d(sizes[0],sigmas[0],dtype,device)
+
+    def build():
+        kernel = gaussian_kernel1d(sizes[0],sigmas[0],torch.float64,device)
+        for size, s in zip(sizes[1:],sigmas[1:]):
+            kernel = kernel.unsqueeze(-1) * gaussian_kernel1d(size,s,torch.float64,device)
+        return kernel.to(dtype)
+
+    return _registry.get(("gaussian",sizes,sigmas,dtype,str(device)),build)
+
+def pad_same(batch,kernel_shape:tuple,border_type:str='reflect'):
+    """Pad the trailing axes of batch so a convolution with a kernel of kernel_shape keeps their size."""
+    pad = []
+    for k in reversed(kernel_shape):
+        pad += [(k - 1) // 2,k // 2]
+    return F.pad(batch,pad,mode=border_type)
+
+def gaussian_blur_batch(batch,kernel_size,sigma,border_type:str='reflect',separable:bool=True):
+    """Gaussian blur of every slice of a (B,H,W) tensor with registry kernels, matches kornia gaussian_blur2d.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        kernel_size (int or tuple): kernel size per axis (rows, columns)
+        sigma (float or tuple): standard deviation per axis (rows, columns)
+        border_type (str): padding mode applied prior to convolution 'constant', 'reflect', 'replicate' or 'circular'
+        separable (bool): run as composition of 2 1D convolutions
+
+    Returns:
+        (B,H,W) blurred tensor.
+    """
+    size_y, size_x = _as_tuple(kernel_size,2)
+    sigma_y, sigma_x = _as_tuple(sigma,2)
+    padded = pad_same(batch.unsqueeze(1),(size_y,size_x),border_type)
+    if separable:
+        kernel_x = gaussian_kernel1d(size_x,sigma_x,batch.dtype,batch.device)
+        kernel_y = gaussian_kernel1d(size_y,sigma_y,batch.dtype,batch.device)
+        blurred = F.conv2d(padded,kernel_x.view(1,1,1,-1))
+        return F.conv2d(blurred,kernel_y.view(1,1,-1,1)).squeeze(1)
+
+    kernel = gaussian_kernel((size_y,size_x),(sigma_y,sigma_x),2,batch.dtype,batch.device)
+    return F.conv2d(padded,kernel[None,None]).squeeze(1)
+
+def gaussian_spectrum(kernel_size,sigma,shape:tuple,dtype=torch.float32,device=device)->torch.Tensor:
+    """rfft2 of a 2D gaussian kernel zero padded to shape, the kernel's first tap at the origin."""
+    sizes = tuple(int(k) for k in _as_tuple(kernel_size,2))
+    sigmas = tuple(float(s) for s in _as_tuple(sigma,2))
+    shape = tuple(int(n) for n in shape)
+
+    def build():
+        kernel = gaussian_kernel(sizes,sigmas,2,dtype,device)
+        return torch.fft.rfft2(kernel,s=shape)
+
+    return _registry.get(("gaussian_fft",sizes,sigmas,shape,dtype,str(device)),build)
+
+def fft_gaussian_blur_batch(batch,kernel_size,sigma,border_type:str='reflect'):
+    """Gaussian blur of every slice of a (B,H,W) tensor as a product of spectra, same result as gaussian_blur_batch.
+
+    The cost does not depend on the kernel size, which makes it faster than direct convolution for large kernels.
+    Padded slices are zero padded further to a size with small prime factors, the valid part of the circular
+    convolution equals the linear one.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        kernel_size (int or tuple): kernel size per axis (rows, columns), odd
+        sigma (float or tuple): standard deviation per axis (rows, columns)
+        border_type (str): padding mode applied prior to convolution 'constant', 'reflect', 'replicate' or 'circular'
+
+    Returns:
+        (B,H,W) blurred tensor.
+    """
+    size_y, size_x = _as_tuple(kernel_size,2)
+    height, width = batch.shape[-2:]
+    padded = pad_same(batch.unsqueeze(1),(size_y,size_x),border_type).squeeze(1)
+    shape = (next_fast_len(padded.shape[-2],real=True),next_fast_len(padded.shape[-1],real=True))
+    spectrum = gaussian_spectrum((size_y,size_x),sigma,shape,batch.dtype,batch.device)
+    blurred = torch.fft.irfft2(torch.fft.rfft2(padded,s=shape) * spectrum,s=shape)
+    return blurred[...,size_y - 1:size_y - 1 + height,size_x - 1:size_x - 1 + width]
+
+def box_filter_batch(batch,window,border_type:str='reflect'):
+    """Mean over a window of every pixel of a (B,H,W) tensor from a summed-area table.
+
+    Every window sum is 4 lookups into the integral image, so the cost per pixel does not depend on the window size.
+    On the CPU the table is accumulated in float64 to keep sums of large windows exact enough for variances. Float64
+    is slow on most GPUs, there the table is accumulated in float32 from the values minus the mean of their slice,
+    which keeps its entries small.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        window (int or tuple): window size per axis (rows, columns), odd
+        border_type (str or None): padding mode applied prior to filtering 'constant', 'reflect', 'replicate' or
+                                   'circular', reflect falls back to replicate for windows larger than the slices,
+                                   None returns the means of the windows inside the slices only
+
+    Returns:
+        (B,H,W) tensor of window means with the dtype of batch, (B,H - rows + 1,W - columns + 1) if border_type is None.
+    """
+    size_y, size_x = (int(k) for k in _as_tuple(window,2))
+    height, width = batch.shape[-2:]
+    if border_type is None:
+        padded = batch
+        height, width = height - size_y + 1, width - size_x + 1
+    else:
+        if border_type == 'reflect' and (size_y // 2 >= height or size_x // 2 >= width):
+            border_type = 'replicate'
+        padded = pad_same(batch.unsqueeze(1),(size_y,size_x),border_type).squeeze(1)
+    if padded.device.type == 'cpu':
+        offset = 0.0
+        table = F.pad(padded.double().cumsum(-2).cumsum(-1),(1,0,1,0))
+    else:
+        offset = padded.float().mean(dim=(-2,-1),keepdim=True)
+        table = F.pad((padded.float() - offset).cumsum(-2).cumsum(-1),(1,0,1,0))
+    sums = (table[...,size_y:size_y + height,size_x:size_x + width] - table[...,:height,size_x:size_x + width]
+            - table[...,size_y:size_y + height,:width] + table[...,:height,:width])
+    return (sums / (size_y * size_x) + offset).to(batch.dtype)
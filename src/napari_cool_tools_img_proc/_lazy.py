@@ -0,0 +1,268 @@
+"""
+This module contains code for computing the slices of a result layer on demand, displayed slices first
+"""
+import threading
+
+import numpy as np
+from napari.layers import Layer
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import device, torch
+from numpy import ndarray
+from tqdm import tqdm
+
+from napari_cool_tools_img_proc._axes import (
+    SPATIAL_DIMS,
+    BatchView,
+    channel_axis_of,
+)
+from napari_cool_tools_img_proc._profiling import stage
+from napari_cool_tools_img_proc._scheduler import job_slot
+
+# states of the slices of a LazySliceArray
+MISSING, COMPUTING, DONE = 0, 1, 2
+
+class LazySliceArray:
+    """Array like result of a 2D operation whose slices are computed when they are first read and kept afterwards.
+
+    Slices are computed by the background fill run by iter_fill, which runs inside the scheduler slot of its
+    operation. Reads (the viewer slicing the displayed step) hand the slices they touch to the fill, which computes
+    them next, and wait for them, then the fill continues with the missing slice closest to the last one read, so
+    scrolling stays responsive and the neighbours of the displayed slice are ready first. Once no fill is running,
+    e.g. after it was cancelled, reads never compute on the reading (viewer) thread, missing slices read as zeros.
+    Only converting the whole array with np.asarray computes the missing slices, holding a slot of backend. Every
+    slice is computed once, a read of a slice being computed waits for it.
+
+    Args:
+        data (ndarray): input with any number of leading batch axes and no channel axis
+        slice_func (callable): function mapping a 2D ndarray to a 2D ndarray of the same shape
+        dtype (np.dtype): dtype of the results
+        desc (str): description of the operation used for scheduler jobs
+        backend (str): backend slice_func runs on, 'torch' or 'skimage'
+    """
+
+    def __init__(self,data,slice_func,dtype,desc:str="",backend:str="torch"):
+        self.data = data
+        self.slice_func = slice_func
+        self.desc = desc
+        self.backend = backend
+        self.shape = tuple(data.shape)
+        self.dtype = np.dtype(dtype)
+        self.ndim = len(self.shape)
+        self.out = np.zeros(self.shape,dtype=self.dtype)
+        self._stack = BatchView(data)
+        self._out_stack = BatchView(self.out)
+        self._state = np.full(len(self._stack),MISSING,dtype=np.uint8)
+        self._done = 0
+        self._wanted = []
+        self._focus = 0
+        self._filler = None
+        self._stopped_info = False
+        self._cond = threading.Condition()
+
+    @property
+    def size(self)->int:
+        return self.out.size
+
+    @property
+    def nbytes(self)->int:
+        return self.out.nbytes
+
+    @property
+    def complete(self)->bool:
+        """True once every slice has been computed."""
+        return self._done == len(self._state)
+
+    def __len__(self)->int:
+        return self.shape[0]
+
+    def __getitem__(self,key)->ndarray:
+        if not self.complete:
+            self._read(self._slice_indices(key))
+        return self.out[key]
+
+    def __array__(self,dtype=None,copy=None)->ndarray:
+        if not self.complete:
+            self._read(np.arange(len(self._state)),compute=True)
+        return self.out if dtype is None else self.out.astype(dtype)
+
+    def _slice_indices(self,key)->ndarray:
+        """Indices into the flattened stack of the slices a read with key touches."""
+        key = key if isinstance(key,tuple) else (key,)
+        n_batch = self.ndim - SPATIAL_DIMS
+        if any(k is None or (isinstance(k,ndarray) and k.dtype == bool) for k in key):
+            return np.arange(len(self._state))
+        for n, k in enumerate(key):
+            if k is Ellipsis:
+                key = key[:n] + (slice(None),) * (self.ndim - len(key) + 1) + key[n + 1:]
+                break
+        batch_key = tuple(key[:n_batch]) + (slice(None),) * max(n_batch - len(key),0)
+        return np.unique(np.arange(len(self._state)).reshape(self._stack.batch_shape)[batch_key])
+
+    def _read(self,indices:ndarray,compute:bool=False):
+        """Make sure slices are computed before they are read.
+
+        Args:
+            indices (ndarray): indices into the flattened stack of the slices read
+            compute (bool): compute missing slices on the calling thread once no fill is running instead of reading
+                            them as zeros
+        """
+        indices = [int(i) for i in indices]
+        with self._cond:
+            if indices:
+                self._focus = indices[0]
+            if self._filler is not None and self._filler != threading.get_ident():
+                self._wanted.extend(i for i in indices if self._state[i] == MISSING)
+                self._cond.notify_all()
+                while self._filler is not None and any(self._state[i] != DONE for i in indices):
+                    self._cond.wait()
+                if all(self._state[i] == DONE for i in indices):
+                    return
+            if self._filler is None and not compute:
+                # the fill stopped early, waiting for a scheduler slot here would freeze the viewer
+                if not self._stopped_info:
+                    self._stopped_info = True
+                    show_info(f"{self.desc}: computation stopped, slices that were not computed are shown empty")
+                return
+
+        # the fill itself reads, or the whole array is converted after the fill stopped
+        with job_slot(f"{self.desc} (remaining slices)",self.backend) as granted:
+            if not granted:
+                return
+            for i in indices:
+                with self._cond:
+                    while self._state[i] == COMPUTING:
+                        self._cond.wait()
+                    if self._state[i] == DONE:
+                        continue
+                    self._state[i] = COMPUTING
+                self._compute(i)
+
+    def _compute(self,i:int):
+        """Compute slice i, which the caller has marked as COMPUTING."""
+        try:
+            with stage("compute",slices=1):
+                self._out_stack[i] = self.slice_func(self._stack[i])
+        except BaseException:
+            with self._cond:
+                self._state[i] = MISSING
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._state[i] = DONE
+            self._done += 1
+            self._cond.notify_all()
+
+    def _claim_next(self)->int:
+        """Oldest missing slice a read waits for or else the missing slice closest to the last read, marked as
+        COMPUTING, None once every slice is done."""
+        with self._cond:
+            while True:
+                if self.complete:
+                    return None
+                while self._wanted:
+                    i = self._wanted.pop(0)
+                    if self._state[i] == MISSING:
+                        self._state[i] = COMPUTING
+                        return i
+                missing = np.flatnonzero(self._state == MISSING)
+                if len(missing):
+                    i = int(missing[np.argmin(np.abs(missing - self._focus))])
+                    self._state[i] = COMPUTING
+                    return i
+                self._cond.wait()
+
+    def claim_fill(self):
+        """Make the calling thread the fill, reads wait for it to compute their slices until release_fill."""
+        with self._cond:
+            self._filler = threading.get_ident()
+
+    def release_fill(self):
+        """Stop handing slices to the fill, reads of missing slices return zeros from now on."""
+        with self._cond:
+            self._filler = None
+            self._cond.notify_all()
+
+    def iter_fill(self,desc:str=""):
+        """Compute every slice on the calling thread, the slices reads wait for first.
+
+        Args:
+            desc (str): description used for progress messages
+
+        Yields:
+            (start, stop) range of the flattened stack computed by the fill.
+        """
+        self.claim_fill()
+        try:
+            with tqdm(total=len(self._state),desc=desc) as progress:
+                while True:
+                    i = self._claim_next()
+                    if i is None:
+                        break
+                    self._compute(i)
+                    progress.update(self._done - progress.n)
+                    yield i, i + 1
+        finally:
+            self.release_fill()
+
+def can_display_lazily(img,in_place:bool=False,desc:str="")->bool:
+    """Check whether the result of an operation on img can be a layer computed on demand.
+
+    Args:
+        img (Image): input layer
+        in_place (bool): whether the operation was requested in place
+        desc (str): description used in the message shown when the whole result has to be computed first instead
+
+    Returns:
+        True for grayscale layers of at least 3 dimensions processed into a new layer.
+    """
+    if img.data.ndim > SPATIAL_DIMS and channel_axis_of(img) is None and not in_place:
+        return True
+    show_info(f"{desc}: on demand slices need a new layer from grayscale data of at least 3 dimensions, computing the whole result instead")
+    return False
+
+def torch_slice_func(batch_func):
+    """2D ndarray function running a function of (B,H,W) tensors on a single slice."""
+    def run(image):
+        batch = torch.as_tensor(np.asarray(image)[None],device=device)
+        if not torch.is_floating_point(batch):
+            batch = batch.float()
+        return batch_func(batch)[0].detach().cpu().numpy()
+    return run
+
+def lazy_result_gen(img,slice_func,name:str,dtype,desc:str="",contrast_limits:tuple=None,backend:str="torch"):
+    """Streaming result layer of a 2D operation whose slices are computed when displayed and in the background.
+
+    Args:
+        img (Image): input layer, grayscale with at least 3 dimensions
+        slice_func (callable): function mapping a 2D ndarray to a 2D ndarray of the same shape
+        name (str): name of the output layer
+        dtype (np.dtype): dtype of the results
+        desc (str): description used for progress messages
+        contrast_limits (tuple or None): contrast limits of the output layer, None lets napari estimate them from
+                                         a few slices which computes those slices first
+        backend (str): backend slice_func runs on, 'torch' or 'skimage'
+
+    Yields:
+        Output layer holding a LazySliceArray, first right after it is created and again after every slice the
+        background fill computes.
+
+    Returns:
+        Output layer once every slice has been computed.
+    """
+    lazy = LazySliceArray(img.data,slice_func,dtype,desc,backend)
+    # slices displayed before the fill starts are computed by it as well, inside the slot this operation holds
+    lazy.claim_fill()
+    try:
+        add_kwargs = {"name": name}
+        if contrast_limits is not None and contrast_limits[0] < contrast_limits[1]:
+            add_kwargs["contrast_limits"] = contrast_limits
+        with stage("layer"):
+            layer = Layer.create(lazy,add_kwargs,"image")
+        yield layer
+
+        for _ in lazy.iter_fill(desc):
+            yield layer
+    finally:
+        lazy.release_fill()
+
+    return layer
@@ -1,61 +1,108 @@
 """
 This module contains code for adjusting image luminance
 """
-
+import numpy as np
 from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.qt.threading import thread_worker
-from napari_cool_tools_io import torch,viewer,device,memory_stats
+from napari_cool_tools_io import torch,memory_stats
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
+from napari_cool_tools_img_proc._incremental import incremental
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._pointwise import PointwiseChain
+from napari_cool_tools_img_proc._pool import apply_to_selected
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._roi import roi_restricted
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._statistics import value_range
+from napari_cool_tools_img_proc._streaming import can_process_in_place, iter_slices, run_generator, stream_to_viewer
+
+def check_non_negative(image):
+    """Raise the error of skimage.exposure for images with negative values."""
+    if image.size and image.min() < 0:
+        raise ValueError("Image Correction methods work correctly only on images with non-negative values. Use skimage.exposure.rescale_intensity.")
 
-def adjust_gamma(img:Image, gamma:float=1, gain:float=1) -> Layer:
+def adjust_gamma(img:Image, gamma:float=1, gain:float=1,all_selected:bool=False,in_place:bool=False,roi:Layer=None) -> Layer:
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gamma(float): Non negative real number.
         gain (float): Constant multiplier.
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Gamma corrected output image with '_LC' suffix added to name."""
     
-    adjust_gamma_thread(img=img,gamma=gamma,gain=gain)
+    if all_selected:
+        apply_to_selected(adjust_gamma_gen,"Adjust gamma",gamma=gamma,gain=gain,in_place=in_place,roi=roi)
+        return
+    worker = adjust_gamma_thread(img=img,gamma=gamma,gain=gain,in_place=in_place,roi=roi)
+    stream_to_viewer(worker,"Adjust gamma")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def adjust_gamma_thread(img:Image, gamma:float=1, gain:float=1) -> Layer:
+@thread_worker(progress=True)
+def adjust_gamma_thread(img:Image, gamma:float=1, gain:float=1,in_place:bool=False,roi:Layer=None) -> Layer:
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gamma(float): Non negative real number.
         gain (float): Constant multiplier.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Gamma corrected output image with '_LC' suffix added to name."""
     
     show_info(f"Adjust gamma thread started")
-    output = adjust_gamma_func(img=img,gamma=gamma,gain=gain)
+    output = yield from adjust_gamma_gen(img=img,gamma=gamma,gain=gain,in_place=in_place,roi=roi)
     show_info(f"Adjust gamma thread completed")
     return output
 
-def adjust_gamma_func(img:Image, gamma:float=1, gain:float=1) -> Layer:
+def adjust_gamma_func(img:Image, gamma:float=1, gain:float=1,in_place:bool=False) -> Layer:
+    """Pass through function of skimage.exposure adjust_log function.
+    
+    Args:
+        img (Image): Image to be adjusted.
+        gamma(float): Non negative real number.
+        gain (float): Constant multiplier.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        
+    Returns:
+        Gamma corrected output image with '_LC' suffix added to name."""
+    return run_generator(adjust_gamma_gen(img=img,gamma=gamma,gain=gain,in_place=in_place))
+
+@profiled("Gamma Adjustment")
+@roi_restricted(0,"Gamma Adjustment")
+@cached("gamma")
+@scheduled("skimage","Gamma Adjustment")
+@incremental("gamma")
+def adjust_gamma_gen(img:Image, gamma:float=1, gain:float=1,in_place:bool=False):
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gamma(float): Non negative real number.
         gain (float): Constant multiplier.
+        in_place (bool): overwrite the data of img instead of creating a new layer
         
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
     Returns:
         Gamma corrected output image with '_LC' suffix added to name."""
     
     from skimage.exposure import adjust_gamma
-    from tqdm import tqdm
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert data.ndim == 2 or data.ndim == 3, "Only works for data of 2 or 3 diminsions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert gamma >= 0, "Gamma should be a non-negative real number."
     except AssertionError as e:
         print("An error Occured:", str(e))
     else:
@@ -64,16 +111,27 @@ def adjust_gamma_func(img:Image, gamma:float=1, gain:float=1) -> Layer:
         layer_type = "image"
         add_kwargs = {"name": f"{name}"}
 
-        if data.ndim == 2:
-            log_corrected = adjust_gamma(data,gamma=gamma,gain=gain)
-            layer = Layer.create(log_corrected,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(data)),desc="Gamma Correction"):
-                data[i] = adjust_gamma(data[i],gamma=gamma,gain=gain)
+        if in_place and can_process_in_place(data,data.dtype,"Gamma Correction"):
+            gamma_corrected, layer = data, img
+        else:
+            gamma_corrected = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(gamma_corrected,add_kwargs,layer_type)
+        yield layer
 
-            layer = Layer.create(data,add_kwargs,layer_type)
+        # float data is corrected in one fused pass, integer data keeps the lookup table of skimage
+        chain = PointwiseChain().gamma(gamma,gain)
 
-    return layer
+        def gamma_slice(image):
+            if not np.issubdtype(image.dtype,np.floating):
+                return adjust_gamma(image,gamma=gamma,gain=gain)
+            check_non_negative(image)
+            return chain.apply(image)
+
+        for _ in iter_slices(data,gamma_slice,gamma_corrected,desc="Gamma Correction"):
+            yield layer
+
+        return layer
     '''
     from skimage.exposure import adjust_gamma
 
@@ -90,62 +148,101 @@ def adjust_gamma_func(img:Image, gamma:float=1, gain:float=1) -> Layer:
     '''
     
 
-def adjust_log(img:Image, gain:float=1, inv:bool=False, pt_K:bool=True) -> Layer:
+def log_slice_func(gain:float=1, inv:bool=False):
+    """2D log correction used by adjust_log_gen, fused for float data and skimage.exposure.adjust_log otherwise."""
+    from skimage.exposure import adjust_log
+
+    chain = PointwiseChain().log(gain,inv)
+
+    def log_slice(image):
+        if not np.issubdtype(image.dtype,np.floating):
+            return adjust_log(image,gain=gain,inv=inv)
+        check_non_negative(image)
+        return chain.apply(image)
+    return log_slice
+
+def adjust_log(img:Image, gain:float=1, inv:bool=False, pt_K:bool=True,all_selected:bool=False,in_place:bool=False,roi:Layer=None) -> Layer:
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gain (float): Constant multiplier.
         inv (bool): If True performs inverse log correction instead of log correction.
-        gpu (bool): If True attempts to use pytorch gpu version of function
+        pt_K (bool): If True uses the pytorch implementation, which clips the result to range 0-1
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Logarithm corrected output image with '_LC' suffix added to name."""
     
-    adjust_log_thread(img=img,gain=gain,inv=inv,pt_K=pt_K)
+    if all_selected:
+        apply_to_selected(adjust_log_pt_gen if pt_K else adjust_log_gen,"Adjust log",gain=gain,inv=inv,in_place=in_place,roi=roi)
+        return
+    worker = adjust_log_thread(img=img,gain=gain,inv=inv,pt_K=pt_K,in_place=in_place,roi=roi)
+    stream_to_viewer(worker,"Adjust log")
     #return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def adjust_log_thread(img:Image, gain:float=1, inv:bool=False, pt_K:bool=True) -> Layer:
+@thread_worker(progress=True)
+def adjust_log_thread(img:Image, gain:float=1, inv:bool=False, pt_K:bool=True,in_place:bool=False,roi:Layer=None) -> Layer:
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gain (float): Constant multiplier.
         inv (bool): If True performs inverse log correction instead of log correction.
-        gpu (bool): If True attempts to use pytorch gpu version of function
+        pt_K (bool): If True uses the pytorch implementation, which clips the result to range 0-1
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
         
     Returns:
         Logarithm corrected output image with '_LC' suffix added to name."""
     
     show_info(f"Adjust log thread started")
-    if pt_K:
-        output = adjust_log_pt_func(img=img,gain=gain,inv=inv)
-        torch.cuda.empty_cache()
-        memory_stats()
-    else:
-        output = adjust_log_func(img=img,gain=gain,inv=inv)
+    gen_func = adjust_log_pt_gen if pt_K else adjust_log_gen
+    output = yield from gen_func(img=img,gain=gain,inv=inv,in_place=in_place,roi=roi)
+    torch.cuda.empty_cache()
+    memory_stats()
     show_info(f"Adjust log thread completed")
     return output
 
-def adjust_log_func(img:Image, gain:float=1, inv:bool=False) -> Layer:
+def adjust_log_func(img:Image, gain:float=1, inv:bool=False,in_place:bool=False) -> Layer:
     """Pass through function of skimage.exposure adjust_log function.
     
     Args:
         img (Image): Image to be adjusted.
         gain (float): constant multiplier.
         inv (bool): If True performs inverse log correction instead of log correction.
+        in_place (bool): overwrite the data of img instead of creating a new layer
         
     Returns:
         Logarithm corrected output image with '_LC' suffix added to name."""
+    return run_generator(adjust_log_gen(img=img,gain=gain,inv=inv,in_place=in_place))
+
+@profiled("Log Adjustment")
+@roi_restricted(0,"Log Adjustment")
+@cached("log")
+@scheduled("skimage","Log Adjustment")
+@incremental("log")
+def adjust_log_gen(img:Image, gain:float=1, inv:bool=False,in_place:bool=False):
+    """Pass through function of skimage.exposure adjust_log function.
     
-    from skimage.exposure import adjust_log
-    from tqdm import tqdm
+    Args:
+        img (Image): Image to be adjusted.
+        gain (float): constant multiplier.
+        inv (bool): If True performs inverse log correction instead of log correction.
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
 
-    data = img.data.copy()
+    Returns:
+        Logarithm corrected output image with '_LC' suffix added to name."""
+    
+    data = img.data
 
     try:
-        assert (data.ndim == 2 or data.ndim == 3), "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         raise Exception("An error Occured:", str(e))
     else:
@@ -154,18 +251,20 @@ def adjust_log_func(img:Image, gain:float=1, inv:bool=False) -> Layer:
         layer_type = "image"
         add_kwargs = {"name": f"{name}"}
 
-        if data.ndim == 2:
-            log_corrected = adjust_log(data,gain=gain,inv=inv)
-            layer = Layer.create(log_corrected,add_kwargs,layer_type)
-        elif data.ndim == 3:
-            for i in tqdm(range(len(data)),desc="Log Correction"):
-                data[i] = adjust_log(data[i],gain=gain,inv=inv)
+        if in_place and can_process_in_place(data,data.dtype,"Log Correction"):
+            log_corrected, layer = data, img
+        else:
+            log_corrected = np.empty_like(data)
+            with stage("layer"):
+                layer = Layer.create(log_corrected,add_kwargs,layer_type)
+        yield layer
 
-            layer = Layer.create(data,add_kwargs,layer_type)
+        for _ in iter_slices(data,log_slice_func(gain,inv),log_corrected,desc="Log Correction"):
+            yield layer
 
         return layer
 
-def adjust_log_pt_func(img:Image, gain:float=1, inv:bool=False, clip_output:bool=True) -> Layer:
+def adjust_log_pt_func(img:Image, gain:float=1, inv:bool=False, clip_output:bool=True,in_place:bool=False) -> Layer:
     """Pass through function of kornia.enhance adjust_log function.
     
     Args:
@@ -173,28 +272,166 @@ def adjust_log_pt_func(img:Image, gain:float=1, inv:bool=False, clip_output:bool
         gain (float): constant multiplier.
         inv (bool): If True performs inverse log correction instead of log correction.
         clip_output (bool, optional) – Whether to clip the output image with range of [0, 1]
+        in_place (bool): overwrite the data of img instead of creating a new layer
         
     Returns:
         Logarithm corrected output image with '_LC' suffix added to name."""
+    return run_generator(adjust_log_pt_gen(img=img,gain=gain,inv=inv,clip_output=clip_output,in_place=in_place))
+
+@profiled("Log Adjustment(PT)")
+@roi_restricted(0,"Log Adjustment(PT)")
+@cached("log_pt")
+@scheduled("torch","Log Adjustment(PT)")
+@incremental("log_pt")
+def adjust_log_pt_gen(img:Image, gain:float=1, inv:bool=False, clip_output:bool=True,in_place:bool=False):
+    """Pass through function of kornia.enhance adjust_log function.
     
-    from kornia.enhance import adjust_log
+    Args:
+        img (Image): Image to be adjusted.
+        gain (float): constant multiplier.
+        inv (bool): If True performs inverse log correction instead of log correction.
+        clip_output (bool, optional) – Whether to clip the output image with range of [0, 1]
+        in_place (bool): overwrite the data of img instead of creating a new layer
+        
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Logarithm corrected output image with '_LC' suffix added to name."""
     
     name = f"{img.name}_LC"
     layer_type = "image"
     add_kwargs = {"name": f"{name}"}
 
-    data = img.data.copy()
+    data = img.data
 
     try:
-        assert (data.ndim == 2 or data.ndim == 3), "Only works for data of 2 or 3 dimensions"
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
     except AssertionError as e:
         raise Exception("An error Occured:", str(e))
     else:
-        pt_data = torch.tensor(data,device=device)
+        log_batch = PointwiseChain().log(gain,inv)
+        if clip_output:
+            log_batch.clip(0.0,1.0)
+
+        out_dtype = np.result_type(data.dtype,np.float32)
+        if in_place and can_process_in_place(data,out_dtype,"Log Correction(PT)"):
+            out_data, layer = data, img
+        else:
+            out_data = np.empty(data.shape,dtype=out_dtype)
+            with stage("layer"):
+                layer = Layer.create(out_data,add_kwargs,layer_type)
+        yield layer
+
+        for _ in iter_chunks(data,log_batch,"log",out_data,halo=0,desc="Log Correction(PT)"):
+            yield layer
+
+        return layer
+
+def adjust_intensity(img:Image,normalize:bool=True,min_val:float=0.0,max_val:float=1.0,low_quantile:float=0.0,high_quantile:float=1.0,
+                     gamma:float=1.0,gamma_gain:float=1.0,log:bool=False,log_gain:float=1.0,inv:bool=False,all_selected:bool=False,in_place:bool=False) -> Layer:
+    """Normalization, gamma and log correction applied in a single fused pass over the data.
+
+    Args:
+        img (Image): Image to be adjusted.
+        normalize (bool): map values to range min_val-max_val first
+        min_val (float): minimum value of range that image values are to be mapped to
+        max_val (float): maximum value of range that image values are to be mapped to
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
+        gamma (float): Non negative real number, 1 skips gamma correction.
+        gamma_gain (float): Constant multiplier of gamma correction.
+        log (bool): apply log correction last
+        log_gain (float): Constant multiplier of log correction.
+        inv (bool): If True performs inverse log correction instead of log correction.
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
 
-        log_corrected = adjust_log(pt_data,gain=gain,inv=inv)
-        out_data = log_corrected.detach().cpu().numpy()
+    Returns:
+        Adjusted output image with '_IA' suffix added to name."""
 
-        layer = Layer.create(out_data,add_kwargs,layer_type)
+    if all_selected:
+        apply_to_selected(adjust_intensity_gen,"Adjust intensity",normalize=normalize,min_val=min_val,max_val=max_val,low_quantile=low_quantile,high_quantile=high_quantile,
+                          gamma=gamma,gamma_gain=gamma_gain,log=log,log_gain=log_gain,inv=inv,in_place=in_place)
+        return
+    worker = adjust_intensity_thread(img=img,normalize=normalize,min_val=min_val,max_val=max_val,low_quantile=low_quantile,high_quantile=high_quantile,
+                                     gamma=gamma,gamma_gain=gamma_gain,log=log,log_gain=log_gain,inv=inv,in_place=in_place)
+    stream_to_viewer(worker,"Adjust intensity")
+    return
+
+@thread_worker(progress=True)
+def adjust_intensity_thread(img:Image,normalize:bool=True,min_val:float=0.0,max_val:float=1.0,low_quantile:float=0.0,high_quantile:float=1.0,
+                            gamma:float=1.0,gamma_gain:float=1.0,log:bool=False,log_gain:float=1.0,inv:bool=False,in_place:bool=False) -> Layer:
+    ''''''
+    show_info("Adjust intensity thread started")
+    output = yield from adjust_intensity_gen(img=img,normalize=normalize,min_val=min_val,max_val=max_val,low_quantile=low_quantile,high_quantile=high_quantile,
+                                             gamma=gamma,gamma_gain=gamma_gain,log=log,log_gain=log_gain,inv=inv,in_place=in_place)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info("Adjust intensity thread completed")
+    return output
 
-        return layer
\ No newline at end of file
+def adjust_intensity_func(img:Image,normalize:bool=True,min_val:float=0.0,max_val:float=1.0,low_quantile:float=0.0,high_quantile:float=1.0,
+                          gamma:float=1.0,gamma_gain:float=1.0,log:bool=False,log_gain:float=1.0,inv:bool=False,in_place:bool=False) -> Layer:
+    """Non streaming version of adjust_intensity_gen"""
+    return run_generator(adjust_intensity_gen(img=img,normalize=normalize,min_val=min_val,max_val=max_val,low_quantile=low_quantile,high_quantile=high_quantile,
+                                              gamma=gamma,gamma_gain=gamma_gain,log=log,log_gain=log_gain,inv=inv,in_place=in_place))
+
+@profiled("Intensity Adjustment")
+@cached("intensity")
+@scheduled("torch","Intensity Adjustment")
+def adjust_intensity_gen(img:Image,normalize:bool=True,min_val:float=0.0,max_val:float=1.0,low_quantile:float=0.0,high_quantile:float=1.0,
+                         gamma:float=1.0,gamma_gain:float=1.0,log:bool=False,log_gain:float=1.0,inv:bool=False,in_place:bool=False):
+    """Normalization, gamma and log correction fused into one expression evaluated once per chunk.
+
+    Args:
+        img (Image): Image to be adjusted.
+        normalize (bool): map values to range min_val-max_val first
+        min_val (float): minimum value of range that image values are to be mapped to
+        max_val (float): maximum value of range that image values are to be mapped to
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
+        gamma (float): Non negative real number, 1 skips gamma correction.
+        gamma_gain (float): Constant multiplier of gamma correction.
+        log (bool): apply log correction last
+        log_gain (float): Constant multiplier of log correction.
+        inv (bool): If True performs inverse log correction instead of log correction.
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Adjusted output image with '_IA' suffix added to name."""
+
+    data = img.data
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert gamma >= 0, "Gamma should be a non-negative real number."
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        chain = PointwiseChain()
+        if normalize:
+            with stage("statistics",nbytes=data.nbytes):
+                data_min, data_max = value_range(data,low_quantile,high_quantile)
+            chain.normalize(data_min,data_max,min_val,max_val,clip=low_quantile > 0 or high_quantile < 1)
+        if gamma != 1 or gamma_gain != 1:
+            chain.gamma(gamma,gamma_gain)
+        if log:
+            chain.log(log_gain,inv)
+
+        out_dtype = np.result_type(data.dtype,np.float32)
+        if in_place and can_process_in_place(data,out_dtype,"Intensity Adjustment"):
+            out_data, layer = data, img
+        else:
+            out_data = np.empty(data.shape,dtype=out_dtype)
+            with stage("layer"):
+                layer = Layer.create(out_data,{"name": f"{img.name}_IA"},"image")
+        yield layer
+
+        for _ in iter_chunks(data,chain,"intensity",out_data,halo=0,desc="Intensity Adjustment",channel_axis=channel_axis_of(img)):
+            yield layer
+
+        return layer
@@ -0,0 +1,310 @@
+"""
+This module contains code for memory budget aware chunk scheduling
+"""
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import psutil
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import device, torch
+from numpy import ndarray
+from tqdm import tqdm
+
+from napari_cool_tools_img_proc._axes import BatchView, normalize_axis
+from napari_cool_tools_img_proc._prefetch import (
+    PrefetchExecutor,
+    prefetch_buffers,
+)
+from napari_cool_tools_img_proc._profiling import current_profile, stage
+
+# fraction of currently free memory that a single operation may use when no explicit budget is set
+BUDGET_FRACTION = 0.5
+
+# multiples of one (padded) float32 slice held at once by each operation: input, output and intermediates
+OP_FOOTPRINT = {
+    "gaussian_blur": 4,
+    "unsharp": 5,
+    "median": 3,
+    "bilateral": 4,
+    "clahe": 4,
+    "dog": 6,
+    "normalize": 3,
+    "normalize_local": 10,
+    "log": 3,
+    "gamma": 3,
+    "intensity": 2,
+    "denoise_tv": 6,
+    "nl_means": 12,
+}
+
+# operations that unfold a kernel_size x kernel_size neighbourhood for every pixel
+UNFOLD_OPS = {"median": 1, "bilateral": 3}
+
+_budget_bytes = None
+_budget_fraction = BUDGET_FRACTION
+_local = threading.local()
+
+def set_memory_budget(budget_bytes:int=None,fraction:float=None):
+    """Configure the memory budget used to size processing chunks.
+
+    Args:
+        budget_bytes (int or None): absolute budget in bytes, if None the budget is derived from currently free memory
+        fraction (float or None): fraction of currently free memory to use when budget_bytes is None
+    """
+    global _budget_bytes, _budget_fraction
+    _budget_bytes = budget_bytes
+    if fraction is not None:
+        assert 0 < fraction <= 1, "fraction must be in range (0,1]"
+        _budget_fraction = fraction
+
+def available_memory()->int:
+    """Free memory in bytes on the device used for computation."""
+    if torch.device(device).type == "cuda":
+        free, _total = torch.cuda.mem_get_info(device)
+        return int(free)
+    return int(psutil.virtual_memory().available)
+
+@contextmanager
+def memory_budget(budget_bytes:int):
+    """Limit operations running on the calling thread to a share of the memory budget.
+
+    Args:
+        budget_bytes (int): budget in bytes used by get_memory_budget() on this thread inside the block
+    """
+    previous = getattr(_local,"budget",None)
+    _local.budget = budget_bytes
+    try:
+        yield
+    finally:
+        _local.budget = previous
+
+def get_memory_budget()->int:
+    """Memory in bytes that a single operation is allowed to use."""
+    if getattr(_local,"budget",None) is not None:
+        return int(_local.budget)
+    if _budget_bytes is not None:
+        return int(_budget_bytes)
+    return int(available_memory() * _budget_fraction)
+
+def estimate_working_set(op:str,shape:tuple,dtype=np.float32,kernel_size:int=1,outputs:int=1,buffers:int=0)->int:
+    """Estimate peak bytes needed to process a block of data.
+
+    Args:
+        op (str): operation name, key of OP_FOOTPRINT
+        shape (tuple): shape of the block (slices, rows, columns) or (rows, columns)
+        dtype (np.dtype): dtype of the input data, computation is assumed to happen in at least float32
+        kernel_size (int): size of the symmetrical kernel used by the operation
+        outputs (int): number of output values computed per input pixel (e.g. settings of a parameter sweep)
+        buffers (int): extra blocks held at once, e.g. loaded ahead or waiting to be written back by prefetching
+
+    Returns:
+        Estimated number of bytes.
+    """
+    itemsize = max(np.dtype(dtype).itemsize,4)
+    pad = max(kernel_size,1) - 1
+    rows, cols = shape[-2] + pad, shape[-1] + pad
+    n_slices = int(np.prod(shape[:-2])) if len(shape) > 2 else 1
+    # every extra output is held once on the device and once on the host
+    factor = OP_FOOTPRINT.get(op,4) + UNFOLD_OPS.get(op,0) * kernel_size**2 + 2 * (outputs - 1) + buffers * outputs
+    return n_slices * rows * cols * itemsize * factor
+
+def choose_batch_size(op:str,shape:tuple,dtype=np.float32,kernel_size:int=1,budget:int=None,outputs:int=1,buffers:int=0)->int:
+    """Number of slices along axis 0 that fit in the memory budget.
+
+    Args:
+        op (str): operation name, key of OP_FOOTPRINT
+        shape (tuple): shape of the full volume (slices, rows, columns)
+        dtype (np.dtype): dtype of the input data
+        kernel_size (int): size of the symmetrical kernel used by the operation
+        budget (int or None): budget in bytes, if None get_memory_budget() is used
+        outputs (int): number of output values computed per input pixel
+        buffers (int): extra batches held at once, e.g. loaded ahead or waiting to be written back by prefetching
+
+    Returns:
+        Batch size, 0 if not even a single slice fits the budget.
+    """
+    budget = get_memory_budget() if budget is None else budget
+    per_slice = estimate_working_set(op,shape[1:],dtype,kernel_size,outputs,buffers)
+    return int(min(shape[0],budget // per_slice))
+
+def is_out_of_memory_error(e:BaseException)->bool:
+    """Check whether an exception was raised by a failed allocation."""
+    if isinstance(e,MemoryError):
+        return True
+    oom_error = getattr(torch.cuda,"OutOfMemoryError",None)
+    if oom_error is not None and isinstance(e,oom_error):
+        return True
+    msg = str(e).lower()
+    return isinstance(e,RuntimeError) and ("out of memory" in msg or "can't allocate memory" in msg)
+
+def apply_in_chunks(data:ndarray,batch_func,op:str,kernel_size:int=1,halo:int=None,out:ndarray=None,desc:str="",channel_axis:int=None)->ndarray:
+    """Apply a batched torch function over an image/volume in chunks that fit the memory budget.
+
+    Args:
+        data (ndarray): 2D image or stack of 2D slices with any number of leading batch axes
+        batch_func (callable): function mapping a (B,H,W) tensor on device to a (B,H,W) tensor
+        op (str): operation name used for working set estimation, key of OP_FOOTPRINT
+        kernel_size (int): size of the symmetrical kernel used by the operation
+        halo (int or None): rows of context needed on each side of a tile, None if operation can't be tiled
+        out (ndarray or None): output array with the same shape as data, allocated if None
+        desc (str): description used for progress and log messages
+        channel_axis (int or None): axis of data holding color channels, processed like a batch axis
+
+    Returns:
+        Output array.
+    """
+    out = np.empty_like(data) if out is None else out
+    for _ in iter_chunks(data,batch_func,op,out,kernel_size=kernel_size,halo=halo,desc=desc,channel_axis=channel_axis):
+        pass
+
+    return out
+
+def iter_chunks(data:ndarray,batch_func,op:str,out:ndarray,kernel_size:int=1,halo:int=None,desc:str="",outputs:int=1,channel_axis:int=None,slice_halo:int=0):
+    """Apply a batched torch function over an image/volume in chunks, yielding as chunks complete.
+
+    All axes in front of the last 2 (spatial) axes, and the channel axis if there is one, are flattened into a
+    single batch axis so e.g. a (T,Z,H,W) series is processed as one stack of T*Z slices.
+    Slices of the stack are processed in batches. If a single slice does not fit the budget and halo is
+    not None the slices are split into row tiles overlapping by halo rows. Allocation failures are retried
+    with half the batch size (or half the tile height once batches are a single slice).
+    Functions computing several outputs per pixel (outputs > 1) return a (B,H,W,outputs) tensor and out has
+    a trailing axis of that length. When out is data itself tiles are collected in a scratch buffer of one batch
+    and written back once the whole slice is done, so later tiles still read the original rows of their halo.
+    Reading and converting the next chunk and writing back the previous one run on background threads while a chunk
+    computes (see PrefetchExecutor), the batch size leaves room for those extra chunks.
+    Operations combining neighbouring slices (slice_halo > 0) get slice_halo extra slices of context on each side of
+    a batch, except at the first and last slice of the stack, and return results for the extended batch.
+
+    Args:
+        data (ndarray): 2D image or stack of 2D slices with any number of leading batch axes
+        batch_func (callable): function mapping a (B,H,W) tensor on device to a (B,H,W) tensor
+        op (str): operation name used for working set estimation, key of OP_FOOTPRINT
+        out (ndarray): output array with the same shape as data, may be data itself
+        kernel_size (int): size of the symmetrical kernel used by the operation
+        halo (int or None): rows of context needed on each side of a tile, None if operation can't be tiled
+        desc (str): description used for progress and log messages
+        outputs (int): number of output values computed per input pixel
+        channel_axis (int or None): axis of data holding color channels, processed like a batch axis
+        slice_halo (int): slices of context needed on each side of a batch, 0 for 2D operations
+
+    Yields:
+        (start, stop) range of slices of the flattened stack that have been completely written to out.
+    """
+    channel_axis = normalize_axis(channel_axis,data.ndim)
+    vol = BatchView(data,channel_axis)
+    vol_out = BatchView(out,channel_axis,out.ndim - data.ndim + 2)
+    n_slices, height = vol.shape[0], vol.shape[1]
+    on_cuda = torch.device(device).type == "cuda"
+    in_place = vol.shares_memory(vol_out)
+    # context slices would be read after earlier batches overwrote them
+    assert not (in_place and slice_halo), "Operations combining neighbouring slices can't write into their input"
+    scratch = None
+
+    budget = get_memory_budget()
+    batch_size = choose_batch_size(op,vol.shape,vol.dtype,kernel_size,budget,outputs,prefetch_buffers())
+    if batch_size < n_slices:
+        batch_size -= 2 * slice_halo
+    tile_rows = height
+    if batch_size < 1:
+        batch_size = 1
+        if halo is not None:
+            per_row = (1 + 2 * slice_halo) * estimate_working_set(op,(1,vol.shape[2]),vol.dtype,kernel_size,outputs,prefetch_buffers())
+            tile_rows = int(max(min(height,budget // per_row - 2 * halo),1))
+    if tile_rows < height:
+        show_info(f"{desc}: processing {n_slices} slices one at a time in tiles of {tile_rows} rows (budget {budget / 2**20:.0f} MiB)")
+    else:
+        show_info(f"{desc}: processing {n_slices} slices in batches of {batch_size} (budget {budget / 2**20:.0f} MiB)")
+
+    profile = current_profile()
+
+    def plan(start:int,row:int):
+        """Slices, rows, rows read and slices read including the halos of the chunk starting at slice start and row row."""
+        if start >= n_slices:
+            return None
+        stop = min(start + batch_size,n_slices)
+        row_stop = min(row + tile_rows,height)
+        return (start, stop, row, row_stop, max(row - (halo or 0),0), min(row_stop + (halo or 0),height),
+                max(start - slice_halo,0), min(stop + slice_halo,n_slices))
+
+    def following(chunk):
+        start, stop, _row, row_stop = chunk[:4]
+        return plan(start,row_stop) if row_stop < height else plan(stop,0)
+
+    def load(chunk):
+        _start, _stop, _row, _row_stop, read_start, read_stop, slice_start, slice_stop = chunk
+        with stage("copy",profile=profile):
+            block = np.asarray(vol[slice_start:slice_stop,read_start:read_stop])
+        with stage("to_tensor",nbytes=block.nbytes,profile=profile):
+            in_data = torch.as_tensor(block,device=device)
+            if not torch.is_floating_point(in_data):
+                in_data = in_data.float()
+        return in_data
+
+    def store(chunk,result):
+        nonlocal scratch
+        start, stop, row, row_stop = chunk[:4]
+        with stage("to_host",nbytes=result.numel() * result.element_size(),profile=profile):
+            host = result.detach().cpu().numpy()
+        with stage("copy",nbytes=host.nbytes,profile=profile):
+            if in_place and not (row == 0 and row_stop == height):
+                if row == 0:
+                    scratch = np.empty((stop - start,) + vol_out.shape[1:],dtype=vol_out.dtype)
+                scratch[:,row:row_stop] = host
+                if row_stop == height:
+                    vol_out[start:stop] = scratch
+            else:
+                vol_out[start:stop,row:row_stop] = host
+
+    try:
+        with tqdm(total=n_slices,desc=desc) as pbar, PrefetchExecutor(desc=desc) as executor:
+            chunk = plan(0,0)
+            executor.load(chunk,load,chunk)
+            while chunk is not None:
+                # the next chunk is read and converted while this one computes
+                upcoming = following(chunk)
+                if upcoming is not None:
+                    executor.load(upcoming,load,upcoming)
+                start, stop, row, row_stop, read_start, _read_stop, slice_start, _slice_stop = chunk
+                try:
+                    in_data = executor.take(chunk)
+                    done = stop - start if row_stop == height else 0
+                    with stage("compute",slices=done):
+                        result = batch_func(in_data)
+                        result = result[start - slice_start:stop - slice_start,row - read_start:row_stop - read_start]
+                        if on_cuda:
+                            torch.cuda.synchronize()
+                    del in_data
+                except (MemoryError,RuntimeError) as e:
+                    if not is_out_of_memory_error(e):
+                        raise
+                    # chunks loaded ahead have the old size
+                    executor.cancel_loads()
+                    if on_cuda:
+                        torch.cuda.empty_cache()
+                    if stop - start > 1:
+                        batch_size = max((stop - start) // 2,1)
+                        show_info(f"{desc}: out of memory, retrying with batch size {batch_size}")
+                    elif halo is not None and tile_rows > 1:
+                        tile_rows = max(tile_rows // 2,1)
+                        show_info(f"{desc}: out of memory, retrying with tiles of {tile_rows} rows")
+                    else:
+                        raise
+                    chunk = plan(start,row)
+                    executor.load(chunk,load,chunk)
+                    continue
+
+                # results are written back while the next chunk computes
+                completed = executor.store(chunk,store,chunk,result)
+                del result
+                if upcoming is None:
+                    completed += executor.drain()
+                for done_start, done_stop, _row, done_row_stop, *_reads in completed:
+                    if done_row_stop == height:
+                        pbar.update(done_stop - done_start)
+                        yield done_start, done_stop
+                chunk = upcoming
+    finally:
+        # also reached when a streaming consumer stops early (cancellation), release cached device memory right away
+        if on_cuda:
+            torch.cuda.empty_cache()
@@ -9,6 +9,8 @@ from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.qt.threading import thread_worker
 from napari_cool_tools_io import torch,viewer,device,memory_stats
+from napari_cool_tools_img_proc._axes import BatchView
+from napari_cool_tools_img_proc._profiling import profiled, stage
 
 from napari_cool_tools_io import torch
 
@@ -33,6 +35,7 @@ def pad_image2D_plg(img:Image,axis0_before:int=12,axis0_after:int=12,axis1_befor
     return
 
 @thread_worker(connect={"returned": viewer.add_layer},progress=True)
+@profiled("Pad 2D")
 def pad_image2D_thread(img:Image,axis0_before:int=12,axis0_after:int=12,axis1_before:int=0,axis1_after:int=0,mode:str='constant')->Image:
     """"""
     show_info(f'Pad 2D thread has started')
@@ -44,9 +47,12 @@ def pad_image2D_thread(img:Image,axis0_before:int=12,axis0_after:int=12,axis1_be
 
     # optional layer type argument
     layer_type = "image"
-    data = img.data.copy()
-    out_data = pad_image2D_np(data=data,axis0_before=axis0_before,axis0_after=axis0_after,axis1_before=axis1_before,axis1_after=axis1_after,mode=mode)
-    output = Layer.create(out_data,add_kwargs,layer_type)
+    with stage("copy",nbytes=img.data.nbytes):
+        data = img.data.copy()
+    with stage("compute",slices=1):
+        out_data = pad_image2D_np(data=data,axis0_before=axis0_before,axis0_after=axis0_after,axis1_before=axis1_before,axis1_after=axis1_after,mode=mode)
+    with stage("layer"):
+        output = Layer.create(out_data,add_kwargs,layer_type)
 
     show_info(f'Pad 2D thread has completed')
 
@@ -72,6 +78,7 @@ def pool_2D_plg(img:Image, block_size:int=2,pooling:NpPoolType=NpPoolType.max)->
     return
 
 @thread_worker(connect={"returned": viewer.add_layer},progress=True)
+@profiled("Pooling 2D")
 def pool_2D_thread(img:Image, block_size:int=2, pooling:NpPoolType=NpPoolType.max)->Image:
     """"""
     
@@ -83,9 +90,12 @@ def pool_2D_thread(img:Image, block_size:int=2, pooling:NpPoolType=NpPoolType.ma
 
     # optional layer type argument
     layer_type = "image"
-    data = img.data.copy()
-    out_data = pool_2D(data=data,block_size=block_size,pooling=pooling)
-    output = Layer.create(out_data,add_kwargs,layer_type)
+    with stage("copy",nbytes=img.data.nbytes):
+        data = img.data.copy()
+    with stage("compute",slices=1):
+        out_data = pool_2D(data=data,block_size=block_size,pooling=pooling)
+    with stage("layer"):
+        output = Layer.create(out_data,add_kwargs,layer_type)
     show_info(f"Pooling 2D thread has completed")
 
     return output
@@ -99,3 +109,326 @@ def pool_2D(data:ndarray, block_size:int=2, pooling:NpPoolType=NpPoolType.max)->
         pool_func = np.mean
     out_data = block_reduce(data,block_size=block_size,func=pool_func)
     return out_data
+
+# padding modes whose border values are copies of data values, all other modes compute border values
+INDEX_MODES = ("edge","reflect","symmetric","wrap")
+STAT_MODES = {"maximum": np.max, "mean": np.mean, "median": np.median, "minimum": np.min}
+
+def pad_indices(idx:ndarray,size:int,mode:str)->ndarray:
+    """Index of the data value np.pad copies to every (possibly out of range) index for the index based modes.
+
+    Args:
+        idx (ndarray): indices along an axis relative to the first data value, negative in the before padding
+        size (int): length of the data along the axis
+        mode (str): 'edge', 'reflect', 'symmetric' or 'wrap'
+
+    Returns:
+        Indices in range [0,size).
+    """
+    if mode == "edge" or size == 1:
+        return np.clip(idx,0,size - 1)
+    if mode == "wrap":
+        return np.mod(idx,size)
+    if mode == "symmetric":
+        idx = np.mod(idx,2 * size)
+        return np.where(idx < size,idx,2 * size - 1 - idx)
+    if mode == "reflect":
+        idx = np.mod(idx,2 * (size - 1))
+        return np.where(idx < size,idx,2 * (size - 1) - idx)
+    raise ValueError(f"{mode} is not an index based padding mode")
+
+class VirtualPad:
+    """Padded view of a stack of 2D slices computing border values on the fly instead of allocating a padded copy.
+
+    Values match np.pad applied to every slice, modes that derive border values from statistics of a whole row or
+    column (maximum, mean, median, minimum) read the data once on creation to compute those statistics.
+
+    Args:
+        data (ndarray): 2D image or stack of 2D slices with any number of leading batch axes
+        pad_width (tuple): ((before,after),(before,after)) rows and columns added to each spatial axis
+        mode (str): np.pad mode, see NpBorderType, 'empty' borders are filled with constant_value
+        constant_value (float): value of constant borders and end value of linear_ramp borders
+    """
+
+    def __init__(self,data:ndarray,pad_width:tuple=((0,0),(0,0)),mode:str="constant",constant_value:float=0):
+        self.vol = BatchView(data)
+        self.pad_width = tuple((int(before),int(after)) for before, after in pad_width)
+        self.mode = mode
+        self.constant_value = constant_value
+        n, height, width = self.vol.shape
+        self.shape = (n,height + sum(self.pad_width[0]),width + sum(self.pad_width[1]))
+        self.dtype = self.vol.dtype
+
+        if mode in STAT_MODES:
+            stat = STAT_MODES[mode]
+            self.col_stat = np.empty((n,width),dtype=self.dtype)
+            self.row_stat = np.empty((n,height),dtype=self.dtype)
+            self.corner = np.empty(n,dtype=self.dtype)
+            for i in range(n):
+                image = self.vol[i]
+                # np.pad pads rows first, the columns of the corners are statistics of the padded rows
+                self.col_stat[i] = self._round(stat(image,axis=0))
+                self.row_stat[i] = self._round(stat(image,axis=1))
+                self.corner[i] = self._round(stat(self.col_stat[i]))
+
+    def _round(self,values):
+        return np.round(values) if np.issubdtype(self.dtype,np.integer) else values
+
+    def _pad_axis(self,block:ndarray,idx:ndarray,size:int,axis:int,pads:tuple,stat=None,edge_before=None,edge_after=None)->ndarray:
+        """Extend block, holding the in range entries of idx along axis, with the border values of idx."""
+        shape = list(block.shape)
+        shape[axis] = len(idx)
+        out = np.empty(shape,dtype=self.dtype)
+        view, block = np.moveaxis(out,axis,-1), np.moveaxis(block,axis,-1)
+        before, after = idx < 0, idx >= size
+        view[...,~(before | after)] = block
+
+        if self.mode in STAT_MODES:
+            view[...,before | after] = stat[...,np.newaxis]
+        elif self.mode == "linear_ramp":
+            # same arithmetic as np.linspace(end,edge,pad,endpoint=False) which floors integer ramps
+            end = self.constant_value
+            floor = np.floor if np.issubdtype(self.dtype,np.integer) else (lambda v: v)
+            if before.any():
+                step = (edge_before[...,np.newaxis].astype(np.float64) - end) / pads[0]
+                view[...,before] = floor((idx[before] + pads[0]) * step + end)
+            if after.any():
+                step = (edge_after[...,np.newaxis].astype(np.float64) - end) / pads[1]
+                view[...,after] = floor((pads[1] - 1 - (idx[after] - size)) * step + end)
+        else:
+            view[...,before | after] = self.constant_value
+        return out
+
+    def read(self,start:int,stop:int,rows:tuple,cols:tuple)->ndarray:
+        """Padded values of slices start to stop, rows and columns are (start, stop) ranges in padded coordinates.
+
+        Ranges may extend past the padded shape, values continue as if the padding was wider.
+        """
+        r = np.arange(*rows) - self.pad_width[0][0]
+        c = np.arange(*cols) - self.pad_width[1][0]
+        height, width = self.vol.shape[1:]
+
+        if self.mode in INDEX_MODES:
+            ri, ci = pad_indices(r,height,self.mode), pad_indices(c,width,self.mode)
+            r_lo, c_lo = ri.min(), ci.min()
+            block = self.vol[start:stop,r_lo:ri.max() + 1,c_lo:ci.max() + 1]
+            return block[:,ri - r_lo][:,:,ci - c_lo]
+
+        ra, rb = int(np.clip(r[0],0,height)), int(np.clip(r[-1] + 1,0,height))
+        ca, cb = int(np.clip(c[0],0,width)), int(np.clip(c[-1] + 1,0,width))
+        core = self.vol[start:stop,ra:rb,ca:cb]
+
+        col_stat = row_stat = None
+        if self.mode in STAT_MODES:
+            col_stat = self.col_stat[start:stop,ca:cb]
+            inside = (r >= 0) & (r < height)
+            row_stat = np.where(inside,self.row_stat[start:stop][:,np.clip(r,0,height - 1)],self.corner[start:stop,np.newaxis])
+
+        def pad_rows(block,c_lo,c_hi,stat):
+            edges = (None,None)
+            if self.mode == "linear_ramp":
+                edges = (self.vol[start:stop,0,c_lo:c_hi],self.vol[start:stop,height - 1,c_lo:c_hi])
+            return self._pad_axis(block,r,height,1,self.pad_width[0],stat,*edges)
+
+        padded = pad_rows(core,ca,cb,col_stat)
+        edges = (None,None)
+        if self.mode == "linear_ramp" and ((c < 0).any() or (c >= width).any()):
+            # ramps along rows start at the first/last column of the data padded along columns
+            edges = tuple(pad_rows(self.vol[start:stop,ra:rb,col:col + 1],col,col + 1,None)[:,:,0] for col in (0,width - 1))
+        return self._pad_axis(padded,c,width,2,self.pad_width[1],row_stat,*edges)
+
+class PatchExtractor:
+    """Lazily pad, pool and tile a stack of 2D slices into fixed size patches for neural network inference.
+
+    Only the padded region under each patch is computed, so preparing a volume never allocates a padded or pooled
+    copy of it. Patches are placed on a regular grid in the pooled, padded image with overlap pixels shared between
+    neighbours, the last patch of each row/column is shifted back to end at the image border.
+
+    Args:
+        data (ndarray): 2D image or stack of 2D slices with any number of leading batch axes
+        patch_size (int or tuple): (rows, columns) of a patch after pooling
+        overlap (int): pixels shared by neighbouring patches
+        pad_width (tuple): ((before,after),(before,after)) padding of each spatial axis prior to pooling
+        mode (str): np.pad mode, see NpBorderType
+        block_size (int): pooling block size, 1 disables pooling
+        pooling (str): 'max' or 'avg'
+        constant_value (float): value of constant borders and end value of linear_ramp borders
+    """
+
+    def __init__(self,data:ndarray,patch_size=256,overlap:int=0,pad_width:tuple=((0,0),(0,0)),mode:str="constant",
+                 block_size:int=1,pooling:str="max",constant_value:float=0):
+        self.data = data
+        self.padded = VirtualPad(data,pad_width,mode,constant_value)
+        self.patch_size = (patch_size,patch_size) if isinstance(patch_size,int) else tuple(patch_size)
+        self.overlap = overlap
+        self.block_size = block_size
+        self.pooling = pooling
+        n, height, width = self.padded.shape
+        # partial pooling blocks at the border are filled with zeros like skimage block_reduce
+        self.shape = (n,-(-height // block_size),-(-width // block_size))
+        assert all(p > overlap for p in self.patch_size), "Patch size must be larger than the overlap"
+        assert self.shape[1] >= self.patch_size[0] and self.shape[2] >= self.patch_size[1], \
+            f"Patch size {self.patch_size} is larger than the pooled, padded image {self.shape[1:]}"
+        self.rows = self._starts(self.shape[1],self.patch_size[0])
+        self.cols = self._starts(self.shape[2],self.patch_size[1])
+        self.positions = [(i,y,x) for i in range(n) for y in self.rows for x in self.cols]
+
+    def _starts(self,size:int,patch:int)->list:
+        starts = list(range(0,size - patch + 1,patch - self.overlap))
+        if starts[-1] + patch < size:
+            starts.append(size - patch)
+        return starts
+
+    def __len__(self)->int:
+        return len(self.positions)
+
+    def read_patches(self,start:int,stop:int,y:int,x:int)->ndarray:
+        """Patch at pooled position (y, x) of slices start to stop as a (stop-start,rows,columns) array."""
+        s = self.block_size
+        ph, pw = self.patch_size
+        _, height, width = self.padded.shape
+        region = self.padded.read(start,stop,(y * s,min((y + ph) * s,height)),(x * s,min((x + pw) * s,width)))
+        if s == 1:
+            return region
+        full = np.zeros((stop - start,ph * s,pw * s),dtype=region.dtype)
+        full[:,:region.shape[1],:region.shape[2]] = region
+        blocks = full.reshape(stop - start,ph,s,pw,s)
+        return blocks.max(axis=(2,4)) if self.pooling == "max" else blocks.mean(axis=(2,4))
+
+    def iter_batches(self,batch_size:int=16,positions:list=None):
+        """Generate batches of patches, computing each patch only when its batch is requested.
+
+        Args:
+            batch_size (int): patches per batch
+            positions (list or None): (slice, y, x) positions to extract, defaults to all positions
+
+        Yields:
+            (patches, positions) with patches a (n,rows,columns) array and positions the list of its n positions.
+        """
+        positions = self.positions if positions is None else positions
+        for i in range(0,len(positions),batch_size):
+            batch = positions[i:i + batch_size]
+            with stage("compute",slices=len(batch)):
+                patches = np.stack([self.read_patches(b,b + 1,y,x)[0] for b, y, x in batch])
+            yield patches, batch
+
+    def stitcher(self,channels:int=None,dtype=np.float32):
+        """PatchStitcher assembling model outputs for the patches of this extractor."""
+        return PatchStitcher(self,channels,dtype)
+
+class PatchDataset(torch.utils.data.IterableDataset):
+    """Torch dataset streaming the patches of a PatchExtractor, positions are split between DataLoader workers.
+
+    Yields:
+        (patch, position) with patch a (1,rows,columns) float tensor and position a (slice, y, x) tuple.
+    """
+
+    def __init__(self,extractor:PatchExtractor):
+        super().__init__()
+        self.extractor = extractor
+
+    def __len__(self)->int:
+        return len(self.extractor)
+
+    def __iter__(self):
+        positions = self.extractor.positions
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            positions = positions[worker.id::worker.num_workers]
+        for b, y, x in positions:
+            patch = self.extractor.read_patches(b,b + 1,y,x)
+            yield torch.as_tensor(patch,dtype=torch.float32), (b,y,x)
+
+def blend_weights(size:int,overlap:int)->ndarray:
+    """1D weights ramping up over the overlap at both ends of a patch so overlapping outputs fade into each other."""
+    if overlap <= 0:
+        return np.ones(size,dtype=np.float32)
+    ramp = (np.minimum(np.arange(size),np.arange(size)[::-1]) + 1) / (overlap + 1)
+    return np.minimum(ramp,1).astype(np.float32)
+
+class PatchStitcher:
+    """Assemble per patch model outputs into a stack, blending overlapping patches with linear weights.
+
+    Args:
+        extractor (PatchExtractor): extractor that produced the patches
+        channels (int or None): output channels per patch, None for (rows,columns) outputs
+        dtype (np.dtype): dtype of the stitched output
+    """
+
+    def __init__(self,extractor:PatchExtractor,channels:int=None,dtype=np.float32):
+        self.extractor = extractor
+        n, height, width = extractor.shape
+        self.channels = channels
+        shape = (n,height,width) if channels is None else (n,channels,height,width)
+        self.out = np.zeros(shape,dtype=dtype)
+        self.weight = np.zeros((n,height,width),dtype=np.float32)
+        ph, pw = extractor.patch_size
+        self.window = np.outer(blend_weights(ph,extractor.overlap),blend_weights(pw,extractor.overlap))
+
+    def add(self,outputs,positions:list):
+        """Accumulate model outputs, (n,rows,columns) or (n,channels,rows,columns), for n patch positions."""
+        if isinstance(outputs,torch.Tensor):
+            outputs = outputs.detach().cpu().numpy()
+        ph, pw = self.extractor.patch_size
+        with stage("copy",nbytes=outputs.nbytes):
+            for output, (b, y, x) in zip(outputs,positions):
+                self.out[b,...,y:y + ph,x:x + pw] += output * self.window
+                self.weight[b,y:y + ph,x:x + pw] += self.window
+
+    def result(self,crop:bool=True)->ndarray:
+        """Blended output, cropped to the pooled extent of the unpadded data and shaped like its batch axes.
+
+        Args:
+            crop (bool): remove the (pooled) padding
+        """
+        weight = np.maximum(self.weight,np.finfo(np.float32).tiny)
+        out = self.out / (weight if self.channels is None else weight[:,np.newaxis])
+        extractor = self.extractor
+        if crop:
+            s = extractor.block_size
+            (top, bottom), (left, right) = extractor.padded.pad_width
+            height, width = extractor.padded.vol.shape[1:]
+            out = out[...,top // s:top // s + -(-height // s),left // s:left // s + -(-width // s)]
+        return out.reshape(extractor.data.shape[:-2] + out.shape[1:])
+
+def extract_patches_plg(img:Image,patch_size:int=256,overlap:int=32,axis0_before:int=0,axis0_after:int=0,axis1_before:int=0,axis1_after:int=0,
+                        mode:NpBorderType=NpBorderType.constant,block_size:int=1,pooling:NpPoolType=NpPoolType.max):
+    """Show the patches a network would receive as a stack, one patch per slice.
+
+    Args:
+        img (Image): Image/Volume to be split into patches.
+        patch_size (int): rows and columns of a patch after pooling
+        overlap (int): pixels shared by neighbouring patches
+        axis0_before (int): rows padded before the first row
+        axis0_after (int): rows padded after the last row
+        axis1_before (int): columns padded before the first column
+        axis1_after (int): columns padded after the last column
+        mode (NpBorderType(Enum)): np.pad mode used for the padding
+        block_size (int): pooling block size, 1 disables pooling
+        pooling (NpPoolType(Enum)): max or average pooling
+    """
+    extract_patches_thread(img=img,patch_size=patch_size,overlap=overlap,pad_width=((axis0_before,axis0_after),(axis1_before,axis1_after)),
+                           mode=mode.value,block_size=block_size,pooling=pooling.value)
+
+    return
+
+@thread_worker(connect={"returned": viewer.add_layer},progress=True)
+@profiled("Extract Patches 2D")
+def extract_patches_thread(img:Image,patch_size:int=256,overlap:int=32,pad_width:tuple=((0,0),(0,0)),mode:str='constant',block_size:int=1,pooling:str='max')->Image:
+    """"""
+    show_info('Extract Patches 2D thread has started')
+
+    extractor = PatchExtractor(img.data,patch_size,overlap,pad_width,mode,block_size,pooling)
+    patches = np.empty((len(extractor),) + extractor.patch_size,dtype=np.float32 if pooling == "avg" and block_size > 1 else extractor.padded.dtype)
+    done = 0
+    for batch, _positions in tqdm(extractor.iter_batches(),total=-(-len(extractor) // 16),desc="Extract Patches"):
+        patches[done:done + len(batch)] = batch
+        done += len(batch)
+
+    add_kwargs = {"name": f"{img.name}_Patches_{patch_size}", "metadata": {"positions": extractor.positions}}
+    with stage("layer"):
+        output = Layer.create(patches,add_kwargs,"image")
+
+    show_info('Extract Patches 2D thread has completed')
+
+    return output
@@ -2,112 +2,172 @@
 This module contains code for normalizing image values
 """
 #import torch
+import numpy as np
 from napari.utils.notifications import show_info
 from napari.layers import Image, Layer
 from napari.types import ImageData
 from napari.qt.threading import thread_worker
-from napari_cool_tools_io import torch, viewer, device, memory_stats
+from napari_cool_tools_io import torch, device, memory_stats
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
+from napari_cool_tools_img_proc._incremental import incremental
+from napari_cool_tools_img_proc._kernels import box_filter_batch
+from napari_cool_tools_img_proc._memory import apply_in_chunks, iter_chunks
+from napari_cool_tools_img_proc._pointwise import PointwiseChain
+from napari_cool_tools_img_proc._pool import apply_to_selected
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._roi import roi_restricted
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._statistics import value_range
+from napari_cool_tools_img_proc._streaming import can_process_in_place, iter_slices, run_generator, stream_to_viewer
 
-def normalize_in_range(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = True) -> Layer:
+def normalize_in_range(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = False,all_selected:bool=False,low_quantile:float = 0.0,high_quantile:float = 1.0) -> Layer:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
         img (Image): ndarray representing image data
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
-        in_place (bool): flag indicating whether to modify the image in place or return new image
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
     """
-    normalize_in_range_thread(img=img,min_val=min_val,max_val=max_val,in_place=in_place)
+    if all_selected:
+        apply_to_selected(normalize_in_range_gen,"Normalization",min_val=min_val,max_val=max_val,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile)
+        return
+    worker = normalize_in_range_thread(img=img,min_val=min_val,max_val=max_val,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile)
+    stream_to_viewer(worker,"Normalization")
     return
 
-@thread_worker(connect={"returned": viewer.add_layer},progress=True)
-def normalize_in_range_thread(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = True) -> Layer:
+@thread_worker(progress=True)
+def normalize_in_range_thread(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = False,low_quantile:float = 0.0,high_quantile:float = 1.0) -> Layer:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
         img (Image): ndarray representing image data
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
-        in_place (bool): flag indicating whether to modify the image in place or return new image
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
     """
     show_info(f"Normalization thread started")
-    output = normalize_in_range_func(img=img,min_val=min_val,max_val=max_val,in_place=in_place)
+    output = yield from normalize_in_range_gen(img=img,min_val=min_val,max_val=max_val,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile)
     #output = normalize_in_range_pt_func(img=img,min_val=min_val,max_val=max_val,in_place=in_place)
     torch.cuda.empty_cache()
     memory_stats()
     show_info(f"Normalization thread completed")
     return output
 
-def normalize_in_range_func(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = True) -> Layer:
+def normalize_in_range_func(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = False,low_quantile:float = 0.0,high_quantile:float = 1.0) -> Layer:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
         img (Image): ndarray representing image data
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
-        in_place (bool): flag indicating whether to modify the image in place or return new image
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
+
+    Returns:
+        Image with normalized values mapped between range of min_val and max_val is in_place
+    """
+    return run_generator(normalize_in_range_gen(img=img,min_val=min_val,max_val=max_val,in_place=in_place,low_quantile=low_quantile,high_quantile=high_quantile))
+
+@profiled("Normalize")
+@cached("normalize")
+@scheduled("skimage","Normalize")
+def normalize_in_range_gen(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = False,low_quantile:float = 0.0,high_quantile:float = 1.0):
+    """Function to map image/B-scan values to a specific range between min_val and max_val.
+
+    Args:
+        img (Image): ndarray representing image data
+        min_val (float): minimum value of range that image values are to be mapped to
+        max_val (float): maximum value of range that image values are to be mapped to
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
     """
     
     data = img.data
-    norm_data = (max_val - min_val) * ((data-data.min())/ (data.max()-data.min())) + min_val
+    with stage("statistics",nbytes=data.nbytes):
+        data_min, data_max = value_range(data,low_quantile,high_quantile)
+    clip = low_quantile > 0 or high_quantile < 1
+    out_dtype = np.result_type(data.dtype,np.float32)
 
-    if in_place:
-        name = f"{img.name}_Norm_{min_val}-{max_val}"
-        #new_name = f"pre_norm_{img.name}"
-        #img.name = new_name
-        add_kwargs = {"name":name}
-        layer_type = 'image'
-        layer = Layer.create(norm_data,add_kwargs,layer_type)
-        return layer
+    if in_place and can_process_in_place(data,out_dtype,"Normalize"):
+        norm_data, layer = data, img
     else:
+        norm_data = np.empty(data.shape,dtype=out_dtype)
         name = f"{img.name}_norm_{min_val}_{max_val}"
         add_kwargs = {"name":name}
         layer_type = "image"
-        layer = Layer.create(norm_data,add_kwargs,layer_type)
-        return layer
+        with stage("layer"):
+            layer = Layer.create(norm_data,add_kwargs,layer_type)
+    yield layer
+
+    chain = PointwiseChain().normalize(data_min,data_max,min_val,max_val,clip)
+
+    def normalize_slice(image):
+        return chain.apply(image)
+
+    for _ in iter_slices(data,normalize_slice,norm_data,desc="Normalize"):
+        yield layer
+
+    return layer
     
-def normalize_in_range_pt_func(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = True) -> Layer:
+@profiled("Normalize(PT)")
+def normalize_in_range_pt_func(img: Image, min_val:float = 0.0, max_val:float = 1.0, in_place:bool = False,low_quantile:float = 0.0,high_quantile:float = 1.0) -> Layer:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
         img (Image): ndarray representing image data
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
-        in_place (bool): flag indicating whether to modify the image in place or return new image
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
     """
     
-    data = img.data.copy()
-    pt_data = torch.tensor(data,device=device)
-    norm_data = (max_val - min_val) * ((pt_data-pt_data.min())/ (pt_data.max()-pt_data.min())) + min_val
+    data = img.data
+    with stage("statistics",nbytes=data.nbytes):
+        data_min, data_max = value_range(data,low_quantile,high_quantile)
+    clip = low_quantile > 0 or high_quantile < 1
 
-    if in_place:
-        name = f"{img.name}_Norm_{min_val}-{max_val}"
-        #new_name = f"pre_norm_{img.name}"
-        #img.name = new_name
-        add_kwargs = {"name":name}
-        layer_type = 'image'
-        layer = Layer.create(norm_data.detach().cpu().numpy(),add_kwargs,layer_type)
-        return layer
+    normalize_batch = PointwiseChain().normalize(data_min,data_max,min_val,max_val,clip)
+
+    out_dtype = np.result_type(data.dtype,np.float32)
+    if in_place and can_process_in_place(data,out_dtype,"Normalize(PT)"):
+        apply_in_chunks(data,normalize_batch,"normalize",halo=0,out=data,desc="Normalize")
+        return img
     else:
+        out = np.empty(data.shape,dtype=out_dtype)
+        norm_data = apply_in_chunks(data,normalize_batch,"normalize",halo=0,out=out,desc="Normalize")
         name = f"{img.name}_norm_{min_val}_{max_val}"
         add_kwargs = {"name":name}
         layer_type = "image"
-        layer = Layer.create(norm_data.detach().cpu().numpy(),add_kwargs,layer_type)
+        with stage("layer"):
+            layer = Layer.create(norm_data,add_kwargs,layer_type)
         return layer
 
-def normalize_data_in_range_func(img: ImageData, min_val:float = 0.0, max_val:float = 1.0) -> ImageData:
+def normalize_data_in_range_func(img: ImageData, min_val:float = 0.0, max_val:float = 1.0,low_quantile:float = 0.0,high_quantile:float = 1.0) -> ImageData:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
@@ -115,19 +175,23 @@ def normalize_data_in_range_func(img: ImageData, min_val:float = 0.0, max_val:fl
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
         numpy_out (bool): flag indicating whether to return torch tensor or numpy ndarray
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
     """
     
     data = img
-    norm_data = (max_val - min_val) * ((data-data.min())/ (data.max()-data.min())) + min_val
+    data_min, data_max = value_range(data,low_quantile,high_quantile)
+    clip = low_quantile > 0 or high_quantile < 1
+    norm_data = PointwiseChain().normalize(data_min,data_max,min_val,max_val,clip).apply(data)
 
     out = norm_data
 
     return out    
     
-def normalize_data_in_range_pt_func(img: ImageData, min_val:float = 0.0, max_val:float = 1.0, numpy_out:bool = True) -> ImageData:
+def normalize_data_in_range_pt_func(img: ImageData, min_val:float = 0.0, max_val:float = 1.0, numpy_out:bool = True,low_quantile:float = 0.0,high_quantile:float = 1.0) -> ImageData:
     """Function to map image/B-scan values to a specific range between min_val and max_val.
 
     Args:
@@ -135,6 +199,8 @@ def normalize_data_in_range_pt_func(img: ImageData, min_val:float = 0.0, max_val
         min_val (float): minimum value of range that image values are to be mapped to
         max_val (float): maximum value of range that image values are to be mapped to
         numpy_out (bool): flag indicating whether to return torch tensor or numpy ndarray
+        low_quantile (float): quantile of the data mapped to min_val, lower values are clipped, 0 uses the minimum
+        high_quantile (float): quantile of the data mapped to max_val, higher values are clipped, 1 uses the maximum
 
     Returns:
         Image with normalized values mapped between range of min_val and max_val is in_place
@@ -142,11 +208,131 @@ def normalize_data_in_range_pt_func(img: ImageData, min_val:float = 0.0, max_val
     
     data = img.copy()
     pt_data = torch.tensor(data,device=device)
-    norm_data = (max_val - min_val) * ((pt_data-pt_data.min())/ (pt_data.max()-pt_data.min())) + min_val
+    if not torch.is_floating_point(pt_data):
+        pt_data = pt_data.float()
+    if low_quantile > 0 or high_quantile < 1:
+        data_min, data_max = value_range(data,low_quantile,high_quantile)
+        norm_data = PointwiseChain().normalize(data_min,data_max,min_val,max_val,clip=True)(pt_data)
+    else:
+        norm_data = PointwiseChain().normalize(pt_data.min(),pt_data.max(),min_val,max_val)(pt_data)
 
     if numpy_out:
         out = norm_data.detach().cpu().numpy()
     else:
         out = norm_data
 
-    return out
\ No newline at end of file
+    return out
+
+def normalize_local(img: Image, window_size:int = 31, min_std:float = 1e-6, clip:float = 3.0, in_place:bool = False,all_selected:bool=False,roi:Layer=None) -> Layer:
+    """Adaptive normalization of every pixel by the mean and standard deviation of the window around it.
+
+    Compensates slowly varying brightness such as depth dependent attenuation of OCT B-scans. Window statistics are
+    computed from summed-area tables, so the cost does not depend on window_size.
+
+    Args:
+        img (Image): ndarray representing image data
+        window_size (int): rows and columns of the window, odd
+        min_std (float): lower bound of the local standard deviation in units of the data, keeps flat regions from
+                         amplifying noise
+        clip (float): local z-scores in range -clip to clip are mapped to 0-1 and values outside are clipped, 0
+                      returns the z-scores themselves
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+        all_selected (bool): apply to all selected Image layers instead of img, one result layer per input
+        roi (Layer or None): Labels or Shapes layer, only its masked regions are processed and the rest of the result is copied from img
+
+    Returns:
+        Locally normalized image with '_LN(window_size)' suffix added to name.
+    """
+    if all_selected:
+        apply_to_selected(normalize_local_gen,"Local Normalization",window_size=window_size,min_std=min_std,clip=clip,in_place=in_place,roi=roi)
+        return
+    worker = normalize_local_thread(img=img,window_size=window_size,min_std=min_std,clip=clip,in_place=in_place,roi=roi)
+    stream_to_viewer(worker,"Local Normalization")
+    return
+
+@thread_worker(progress=True)
+def normalize_local_thread(img: Image, window_size:int = 31, min_std:float = 1e-6, clip:float = 3.0, in_place:bool = False,roi:Layer=None) -> Layer:
+    ''''''
+    show_info("Local Normalization thread started")
+    output = yield from normalize_local_gen(img=img,window_size=window_size,min_std=min_std,clip=clip,in_place=in_place,roi=roi)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info("Local Normalization thread completed")
+    return output
+
+def normalize_local_func(img: Image, window_size:int = 31, min_std:float = 1e-6, clip:float = 3.0, in_place:bool = False) -> Layer:
+    """Non streaming version of normalize_local_gen"""
+    return run_generator(normalize_local_gen(img=img,window_size=window_size,min_std=min_std,clip=clip,in_place=in_place))
+
+def local_normalize_batch(batch,window_size:int = 31, min_std:float = 1e-6, clip:float = 3.0):
+    """Local z-scores of every pixel of a (B,H,W) tensor from window means of the data and its square.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        window_size (int): rows and columns of the window, odd
+        min_std (float): lower bound of the local standard deviation
+        clip (float): z-scores in range -clip to clip are mapped to 0-1, 0 returns z-scores
+
+    Returns:
+        (B,H,W) normalized tensor.
+    """
+    # local statistics are shift invariant, centering every slice keeps the variance E[x^2] - E[x]^2 accurate
+    centered = batch - batch.mean(dim=(-2,-1),keepdim=True)
+    mean = box_filter_batch(centered,window_size)
+    variance = (box_filter_batch(centered.square(),window_size) - mean.square()).clamp_(min=0)
+    z = (centered - mean) / variance.sqrt().clamp_(min=max(min_std,1e-12))
+    if clip > 0:
+        z = PointwiseChain().normalize(-clip,clip,0.0,1.0,clip=True)(z)
+    return z
+
+@profiled("Local Normalization")
+@roi_restricted(lambda args: args["window_size"] // 2,"Local Normalization")
+@cached("normalize_local")
+@scheduled("torch","Local Normalization")
+@incremental("normalize_local")
+def normalize_local_gen(img: Image, window_size:int = 31, min_std:float = 1e-6, clip:float = 3.0, in_place:bool = False):
+    """Streaming adaptive normalization of every pixel by the mean and standard deviation of the window around it.
+
+    Slices are processed in batches and split into row tiles overlapping by half a window when a slice does not
+    fit the memory budget.
+
+    Args:
+        img (Image): ndarray representing image data
+        window_size (int): rows and columns of the window, odd
+        min_std (float): lower bound of the local standard deviation in units of the data
+        clip (float): local z-scores in range -clip to clip are mapped to 0-1, 0 returns z-scores
+        in_place (bool): overwrite the data of img instead of creating a new layer, float data is required
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Locally normalized image with '_LN(window_size)' suffix added to name.
+    """
+    data = img.data
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert window_size >= 1 and window_size % 2 == 1, "window_size must be a positive odd number"
+        assert clip >= 0, "clip must not be negative"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        out_dtype = np.result_type(data.dtype,np.float32)
+        if in_place and can_process_in_place(data,out_dtype,"Local Normalization"):
+            norm_data, layer = data, img
+        else:
+            norm_data = np.empty(data.shape,dtype=out_dtype)
+            add_kwargs = {"name": f"{img.name}_LN{window_size}"}
+            layer_type = "image"
+            with stage("layer"):
+                layer = Layer.create(norm_data,add_kwargs,layer_type)
+        yield layer
+
+        def normalize_batch(batch):
+            return local_normalize_batch(batch,window_size,min_std,clip)
+
+        for _ in iter_chunks(data,normalize_batch,"normalize_local",norm_data,halo=window_size // 2,desc="Local Normalization",channel_axis=channel_axis_of(img)):
+            yield layer
+
+        return layer
@@ -0,0 +1,210 @@
+"""
+This module contains code for fusing chains of pointwise intensity operations into a single pass over the data
+"""
+import math
+import threading
+
+import numpy as np
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import torch
+from numpy import ndarray
+
+from napari_cool_tools_img_proc._memory import is_out_of_memory_error
+
+try:
+    import numexpr
+except ImportError:
+    numexpr = None
+
+# compile fused chains with torch.compile, eager torch is used when disabled or compilation fails
+COMPILE = True
+
+# smallest batch in elements worth the one time compilation, smaller batches run eagerly
+COMPILE_MIN_ELEMENTS = 2**22
+
+# number of parameters of every step
+STEP_PARAMS = {"affine": 2, "normalize": 4, "clip": 2, "gamma": 2, "log": 1, "exp": 1}
+
+_eager = {}
+_compiled = {}
+_failed = set()
+_lock = threading.Lock()
+
+def configure_fusion(use_compile:bool=None,compile_min_elements:int=None):
+    """Configure compilation of fused pointwise chains.
+
+    Args:
+        use_compile (bool or None): compile chains with torch.compile instead of running them eagerly
+        compile_min_elements (int or None): smallest batch in elements that is run through a compiled chain
+    """
+    global COMPILE, COMPILE_MIN_ELEMENTS
+    if use_compile is not None:
+        COMPILE = use_compile
+    if compile_min_elements is not None:
+        COMPILE_MIN_ELEMENTS = compile_min_elements
+
+def _chain_function(kinds:tuple):
+    """Python function applying the steps kinds to a tensor, the loop is unrolled when it is traced for compilation."""
+    def chain(x,params:list):
+        i = 0
+        for kind in kinds:
+            p = params[i:i + STEP_PARAMS[kind]]
+            if kind == "affine":
+                x = x * p[0] + p[1]
+            elif kind == "normalize":
+                x = p[2] * ((x - p[0]) / p[1]) + p[3]
+            elif kind == "clip":
+                x = torch.maximum(torch.minimum(x,p[1]),p[0])
+            elif kind == "gamma":
+                x = p[1] * torch.pow(x,p[0])
+            elif kind == "log":
+                x = p[0] * torch.log2(1 + x)
+            elif kind == "exp":
+                x = p[0] * (torch.exp2(x) - 1)
+            i += STEP_PARAMS[kind]
+        return x
+    return chain
+
+def _numexpr_expression(kinds:tuple)->list:
+    """numexpr expressions of the steps kinds split into segments ending at clip steps, clips are applied in place."""
+    segments, expr, i = [], "x", 0
+    for kind in kinds:
+        p = [f"p{i + j}" for j in range(STEP_PARAMS[kind])]
+        if kind == "affine":
+            expr = f"({expr}) * {p[0]} + {p[1]}"
+        elif kind == "normalize":
+            expr = f"{p[2]} * ((({expr}) - {p[0]}) / {p[1]}) + {p[3]}"
+        elif kind == "clip":
+            segments.append((expr,p))
+            expr = "x"
+        elif kind == "gamma":
+            expr = f"{p[1]} * ({expr}) ** {p[0]}"
+        elif kind == "log":
+            expr = f"{p[0]} * log(1 + ({expr})) / {math.log(2)!r}"
+        elif kind == "exp":
+            expr = f"{p[0]} * (exp(({expr}) * {math.log(2)!r}) - 1)"
+        i += STEP_PARAMS[kind]
+    segments.append((expr,None))
+    return segments
+
+def chain_function(kinds:tuple,numel:int=0):
+    """Callable (tensor, params) -> tensor applying the steps kinds in one fused pass.
+
+    Chains are compiled once per sequence of step kinds with dynamic shapes, parameters are passed as tensors so
+    new parameter values and batch sizes reuse the compiled code. Batches smaller than COMPILE_MIN_ELEMENTS run
+    eagerly.
+
+    Args:
+        kinds (tuple): step kinds in order of application
+        numel (int): number of elements of the batch the chain is applied to
+
+    Returns:
+        Compiled or eager chain function.
+    """
+    with _lock:
+        if kinds not in _eager:
+            _eager[kinds] = _chain_function(kinds)
+        eager = _eager[kinds]
+        if not COMPILE or numel < COMPILE_MIN_ELEMENTS or kinds in _failed or not hasattr(torch,"compile"):
+            return eager
+        if kinds not in _compiled:
+            _compiled[kinds] = torch.compile(eager,dynamic=True)
+        compiled = _compiled[kinds]
+
+    def run(x,params):
+        try:
+            return compiled(x,params)
+        # dynamo and inductor failures, including a missing C compiler, are RuntimeErrors
+        except RuntimeError as e:
+            if is_out_of_memory_error(e):
+                raise
+            with _lock:
+                _failed.add(kinds)
+            show_info(f"Pointwise chain {'/'.join(kinds)}: compilation failed, running eagerly ({type(e).__name__})")
+            return eager(x,params)
+    return run
+
+class PointwiseChain:
+    """Sequence of pointwise intensity operations evaluated as one fused expression.
+
+    Every step is applied to the result of the previous one without materializing full size intermediates, e.g.
+    normalization followed by gamma and log correction reads the input and writes the output once. Parameters may
+    be scalars or arrays/tensors broadcasting against the data such as per slice minima of shape (B,1,1).
+
+    Example:
+        chain = PointwiseChain().normalize(data_min,data_max,0.0,1.0).gamma(0.5).log()
+        out = chain(batch)
+    """
+
+    def __init__(self):
+        self.kinds = ()
+        self.params = []
+
+    def _add(self,kind:str,*params):
+        self.kinds += (kind,)
+        self.params += list(params)
+        return self
+
+    def affine(self,scale,offset):
+        """x * scale + offset"""
+        return self._add("affine",scale,offset)
+
+    def clip(self,low,high):
+        """Limit values to range low-high."""
+        return self._add("clip",low,high)
+
+    def normalize(self,data_min,data_max,min_val:float=0.0,max_val:float=1.0,clip:bool=False):
+        """Map range data_min-data_max to range min_val-max_val, optionally clipping values outside of it."""
+        # same operation order as the unfused normalization so range ends map exactly to min_val and max_val
+        self._add("normalize",data_min,data_max - data_min,max_val - min_val,min_val)
+        return self.clip(min_val,max_val) if clip else self
+
+    def gamma(self,gamma:float=1.0,gain:float=1.0):
+        """gain * x ** gamma like skimage.exposure.adjust_gamma of float data."""
+        return self._add("gamma",gamma,gain)
+
+    def log(self,gain:float=1.0,inv:bool=False):
+        """gain * log2(1 + x) or the inverse gain * (2 ** x - 1) like skimage/kornia adjust_log of float data."""
+        return self._add("exp" if inv else "log",gain)
+
+    def _tensor_params(self,x)->list:
+        return [torch.as_tensor(p,dtype=x.dtype,device=x.device) for p in self.params]
+
+    def __call__(self,batch):
+        """Apply the chain to a floating point tensor."""
+        if not self.kinds:
+            return batch
+        return chain_function(self.kinds,batch.numel())(batch,self._tensor_params(batch))
+
+    def apply(self,data:ndarray,out:ndarray=None)->ndarray:
+        """Apply the chain to an array with numexpr when it is installed and torch on the cpu otherwise.
+
+        Args:
+            data (ndarray): input array, integer data is processed as float32
+            out (ndarray or None): output array with the shape of data, allocated if None
+
+        Returns:
+            Output array.
+        """
+        data = np.asarray(data)
+        work_dtype = np.result_type(data.dtype,np.float32)
+        out = np.empty(data.shape,dtype=work_dtype) if out is None else out
+        if not self.kinds:
+            out[...] = data
+            return out
+
+        if numexpr is not None:
+            params = {f"p{i}": np.asarray(p,dtype=work_dtype) for i, p in enumerate(self.params)}
+            x = data.astype(work_dtype,copy=False)
+            for expr, clip in _numexpr_expression(self.kinds):
+                result = numexpr.evaluate(expr,local_dict={"x": x,**params},out=out if out.dtype == work_dtype else None,casting="unsafe")
+                if clip is not None:
+                    np.clip(result,params[clip[0]],params[clip[1]],out=result)
+                x = result
+            if x is not out:
+                out[...] = x
+            return out
+
+        tensor = torch.as_tensor(data.astype(work_dtype,copy=False))
+        out[...] = self(tensor).numpy()
+        return out
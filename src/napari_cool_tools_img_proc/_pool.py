@@ -0,0 +1,104 @@
+"""
+This module contains code for applying an operation to all selected layers through a shared worker pool
+"""
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from napari.layers import Image
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import device, torch, viewer
+
+from napari_cool_tools_img_proc._memory import get_memory_budget, memory_budget
+from napari_cool_tools_img_proc._scheduler import (
+    BATCH_PRIORITY,
+    job_priority,
+    pooled_budget,
+)
+from napari_cool_tools_img_proc._streaming import (
+    run_generator,
+    stream_results_to_viewer,
+)
+
+# number of layers processed at the same time, running layers share the memory budget
+POOL_WORKERS = max(min((os.cpu_count() or 1) // 2,4),1)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool()->ThreadPoolExecutor:
+    """Worker pool shared by all multi layer operations."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=POOL_WORKERS,thread_name_prefix="img_proc_pool")
+        return _pool
+
+def selected_images()->list:
+    """Image layers currently selected in the viewer, in layer list order."""
+    return [layer for layer in viewer.layers if layer in viewer.layers.selection and isinstance(layer,Image)]
+
+def apply_to_selected(gen_func,desc:str,**kwargs):
+    """Run a streaming operation over every selected Image layer and add each result as its own layer.
+
+    Args:
+        gen_func (callable): streaming operation generator taking the input layer as img keyword argument
+        desc (str): operation description used for progress and cancellation messages
+        **kwargs: remaining arguments passed to gen_func
+    """
+    layers = selected_images()
+    if not layers:
+        show_info(f"{desc}: no Image layers are selected")
+        return
+    worker = apply_to_layers_thread(gen_func=gen_func,layers=layers,desc=desc,**kwargs)
+    stream_results_to_viewer(worker,desc)
+
+@thread_worker(progress=True)
+def apply_to_layers_thread(gen_func,layers:list,desc:str="",**kwargs):
+    ''''''
+    show_info(f'{desc} thread has started for {len(layers)} layers')
+    yield from iter_apply_to_layers(gen_func,layers,desc,**kwargs)
+    show_info(f'{desc} thread has completed')
+
+def iter_apply_to_layers(gen_func,layers:list,desc:str="",**kwargs):
+    """Run a streaming operation over several layers on the shared pool, yielding results as they complete.
+
+    Every job is queued with BATCH_PRIORITY so interactive operations started meanwhile run first. Once it holds a slot
+    of its backend it runs with the budget divided by the number of jobs of that backend able to run at once, so torch
+    jobs that the scheduler runs one at a time get the whole budget while the pool as a whole stays within it.
+    Closing this generator (cancellation) stops running jobs after their current batch and drops queued ones.
+
+    Args:
+        gen_func (callable): streaming operation generator taking the input layer as img keyword argument
+        layers (list): input Image layers
+        desc (str): operation description used in error notifications
+        **kwargs: remaining arguments passed to gen_func
+
+    Yields:
+        Output layer of every job that completed, in order of completion.
+    """
+    budget = get_memory_budget()
+    cancelled = threading.Event()
+
+    def job(layer):
+        # work done outside a backend slot keeps the conservative share
+        with memory_budget(budget // POOL_WORKERS), pooled_budget(budget,POOL_WORKERS), job_priority(BATCH_PRIORITY):
+            return run_generator(gen_func(img=layer,**kwargs),cancelled)
+
+    futures = {get_pool().submit(job,layer): layer for layer in layers}
+    try:
+        for future in as_completed(futures):
+            try:
+                output = future.result()
+            except (RuntimeError,ValueError,TypeError,MemoryError,OSError) as e:
+                show_info(f"{desc} failed for layer {futures[future].name}: {e}")
+                continue
+            if output is not None:
+                yield output
+    finally:
+        cancelled.set()
+        for future in futures:
+            future.cancel()
+        if torch.device(device).type == "cuda":
+            torch.cuda.empty_cache()
@@ -0,0 +1,168 @@
+"""
+This module contains code for overlapping reading and writing back of data with compute in slice loops
+"""
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from napari.utils.notifications import show_info
+
+from napari_cool_tools_img_proc._profiling import current_profile
+
+# items loaded ahead of and written back behind the item being computed, 0 runs every stage in sequence
+PREFETCH_DEPTH = 1
+
+def configure_prefetch(depth:int=None):
+    """Configure prefetching of slice loops.
+
+    Args:
+        depth (int or None): items loaded ahead and written back behind the one being computed, 0 disables
+                             prefetching
+    """
+    global PREFETCH_DEPTH
+    if depth is not None:
+        assert depth >= 0, "depth must not be negative"
+        PREFETCH_DEPTH = depth
+
+def prefetch_buffers()->int:
+    """Extra items held at once by a prefetching loop, loaded inputs ahead plus results waiting to be written."""
+    return 2 * PREFETCH_DEPTH
+
+class PrefetchExecutor:
+    """Bounded pipeline running the load and store stages of a loop on background threads around its compute stage.
+
+    While item i is computed on the calling thread, up to depth following items are loaded (read and converted) on a
+    loader thread and up to depth previous results are written back on a writer thread, so lazy or disk backed inputs
+    and dtype conversions don't leave the compute idle. Loads and stores each run in submission order. With depth 0
+    loads run when their item is taken and stores right away, like a plain loop.
+    Time every lane is busy is reported when the executor is closed to tell whether a run is I/O or compute bound.
+
+    Args:
+        depth (int or None): items loaded ahead and written back behind, PREFETCH_DEPTH if None
+        desc (str): description used in the utilization message
+    """
+
+    def __init__(self,depth:int=None,desc:str=""):
+        self.depth = PREFETCH_DEPTH if depth is None else depth
+        self.desc = desc
+        self.profile = current_profile()
+        self.busy = {"load": 0.0,"compute": 0.0,"store": 0.0}
+        self.wait = 0.0
+        self.items = 0
+        self._inline = 0.0
+        self._loads = deque()
+        self._stores = deque()
+        self._loader = self._writer = None
+        if self.depth > 0:
+            self._loader = ThreadPoolExecutor(max_workers=1,thread_name_prefix="img_proc_load")
+            self._writer = ThreadPoolExecutor(max_workers=1,thread_name_prefix="img_proc_store")
+        self._start = time.perf_counter()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        self.close(report=exc[0] is None)
+        return False
+
+    def _timed(self,lane:str,func,*args):
+        t0 = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.busy[lane] += time.perf_counter() - t0
+
+    def _inline_timed(self,lane:str,func,*args):
+        t0 = time.perf_counter()
+        try:
+            return self._timed(lane,func,*args)
+        finally:
+            self._inline += time.perf_counter() - t0
+
+    def load(self,key,func,*args):
+        """Queue loading of item key with func(*args), taken later with take(key)."""
+        if self._loader is None:
+            self._loads.append((key,None,func,args))
+        else:
+            self._loads.append((key,self._loader.submit(self._timed,"load",func,*args),func,args))
+
+    def take(self,key):
+        """Result of loading key, the oldest queued load, waiting for it if it is still running."""
+        queued, future, func, args = self._loads.popleft()
+        assert queued == key, f"items must be taken in the order they were loaded, expected {queued} got {key}"
+        if future is None:
+            return self._inline_timed("load",func,*args)
+        t0 = time.perf_counter()
+        try:
+            return future.result()
+        finally:
+            self.wait += time.perf_counter() - t0
+
+    def cancel_loads(self):
+        """Discard all queued loads, e.g. after the item sizes changed, waiting for the one that is running."""
+        while self._loads:
+            _key, future, _func, _args = self._loads.popleft()
+            if future is not None and not future.cancel():
+                # the result of a discarded load, or its error, is not needed
+                wait([future])
+
+    def store(self,key,func,*args)->list:
+        """Queue writing back item key with func(*args).
+
+        Returns:
+            Keys of the items whose stores have completed, in submission order. Waits for the oldest store while more
+            than depth are pending.
+        """
+        self.items += 1
+        if self._writer is None:
+            self._inline_timed("store",func,*args)
+            return [key]
+        self._stores.append((key,self._writer.submit(self._timed,"store",func,*args)))
+        return self._completed(self.depth)
+
+    def drain(self)->list:
+        """Wait for all pending stores, returns the keys of the items they completed."""
+        return self._completed(0)
+
+    def _completed(self,pending:int)->list:
+        done = []
+        while self._stores and (len(self._stores) > pending or self._stores[0][1].done()):
+            key, future = self._stores.popleft()
+            t0 = time.perf_counter()
+            try:
+                future.result()
+            finally:
+                self.wait += time.perf_counter() - t0
+            done.append(key)
+        return done
+
+    def utilization(self)->dict:
+        """Fraction of the wall time every lane was busy so far."""
+        wall = max(time.perf_counter() - self._start,1e-9)
+        self.busy["compute"] = max(wall - self.wait - self._inline,0.0)
+        return {lane: min(busy / wall,1.0) for lane, busy in self.busy.items()}
+
+    def close(self,report:bool=True):
+        """Drop queued loads, finish pending stores and report lane utilization.
+
+        Args:
+            report (bool): report lane utilization and raise the error of the first failed pending store, False when
+                           closing because of another error
+        """
+        self.cancel_loads()
+        # results that were computed are still written back, e.g. into a layer processed in place
+        error = None
+        for _key, future in self._stores:
+            error = error or future.exception()
+        self._stores.clear()
+        for pool in (self._loader,self._writer):
+            if pool is not None:
+                pool.shutdown(wait=True)
+        if report and error is not None:
+            raise error
+        utilization = self.utilization()
+        if self.profile is not None and self.depth > 0:
+            self.profile.add("wait",self.wait)
+        if report and self.items > 1:
+            bound = "compute bound" if utilization["compute"] >= max(utilization["load"],utilization["store"]) else "I/O bound"
+            show_info(f"{self.desc}: load {utilization['load']:.0%}, compute {utilization['compute']:.0%}, store {utilization['store']:.0%} busy ({bound})")
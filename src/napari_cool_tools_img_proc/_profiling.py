@@ -0,0 +1,279 @@
+"""
+This module contains code for profiling image processing operations
+"""
+import csv
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import wraps
+from inspect import isgeneratorfunction
+
+import psutil
+from qtpy.QtCore import QTimer
+from qtpy.QtWidgets import (
+    QFileDialog,
+    QHBoxLayout,
+    QPushButton,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QWidget,
+)
+
+# stages timed by the processing code, other stage names are accepted and reported as extra columns
+STAGES = ("copy","to_tensor","compute","to_host","layer")
+
+# stages moving data between storage, host and device, the rest of an operation's time is compute
+IO_STAGES = ("copy","to_tensor","to_host")
+
+# maximum number of operation records kept in memory
+MAX_RECORDS = 1000
+
+_records = deque(maxlen=MAX_RECORDS)
+_lock = threading.Lock()
+_local = threading.local()
+_enabled = True
+_recorded = 0
+
+def _rss()->int:
+    """Resident set size of this process in bytes."""
+    return psutil.Process().memory_info().rss
+
+class OperationProfile:
+    """Per stage timings, bytes moved, slice throughput and peak RSS recorded for one operation run."""
+
+    def __init__(self,name:str):
+        self.name = name
+        self.start = time.time()
+        self.wall = 0.0
+        self.stages = {}
+        self.bytes_moved = 0
+        self.slices = 0
+        self.peak_rss = _rss()
+        self._lock = threading.Lock()
+
+    def add(self,stage:str,seconds:float,nbytes:int=0,slices:int=0):
+        """Accumulate time spent in a stage.
+
+        Args:
+            stage (str): stage name, one of STAGES or a custom name
+            seconds (float): time spent in the stage
+            nbytes (int): bytes moved by the stage
+            slices (int): slices completed by the stage
+        """
+        rss = _rss()
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage,0.0) + seconds
+            self.bytes_moved += nbytes
+            self.slices += slices
+            self.peak_rss = max(self.peak_rss,rss)
+
+    @property
+    def slices_per_second(self)->float:
+        return self.slices / self.wall if self.wall > 0 else 0.0
+
+    def as_dict(self)->dict:
+        """Flat dictionary representation used for display and export."""
+        record = {
+            "name": self.name,
+            "start": time.strftime("%Y-%m-%d %H:%M:%S",time.localtime(self.start)),
+            "wall_s": round(self.wall,4),
+        }
+        for stage in STAGES:
+            record[f"{stage}_s"] = round(self.stages.get(stage,0.0),4)
+        for stage in sorted(set(self.stages) - set(STAGES)):
+            record[f"{stage}_s"] = round(self.stages[stage],4)
+        # stages overlapped by prefetching run at the same time, so both fractions may be close to 1
+        io = sum(self.stages.get(stage,0.0) for stage in IO_STAGES)
+        compute = self.stages.get("compute",0.0)
+        record["io_util"] = round(io / self.wall,3) if self.wall > 0 else 0.0
+        record["compute_util"] = round(compute / self.wall,3) if self.wall > 0 else 0.0
+        record["bound"] = "io" if io > compute else "compute"
+        record["bytes_moved"] = self.bytes_moved
+        record["slices"] = self.slices
+        record["slices_per_s"] = round(self.slices_per_second,2)
+        record["peak_rss_mb"] = round(self.peak_rss / 2**20,1)
+        return record
+
+def set_profiling(enabled:bool=True):
+    """Enable or disable recording of operation profiles."""
+    global _enabled
+    _enabled = enabled
+
+def current_profile():
+    """Profile of the operation running on the calling thread or None."""
+    return getattr(_local,"profile",None)
+
+@contextmanager
+def profile_operation(name:str):
+    """Record a profile for the enclosed operation.
+
+    Nested calls on the same thread accumulate into the outermost profile.
+
+    Args:
+        name (str): operation name shown in reports
+    """
+    global _recorded
+    if not _enabled:
+        yield None
+        return
+    if current_profile() is not None:
+        _local.depth += 1
+        try:
+            yield current_profile()
+        finally:
+            _local.depth -= 1
+        return
+
+    profile = OperationProfile(name)
+    _local.profile = profile
+    _local.depth = 1
+    t0 = time.perf_counter()
+    try:
+        yield profile
+    finally:
+        profile.wall = time.perf_counter() - t0
+        profile.peak_rss = max(profile.peak_rss,_rss())
+        _local.profile = None
+        _local.depth = 0
+        with _lock:
+            _records.append(profile)
+            _recorded += 1
+
+@contextmanager
+def stage(name:str,nbytes:int=0,slices:int=0,profile:OperationProfile=None):
+    """Time the enclosed block as a stage of the current operation.
+
+    Args:
+        name (str): stage name, one of STAGES or a custom name
+        nbytes (int): bytes moved by the stage
+        slices (int): slices completed by the stage
+        profile (OperationProfile or None): profile to record to, defaults to the one active on this thread
+    """
+    if profile is None:
+        profile = current_profile()
+        # slices finished by nested operations are part of the outer operation's slices
+        if getattr(_local,"depth",0) > 1:
+            slices = 0
+    if profile is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    completed = False
+    try:
+        yield
+        completed = True
+    finally:
+        # work interrupted by an exception (e.g. an allocation failure that is retried) is timed but not counted
+        if completed:
+            profile.add(name,time.perf_counter() - t0,nbytes,slices)
+        else:
+            profile.add(name,time.perf_counter() - t0)
+
+def profiled(name:str):
+    """Decorator recording a profile named name for every call of the decorated function.
+
+    Generator functions are profiled from first to last iteration.
+    """
+    def decorator(func):
+        if isgeneratorfunction(func):
+            @wraps(func)
+            def gen_wrapper(*args,**kwargs):
+                with profile_operation(name):
+                    return (yield from func(*args,**kwargs))
+            return gen_wrapper
+
+        @wraps(func)
+        def wrapper(*args,**kwargs):
+            with profile_operation(name):
+                return func(*args,**kwargs)
+        return wrapper
+    return decorator
+
+def get_profiles()->list:
+    """Recorded operation profiles as a list of dictionaries, oldest first."""
+    with _lock:
+        return [p.as_dict() for p in _records]
+
+def clear_profiles():
+    """Discard all recorded operation profiles."""
+    with _lock:
+        _records.clear()
+
+def export_profiles(path:str):
+    """Write recorded operation profiles to a .json or .csv file.
+
+    Args:
+        path (str): output file path, format is chosen from the extension
+    """
+    records = get_profiles()
+    if str(path).lower().endswith(".csv"):
+        columns = []
+        for record in records:
+            columns.extend(k for k in record if k not in columns)
+        with open(path,"w",newline="") as f:
+            writer = csv.DictWriter(f,fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(records)
+    else:
+        with open(path,"w") as f:
+            json.dump(records,f,indent=2)
+
+class ProfilerWidget(QWidget):
+    """Dock widget listing recorded operation profiles."""
+
+    def __init__(self,napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+        self._shown = -1
+
+        self.table = QTableWidget()
+        refresh_btn = QPushButton("Refresh")
+        clear_btn = QPushButton("Clear")
+        export_btn = QPushButton("Export")
+        refresh_btn.clicked.connect(self.refresh)
+        clear_btn.clicked.connect(self._on_clear)
+        export_btn.clicked.connect(self._on_export)
+
+        buttons = QHBoxLayout()
+        buttons.addWidget(refresh_btn)
+        buttons.addWidget(clear_btn)
+        buttons.addWidget(export_btn)
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(buttons)
+        self.setLayout(layout)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self._poll)
+        self._timer.start(1000)
+        self.refresh()
+
+    def _poll(self):
+        if _recorded != self._shown:
+            self.refresh()
+
+    def refresh(self):
+        records = get_profiles()
+        columns = []
+        for record in records:
+            columns.extend(k for k in record if k not in columns)
+        self.table.clear()
+        self.table.setColumnCount(len(columns))
+        self.table.setRowCount(len(records))
+        self.table.setHorizontalHeaderLabels(columns)
+        for row, record in enumerate(records):
+            for col, key in enumerate(columns):
+                self.table.setItem(row,col,QTableWidgetItem(str(record.get(key,""))))
+        self._shown = _recorded
+
+    def _on_clear(self):
+        clear_profiles()
+        self.refresh()
+
+    def _on_export(self):
+        path, _ = QFileDialog.getSaveFileName(self,"Export profiles","profiles.json","JSON (*.json);;CSV (*.csv)")
+        if path:
+            export_profiles(path)
@@ -0,0 +1,186 @@
+"""
+This module contains code for restricting operations to regions of interest marked by Labels or Shapes layers
+"""
+import inspect
+from functools import wraps
+
+import numpy as np
+from napari.layers import Image, Labels, Layer, Shapes
+from napari.utils.notifications import show_info
+from numpy import ndarray
+from scipy import ndimage
+
+from napari_cool_tools_img_proc._axes import (
+    SPATIAL_DIMS,
+    channel_axis_of,
+    normalize_axis,
+)
+from napari_cool_tools_img_proc._incremental import untracked
+from napari_cool_tools_img_proc._profiling import stage
+from napari_cool_tools_img_proc._streaming import can_process_in_place
+
+
+def roi_mask(roi,shape:tuple)->ndarray:
+    """Boolean mask of the region of interest marked by a Labels or Shapes layer.
+
+    Args:
+        roi (Labels or Shapes): layer whose non zero labels or shapes mark the region of interest
+        shape (tuple): shape of the data without channel axis
+
+    Returns:
+        Mask matching the trailing axes of shape, a mask with fewer axes than shape applies to every slice.
+    """
+    assert isinstance(roi,(Labels,Shapes)), f"Region of interest must be a Labels or Shapes layer, not {type(roi).__name__}"
+    if isinstance(roi,Shapes):
+        ndim = min(roi.ndim,len(shape))
+        mask = np.asarray(roi.to_labels(labels_shape=tuple(shape[len(shape) - ndim:]))) > 0
+    else:
+        mask = np.asarray(roi.data) > 0
+    assert SPATIAL_DIMS <= mask.ndim <= len(shape) and mask.shape == tuple(shape[len(shape) - mask.ndim:]), (
+        f"Region of interest of shape {mask.shape} does not match data of shape {tuple(shape)}")
+    return mask
+
+def _overlap(a:tuple,b:tuple)->bool:
+    return all(x.start < y.stop and y.start < x.stop for x, y in zip(a,b))
+
+def _union(a:tuple,b:tuple)->tuple:
+    return tuple(slice(min(x.start,y.start),max(x.stop,y.stop)) for x, y in zip(a,b))
+
+def roi_boxes(mask:ndarray,shape:tuple,halo:int=0,slice_halo:int=0)->list:
+    """Bounding boxes of the connected regions of a mask grown by halo pixels along the rows and columns and by
+    slice_halo slices along the axis before them.
+
+    Boxes that overlap once grown are merged, so every masked pixel is processed once and lies at least halo pixels
+    (slice_halo slices) inside its box or at the border of the data.
+
+    Args:
+        mask (ndarray): boolean mask matching the trailing axes of shape
+        shape (tuple): shape of the data without channel axis
+        halo (int): pixels of context an output pixel depends on along the rows and columns
+        slice_halo (int): neighbouring slices an output pixel depends on on each side, a mask of 2 dimensions
+                          applies to every slice and needs no slice halo
+
+    Returns:
+        List of tuples of slices, one slice per axis of shape.
+    """
+    lead = tuple(slice(0,n) for n in shape[:len(shape) - mask.ndim])
+    labels, _ = ndimage.label(mask)
+    boxes = []
+    for box in ndimage.find_objects(labels):
+        if box is None:
+            continue
+        grown = tuple(slice(max(s.start - halo,0),min(s.stop + halo,n)) for s, n in zip(box[-SPATIAL_DIMS:],mask.shape[-SPATIAL_DIMS:]))
+        if mask.ndim > SPATIAL_DIMS:
+            s, n = box[-SPATIAL_DIMS - 1], mask.shape[-SPATIAL_DIMS - 1]
+            grown = box[:-SPATIAL_DIMS - 1] + (slice(max(s.start - slice_halo,0),min(s.stop + slice_halo,n)),) + grown
+        boxes.append(lead + grown)
+
+    merged = True
+    while merged:
+        merged = False
+        result = []
+        for box in boxes:
+            for n, other in enumerate(result):
+                if _overlap(box,other):
+                    result[n] = _union(box,other)
+                    merged = True
+                    break
+            else:
+                result.append(box)
+        boxes = result
+    return boxes
+
+def roi_restricted(halo=0,desc:str="",slice_halo=0):
+    """Decorator restricting a streaming operation generator whose first argument is the input Image layer to a region of interest.
+
+    The decorated generator accepts an optional roi keyword argument, a Labels or Shapes layer. Without it the
+    operation runs on the whole input. With it the operation runs once per bounding box of the masked regions grown by
+    halo pixels and slice_halo slices, each box as an input of its own so batching and tiling still apply within it,
+    and its results inside the mask are composited into a copy of the input, or into the input itself if the operation
+    was requested in place. Pixels outside the mask keep their input values, so the cost scales with the area of the
+    region instead of the size of the data.
+    Every box runs through the decorators below this one, so it waits for a scheduler slot and its result may be
+    cached like any other input, but it is started inside untracked() so incremental recomputation neither hashes
+    nor records the temporary box inputs.
+    Results are exact for operations whose output pixels depend on the input within halo pixels and slice_halo
+    slices, operations using statistics of the whole image compute them per box instead.
+
+    Args:
+        halo (int or callable): pixels of context an output pixel depends on along the rows and columns, or a function
+                                of the operation's arguments returning it
+        desc (str): description used in messages
+        slice_halo (int or callable): neighbouring slices an output pixel depends on on each side, or a function of
+                                      the operation's arguments returning it
+    """
+    def decorator(gen_func):
+        signature = inspect.signature(gen_func)
+
+        @wraps(gen_func)
+        def wrapper(*args,roi=None,**kwargs):
+            if roi is None:
+                return (yield from gen_func(*args,**kwargs))
+
+            bound = signature.bind(*args,**kwargs)
+            bound.apply_defaults()
+            params = dict(bound.arguments)
+            img = params.pop("img")
+            data = img.data
+            channel_axis = params.get("channel_axis")
+            channel_axis = normalize_axis(channel_axis_of(img) if channel_axis is None else channel_axis,data.ndim)
+            shape = tuple(n for axis, n in enumerate(data.shape) if axis != channel_axis)
+            pad = int(halo(params) if callable(halo) else halo)
+            slice_pad = int(slice_halo(params) if callable(slice_halo) else slice_halo)
+
+            with stage("mask"):
+                mask = roi_mask(roi,shape)
+                boxes = roi_boxes(mask,shape,pad,slice_pad)
+            if not boxes:
+                show_info(f"{desc}: region of interest {roi.name} is empty, nothing to process")
+                return None
+            covered = sum(int(np.prod([s.stop - s.start for s in box])) for box in boxes) / max(int(np.prod(shape)),1)
+            show_info(f"{desc}: processing {len(boxes)} regions of interest covering {covered:.0%} of {img.name}")
+
+            mask = np.broadcast_to(mask,shape)
+            # the boxes are views of the input, results are only ever written through the composite below
+            if "in_place" in bound.arguments:
+                bound.arguments["in_place"] = False
+            layer = out = None
+            for box in boxes:
+                region = mask[box]
+                if channel_axis is not None:
+                    box = box[:channel_axis] + (slice(None),) + box[channel_axis:]
+                    region = np.expand_dims(region,channel_axis)
+                bound.arguments["img"] = Image(data[box],name=img.name,rgb=getattr(img,"rgb",False))
+                run = gen_func(*bound.args,**bound.kwargs)
+                try:
+                    while True:
+                        try:
+                            with untracked():
+                                next(run)
+                        except StopIteration as e:
+                            sub_layer = e.value
+                            break
+                        if layer is not None:
+                            yield layer
+                finally:
+                    run.close()
+                if sub_layer is None:
+                    return None
+
+                if layer is None:
+                    dtype = sub_layer.data.dtype
+                    if params.get("in_place") and can_process_in_place(data,dtype,desc):
+                        out, layer = data, img
+                    else:
+                        with stage("copy",nbytes=data.nbytes):
+                            out = np.asarray(data).astype(np.result_type(data.dtype,dtype))
+                        with stage("layer"):
+                            layer = Layer.create(out,{"name": f"{sub_layer.name}_ROI"},type(sub_layer).__name__.lower())
+                    yield layer
+                with stage("copy",nbytes=sub_layer.data.nbytes):
+                    np.copyto(out[box],sub_layer.data,where=region)
+                yield layer
+
+            return layer
+        return wrapper
+    return decorator
@@ -0,0 +1,175 @@
+"""
+This module contains code for computing several difference of gaussian bands from one gaussian scale space
+"""
+import math
+
+import numpy as np
+from napari.layers import Image, Layer
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import memory_stats, torch
+from torch.nn import functional as F
+
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._cache import cached
+from napari_cool_tools_img_proc._kernels import (
+    gaussian_kernel1d,
+    truncate_size,
+)
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._streaming import (
+    run_generator,
+    stream_to_viewer,
+)
+from napari_cool_tools_img_proc._sweep import parse_values
+
+# smallest blur in pixels of the current octave before it is downsampled, keeps downsampling free of aliasing
+OCTAVE_SIGMA = 3.0
+
+# octaves stop once the smaller spatial dimension would drop below this many pixels
+MIN_OCTAVE_SIZE = 16
+
+def gaussian_blur_batch(batch,sigma:float,truncate:float=4.0):
+    """Separable gaussian blur of a (B,1,H,W) tensor with reflected borders, sigma 0 returns the input."""
+    if sigma <= 0:
+        return batch
+    kernel = gaussian_kernel1d(truncate_size(sigma,truncate),sigma,batch.dtype,batch.device)
+    radius = len(kernel) // 2
+    mode = "reflect" if radius < min(batch.shape[-2:]) else "replicate"
+    padded = F.pad(batch,(radius,radius,radius,radius),mode=mode)
+    blurred = F.conv2d(padded,kernel.view(1,1,1,-1))
+    return F.conv2d(blurred,kernel.view(1,1,-1,1))
+
+def downsample_batch(batch):
+    """Halve the resolution of a (B,1,H,W) tensor by averaging 2x2 blocks, odd sizes are padded by replication."""
+    pad_h, pad_w = batch.shape[-2] % 2, batch.shape[-1] % 2
+    if pad_h or pad_w:
+        batch = F.pad(batch,(0,pad_w,0,pad_h),mode="replicate")
+    return F.avg_pool2d(batch,2)
+
+def scale_space_bands(batch,sigmas:list,truncate:float=4.0,octaves:bool=False,normalize:bool=True):
+    """Difference of gaussian bands between consecutive sigmas from one cascaded gaussian scale space.
+
+    Every level is computed from the previous one with an incremental blur sqrt(s2^2 - s1^2) instead of blurring
+    the input again, optionally halving the resolution whenever the blur reaches OCTAVE_SIGMA pixels so large sigmas
+    are computed on small images. Levels computed at a lower resolution are upsampled bicubically.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        sigmas (list): increasing standard deviations in pixels of the input, n sigmas give n-1 bands
+        truncate (float): number of standard deviations to filter
+        octaves (bool): downsample by 2 once the blur allows it
+        normalize (bool): map every band of every slice to range 0-1
+
+    Returns:
+        (B,H,W,n-1) tensor, band i is blur(sigmas[i]) - blur(sigmas[i+1]).
+    """
+    height, width = batch.shape[-2:]
+    level = batch.unsqueeze(1)
+    # blur variance accumulated so far and size of a pixel of the current level, both in input pixels
+    variance, scale = 0.0, 1
+    bands = []
+    # previous level at the input resolution, bands subtract levels at full resolution so a band next to an octave
+    # boundary keeps the fine detail of its lower sigma
+    previous = None
+    for sigma in sigmas:
+        step = math.sqrt(max(sigma**2 - variance,0.0))
+        level = gaussian_blur_batch(level,step / scale,truncate)
+        variance = max(variance,sigma**2)
+        full = level if scale == 1 else F.interpolate(level,size=(height,width),mode="bicubic",align_corners=False)
+        if previous is not None:
+            bands.append((previous - full)[:,0])
+        previous = full
+        while octaves and sigma / scale >= OCTAVE_SIGMA and min(level.shape[-2:]) >= 2 * MIN_OCTAVE_SIZE:
+            level = downsample_batch(level)
+            # averaging 2x2 blocks adds the variance of a 2 pixel box filter of the current level
+            variance += 0.25 * scale**2
+            scale *= 2
+
+    bands = torch.stack(bands,dim=-1)
+    if normalize:
+        b_min = bands.amin(dim=(1,2),keepdim=True)
+        b_max = bands.amax(dim=(1,2),keepdim=True)
+        bands = (bands - b_min) / (b_max - b_min)
+    return bands
+
+def diff_of_gaus_bands(img:Image,sigmas:str="1,2,4,8,16,20",truncate:float=4.0,octaves:bool=False,normalize:bool=True):
+    """Band-pass (difference of gaussians) between every pair of consecutive sigmas in a single multi-band layer.
+
+    Args:
+        img (Image): Image/Volume to be filtered.
+        sigmas (str): comma separated increasing standard deviations, n sigmas give n-1 bands
+        truncate (float): number of standard deviations to filter
+        octaves (bool): compute large sigmas on downsampled images, faster at a small loss of accuracy
+        normalize (bool): map every band of every slice to range 0-1
+    """
+    worker = diff_of_gaus_bands_thread(img=img,sigmas=parse_values(sigmas),truncate=truncate,octaves=octaves,normalize=normalize)
+    stream_to_viewer(worker,"Band-pass Scale Space")
+
+@thread_worker(progress=True)
+def diff_of_gaus_bands_thread(img:Image,sigmas:list,truncate:float=4.0,octaves:bool=False,normalize:bool=True)->Layer:
+    ''''''
+    show_info('Band-pass Scale Space thread has started')
+    output = yield from diff_of_gaus_bands_gen(img=img,sigmas=sigmas,truncate=truncate,octaves=octaves,normalize=normalize)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info('Band-pass Scale Space thread has completed')
+    return output
+
+def diff_of_gaus_bands_func(img:Image,sigmas:list,truncate:float=4.0,octaves:bool=False,normalize:bool=True)->Layer:
+    """Non streaming version of diff_of_gaus_bands_gen"""
+    return run_generator(diff_of_gaus_bands_gen(img=img,sigmas=sigmas,truncate=truncate,octaves=octaves,normalize=normalize))
+
+@profiled("Band-pass Scale Space")
+@cached("dog_bands")
+@scheduled("torch","Band-pass Scale Space")
+def diff_of_gaus_bands_gen(img:Image,sigmas:list,truncate:float=4.0,octaves:bool=False,normalize:bool=True):
+    """Streaming multi-band difference of gaussians computed from one cascaded scale space.
+
+    Args:
+        img (Image): Image/Volume to be filtered.
+        sigmas (list): increasing standard deviations, n sigmas give n-1 bands
+        truncate (float): number of standard deviations to filter
+        octaves (bool): compute large sigmas on downsampled images
+        normalize (bool): map every band of every slice to range 0-1
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Image Layer with one band per pair of consecutive sigmas along a new leading axis with '_DoG_bands' suffix
+        added to name, the (low, high) sigma of every band is stored in the layer metadata under 'bands'.
+    """
+    data = img.data
+    sigmas = sorted(float(s) for s in sigmas)
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert len(sigmas) >= 2, "At least 2 sigmas are required"
+        assert sigmas[0] >= 0, "Sigmas must not be negative"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        bands = list(zip(sigmas[:-1],sigmas[1:]))
+        n_bands = len(bands)
+
+        out_data = np.empty((n_bands,) + data.shape,dtype=np.result_type(data.dtype,np.float32))
+        add_kwargs = {"name": f"{img.name}_DoG_bands", "metadata": {"bands": bands}}
+        with stage("layer"):
+            layer = Layer.create(out_data,add_kwargs,"image")
+        yield layer
+
+        def bands_batch(batch):
+            return scale_space_bands(batch,sigmas,truncate,octaves,normalize)
+
+        show_info(f"Band-pass Scale Space: computing {n_bands} bands from {len(sigmas)} levels")
+        radius = max(int(truncate * sigmas[-1] + 0.5),1)
+        # per slice normalization and octave sampling grids depend on the whole slice, tiles would differ
+        halo = None if normalize or octaves else radius
+        for _ in iter_chunks(data,bands_batch,"dog",np.moveaxis(out_data,0,-1),kernel_size=2 * radius + 1,halo=halo,
+                             desc="Band-pass Scale Space",outputs=n_bands,channel_axis=channel_axis_of(img)):
+            yield layer
+
+        return layer
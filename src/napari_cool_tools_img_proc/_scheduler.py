@@ -0,0 +1,284 @@
+"""
+This module contains code for queueing operations and limiting how many run concurrently per backend
+"""
+import inspect
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import torch
+from qtpy.QtCore import QTimer
+from qtpy.QtWidgets import (
+    QFormLayout,
+    QPushButton,
+    QSpinBox,
+    QTableWidget,
+    QTableWidgetItem,
+    QVBoxLayout,
+    QWidget,
+)
+
+from napari_cool_tools_img_proc._memory import memory_budget
+from napari_cool_tools_img_proc._profiling import stage
+
+CPU_COUNT = os.cpu_count() or 1
+
+# operations allowed to run at the same time per backend, torch operations use all cores through intra-op threads
+# while skimage/numpy operations are mostly single threaded
+BACKEND_LIMITS = {"torch": 1, "skimage": max(CPU_COUNT // 2,1)}
+
+# lower values run first, operations started from a widget use INTERACTIVE_PRIORITY and multi layer jobs BATCH_PRIORITY
+INTERACTIVE_PRIORITY = 0
+BATCH_PRIORITY = 10
+
+_local = threading.local()
+
+class Job:
+    """Operation waiting for or holding a slot of its backend."""
+
+    def __init__(self,desc:str,backend:str,priority:int,seq:int):
+        self.desc = desc
+        self.backend = backend
+        self.priority = priority
+        self.seq = seq
+        self.state = "queued"
+        self.submitted = time.time()
+        self.started = None
+
+    def as_dict(self)->dict:
+        now = time.time()
+        return {
+            "job": self.desc,
+            "backend": self.backend,
+            "priority": self.priority,
+            "state": self.state,
+            "waited_s": round((self.started or now) - self.submitted,1),
+            "running_s": round(now - self.started,1) if self.started else 0.0,
+        }
+
+class JobScheduler:
+    """Priority queue granting operations a slot of their backend, at most limits[backend] run at once."""
+
+    def __init__(self,limits:dict=None,torch_threads:int=None):
+        self.limits = dict(BACKEND_LIMITS if limits is None else limits)
+        self.torch_threads = torch_threads
+        self._cond = threading.Condition()
+        self._queued = []
+        self._running = []
+        self._seq = itertools.count()
+
+    def acquire(self,desc:str,backend:str,priority:int=INTERACTIVE_PRIORITY):
+        """Block until the job may run, returns the running Job or None if it was cancelled while queued."""
+        with self._cond:
+            job = Job(desc,backend,priority,next(self._seq))
+            self._queued.append(job)
+            if not self._can_start(job):
+                ahead = sum(1 for j in self._queued + self._running if j.backend == backend and j is not job)
+                show_info(f"{desc} is queued behind {ahead} {backend} job(s)")
+            while job.state == "queued" and not self._can_start(job):
+                self._cond.wait()
+            self._queued.remove(job)
+            self._cond.notify_all()
+            if job.state == "cancelled":
+                return None
+            job.state = "running"
+            job.started = time.time()
+            self._running.append(job)
+            self._apply_thread_policy()
+            return job
+
+    def release(self,job:Job):
+        """Free the slot held by a running job."""
+        with self._cond:
+            job.state = "done"
+            self._running.remove(job)
+            self._apply_thread_policy()
+            self._cond.notify_all()
+
+    def cancel_queued(self):
+        """Cancel all jobs that are still waiting for a slot."""
+        with self._cond:
+            for job in self._queued:
+                job.state = "cancelled"
+            self._cond.notify_all()
+
+    def configure(self,limits:dict=None,torch_threads:int=None):
+        """Change backend limits and the torch thread count, 0 threads restores the automatic policy."""
+        with self._cond:
+            if limits:
+                self.limits.update(limits)
+            if torch_threads is not None:
+                self.torch_threads = torch_threads or None
+            self._apply_thread_policy()
+            self._cond.notify_all()
+
+    def status(self)->list:
+        """Running jobs followed by queued jobs in the order they will start."""
+        with self._cond:
+            queued = sorted(self._queued,key=lambda j: (j.priority,j.seq))
+            return [j.as_dict() for j in self._running + queued]
+
+    def _can_start(self,job:Job)->bool:
+        running = sum(1 for j in self._running if j.backend == job.backend)
+        if running >= self.limits.get(job.backend,1):
+            return False
+        first = min((j for j in self._queued if j.backend == job.backend and j.state == "queued"),key=lambda j: (j.priority,j.seq))
+        return first is job
+
+    def _apply_thread_policy(self):
+        """Split the cores between running skimage jobs and the intra-op threads of running torch jobs."""
+        n_torch = sum(1 for j in self._running if j.backend == "torch")
+        if n_torch == 0:
+            return
+        n_cpu = sum(1 for j in self._running if j.backend != "torch")
+        threads = self.torch_threads or max((CPU_COUNT - n_cpu) // n_torch,1)
+        if torch.get_num_threads() != threads:
+            torch.set_num_threads(threads)
+
+_scheduler = JobScheduler()
+
+def get_scheduler()->JobScheduler:
+    """Scheduler shared by all operations of this plugin."""
+    return _scheduler
+
+@contextmanager
+def job_priority(priority:int):
+    """Queue operations started on the calling thread inside the block with the given priority."""
+    previous = getattr(_local,"priority",None)
+    _local.priority = priority
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+@contextmanager
+def pooled_budget(budget:int,workers:int):
+    """Share budget between jobs started on the calling thread inside the block and the other workers of a pool.
+
+    Once such a job holds its slot it runs with budget divided by the number of jobs of its backend that can run at
+    the same time, the backend limit or workers whichever is lower.
+
+    Args:
+        budget (int): memory budget in bytes shared by the pool
+        workers (int): number of pool workers
+    """
+    previous = getattr(_local,"pool",None)
+    _local.pool = (budget,workers)
+    try:
+        yield
+    finally:
+        _local.pool = previous
+
+@contextmanager
+def job_slot(desc:str,backend:str):
+    """Hold a slot of backend for the enclosed block, yields False if the job was cancelled while queued.
+
+    Nested slots on the same thread reuse the outer slot. Inside pooled_budget the block runs with the job's share of
+    the pool budget.
+    """
+    if getattr(_local,"job",None) is not None:
+        yield True
+        return
+    priority = getattr(_local,"priority",None)
+    with stage("queue"):
+        job = _scheduler.acquire(desc,backend,INTERACTIVE_PRIORITY if priority is None else priority)
+    if job is None:
+        yield False
+        return
+    _local.job = job
+    pool = getattr(_local,"pool",None)
+    if pool is None:
+        share = nullcontext()
+    else:
+        budget, workers = pool
+        share = memory_budget(budget // max(min(workers,_scheduler.limits.get(backend,1)),1))
+    try:
+        with share:
+            yield True
+    finally:
+        _local.job = None
+        _scheduler.release(job)
+
+def scheduled(backend,desc:str=None):
+    """Decorator running a streaming operation generator only once its backend has a free slot.
+
+    Args:
+        backend (str or callable): 'torch' or 'skimage', or a function of the bound arguments dictionary returning one
+        desc (str or None): job description shown in the queue, defaults to the function name
+    """
+    def decorator(gen_func):
+        signature = inspect.signature(gen_func)
+        name = desc or gen_func.__name__
+
+        @wraps(gen_func)
+        def wrapper(*args,**kwargs):
+            job_backend = backend
+            if callable(backend):
+                bound = signature.bind(*args,**kwargs)
+                bound.apply_defaults()
+                job_backend = backend(bound.arguments)
+            with job_slot(name,job_backend) as granted:
+                if not granted:
+                    return None
+                return (yield from gen_func(*args,**kwargs))
+        return wrapper
+    return decorator
+
+class QueueWidget(QWidget):
+    """Dock widget showing running and queued jobs and the scheduler limits."""
+
+    def __init__(self,napari_viewer):
+        super().__init__()
+        self.viewer = napari_viewer
+
+        self.table = QTableWidget()
+        self.torch_jobs = QSpinBox()
+        self.torch_jobs.setRange(1,CPU_COUNT)
+        self.torch_jobs.setValue(_scheduler.limits["torch"])
+        self.skimage_jobs = QSpinBox()
+        self.skimage_jobs.setRange(1,CPU_COUNT)
+        self.skimage_jobs.setValue(_scheduler.limits["skimage"])
+        self.torch_threads = QSpinBox()
+        self.torch_threads.setRange(0,CPU_COUNT)
+        self.torch_threads.setSpecialValueText("auto")
+        self.torch_threads.setValue(_scheduler.torch_threads or 0)
+        for spin in (self.torch_jobs,self.skimage_jobs,self.torch_threads):
+            spin.valueChanged.connect(self._on_configure)
+        cancel_btn = QPushButton("Cancel queued")
+        cancel_btn.clicked.connect(_scheduler.cancel_queued)
+
+        form = QFormLayout()
+        form.addRow("torch jobs",self.torch_jobs)
+        form.addRow("skimage jobs",self.skimage_jobs)
+        form.addRow("torch threads",self.torch_threads)
+        layout = QVBoxLayout()
+        layout.addWidget(self.table)
+        layout.addLayout(form)
+        layout.addWidget(cancel_btn)
+        self.setLayout(layout)
+
+        self._timer = QTimer(self)
+        self._timer.timeout.connect(self.refresh)
+        self._timer.start(500)
+        self.refresh()
+
+    def refresh(self):
+        jobs = _scheduler.status()
+        columns = ["job","backend","priority","state","waited_s","running_s"]
+        self.table.clear()
+        self.table.setColumnCount(len(columns))
+        self.table.setRowCount(len(jobs))
+        self.table.setHorizontalHeaderLabels(columns)
+        for row, job in enumerate(jobs):
+            for col, key in enumerate(columns):
+                self.table.setItem(row,col,QTableWidgetItem(str(job[key])))
+
+    def _on_configure(self):
+        _scheduler.configure(
+            limits={"torch": self.torch_jobs.value(),"skimage": self.skimage_jobs.value()},
+            torch_threads=self.torch_threads.value(),
+        )
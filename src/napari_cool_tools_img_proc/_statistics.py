@@ -0,0 +1,181 @@
+"""
+This module contains code for streaming approximate quantile statistics of large or lazily loaded data
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from numpy import ndarray
+
+from napari_cool_tools_img_proc._memory import get_memory_budget
+from napari_cool_tools_img_proc._profiling import stage
+
+# relative error of streamed quantiles, a quantile q is within 0.1% of a value whose rank is q
+RELATIVE_ACCURACY = 0.001
+
+# magnitudes below this are counted as zero
+MIN_MAGNITUDE = 1e-30
+
+class _BucketStore:
+    """Counts of contiguous integer bucket keys held in an array that grows to cover new keys."""
+
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0,dtype=np.int64)
+
+    def add(self,keys:ndarray,counts:ndarray=None):
+        if keys.size == 0:
+            return
+        k_min, k_max = int(keys.min()), int(keys.max())
+        if self.counts.size == 0:
+            self.offset, self.counts = k_min, np.zeros(k_max - k_min + 1,dtype=np.int64)
+        elif k_min < self.offset or k_max >= self.offset + self.counts.size:
+            lo, hi = min(k_min,self.offset), max(k_max + 1,self.offset + self.counts.size)
+            grown = np.zeros(hi - lo,dtype=np.int64)
+            grown[self.offset - lo:self.offset - lo + self.counts.size] = self.counts
+            self.offset, self.counts = lo, grown
+        self.counts += np.bincount(keys - self.offset,weights=counts,minlength=self.counts.size).astype(np.int64)
+
+    def merge(self,other:"_BucketStore"):
+        nonzero = np.flatnonzero(other.counts)
+        self.add(nonzero + other.offset,other.counts[nonzero])
+
+    def keys(self)->ndarray:
+        return np.arange(self.offset,self.offset + self.counts.size)
+
+class QuantileSketch:
+    """Mergeable streaming quantile sketch with relative accuracy guarantees (DDSketch).
+
+    Values are counted in logarithmically spaced buckets, so a few outliers far from the bulk of the data cost a
+    few extra buckets instead of stretching the resolution of every bucket like a linear histogram would. Memory is
+    bounded by the dynamic range of the data, not its size, and sketches of different chunks can be merged which
+    lets parallel workers build partial sketches.
+
+    Args:
+        relative_accuracy (float): maximum relative error of returned quantiles
+    """
+
+    def __init__(self,relative_accuracy:float=RELATIVE_ACCURACY):
+        assert 0 < relative_accuracy < 1, "relative_accuracy must be in range (0,1)"
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        self.positive = _BucketStore()
+        self.negative = _BucketStore()
+        self.zeros = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.total = 0
+
+    def _keys(self,magnitudes:ndarray)->ndarray:
+        return np.ceil(np.log(magnitudes) / self.log_gamma).astype(np.int64)
+
+    def update(self,values):
+        """Add values of any shape, NaNs are ignored and infinite values only set the min and max."""
+        values = np.asarray(values).ravel()
+        if np.issubdtype(values.dtype,np.floating):
+            infinite = np.isinf(values)
+            if infinite.any():
+                self.min, self.max = min(self.min,float(values[infinite].min())), max(self.max,float(values[infinite].max()))
+            values = values[np.isfinite(values)]
+        if values.size == 0:
+            return self
+        values = values.astype(np.float64,copy=False)
+        positive, negative = values > MIN_MAGNITUDE, values < -MIN_MAGNITUDE
+        self.positive.add(self._keys(values[positive]))
+        self.negative.add(self._keys(-values[negative]))
+        self.zeros += int(values.size - positive.sum() - negative.sum())
+        self.min, self.max = min(self.min,float(values.min())), max(self.max,float(values.max()))
+        self.total += values.size
+        return self
+
+    def merge(self,other:"QuantileSketch"):
+        """Add the values counted by another sketch of the same relative accuracy."""
+        assert np.isclose(self.gamma,other.gamma), "Only sketches of the same relative accuracy can be merged"
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zeros += other.zeros
+        self.min, self.max = min(self.min,other.min), max(self.max,other.max)
+        self.total += other.total
+        return self
+
+    def quantile(self,q):
+        """Approximate quantile(s) q in [0,1], 0 and 1 give the exact min and max."""
+        assert self.total > 0, "Sketch is empty"
+        q = np.asarray(q,dtype=np.float64)
+        # buckets in ascending order of value: negatives from the largest magnitude, zeros, positives
+        neg_keys, pos_keys = self.negative.keys()[::-1], self.positive.keys()
+        values = np.concatenate((-2 * self.gamma ** neg_keys / (self.gamma + 1),[0.0],2 * self.gamma ** pos_keys / (self.gamma + 1)))
+        counts = np.concatenate((self.negative.counts[::-1],[self.zeros],self.positive.counts))
+        cumulative = np.cumsum(counts)
+        index = np.searchsorted(cumulative,q * (self.total - 1),side="right")
+        result = np.clip(values[np.minimum(index,len(values) - 1)],self.min,self.max)
+        result = np.where(q <= 0,self.min,np.where(q >= 1,self.max,result))
+        return float(result) if result.ndim == 0 else result
+
+def iter_blocks(data,budget:int=None):
+    """Yield in memory blocks of data along axis 0 sized to the memory budget, reading lazy arrays (dask, zarr,
+    memory maps) one block at a time.
+    """
+    if data.ndim <= 2:
+        yield np.asarray(data)
+        return
+    budget = get_memory_budget() if budget is None else budget
+    item_bytes = int(np.prod(data.shape[1:])) * max(np.dtype(data.dtype).itemsize,8)
+    step = int(max(min(budget // max(item_bytes * 2,1),data.shape[0]),1))
+    for start in range(0,data.shape[0],step):
+        with stage("copy"):
+            block = np.asarray(data[start:start + step])
+        yield block
+
+def compute_sketch(data,relative_accuracy:float=RELATIVE_ACCURACY,workers:int=1)->QuantileSketch:
+    """Quantile sketch of data computed in one streaming pass.
+
+    Args:
+        data (array like): ndarray or lazy array supporting slicing along axis 0
+        relative_accuracy (float): maximum relative error of quantiles
+        workers (int): threads building partial sketches of interleaved blocks that are merged at the end
+
+    Returns:
+        QuantileSketch of all values.
+    """
+    if workers <= 1 or data.ndim <= 2:
+        sketch = QuantileSketch(relative_accuracy)
+        for block in iter_blocks(data):
+            with stage("compute"):
+                sketch.update(block)
+        return sketch
+
+    def partial(worker:int):
+        sketch = QuantileSketch(relative_accuracy)
+        for block in iter_blocks(data[worker::workers],get_memory_budget() // workers):
+            sketch.update(block)
+        return sketch
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        partials = list(pool.map(partial,range(workers)))
+    sketch = QuantileSketch(relative_accuracy)
+    for p in partials:
+        sketch.merge(p)
+    return sketch
+
+def value_range(data,low_quantile:float=0.0,high_quantile:float=1.0,relative_accuracy:float=RELATIVE_ACCURACY)->tuple:
+    """Bounds for normalizing data, the exact minimum and maximum or robust quantiles ignoring outliers.
+
+    Args:
+        data (array like): ndarray or lazy array supporting slicing along axis 0
+        low_quantile (float): quantile used as lower bound, 0 for the minimum
+        high_quantile (float): quantile used as upper bound, 1 for the maximum
+        relative_accuracy (float): maximum relative error of quantiles
+
+    Returns:
+        (low, high) bounds as floats.
+    """
+    assert 0 <= low_quantile < high_quantile <= 1, "Quantiles must satisfy 0 <= low_quantile < high_quantile <= 1"
+    if low_quantile == 0 and high_quantile == 1:
+        if isinstance(data,np.ndarray):
+            return float(data.min()), float(data.max())
+        low, high = np.inf, -np.inf
+        for block in iter_blocks(data):
+            low, high = min(low,float(block.min())), max(high,float(block.max()))
+        return low, high
+    low, high = compute_sketch(data,relative_accuracy).quantile([low_quantile,high_quantile])
+    return float(low), float(high)
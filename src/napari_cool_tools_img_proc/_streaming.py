@@ -0,0 +1,198 @@
+"""
+This module contains code for streaming partial results of long running operations into the viewer
+"""
+import time
+
+import numpy as np
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import device, torch, viewer
+from numpy import ndarray
+from tqdm import tqdm
+
+from napari_cool_tools_img_proc._axes import BatchView
+from napari_cool_tools_img_proc._prefetch import PrefetchExecutor
+from napari_cool_tools_img_proc._profiling import current_profile, stage
+from napari_cool_tools_img_proc._scheduler import get_scheduler
+
+# minimum number of seconds between two refreshes of a layer that is being filled
+REFRESH_INTERVAL = 0.25
+
+# streaming workers that have been started and have not finished yet
+_running = set()
+
+def iter_slices(data:ndarray,slice_func,out:ndarray,desc:str="",channel_axis:int=None):
+    """Apply a 2D function to every slice of an image/volume, yielding as slices complete.
+
+    Args:
+        data (ndarray): 2D image or stack of 2D slices with any number of leading batch axes
+        slice_func (callable): function mapping a 2D ndarray to a 2D ndarray of the same shape
+        out (ndarray): output array with the same shape as data, may be data itself
+        desc (str): description used for progress messages
+        channel_axis (int or None): axis of data holding color channels, every channel is processed as its own slice
+
+    Yields:
+        (start, stop) range of slices of the flattened stack that have been written to out, reading the next slice
+        and writing back the previous one overlap the current slice's computation.
+    """
+    if data.ndim == 2:
+        with stage("compute",slices=1):
+            out[...] = slice_func(data)
+        yield 0, 1
+        return
+
+    stack, stack_out = BatchView(data,channel_axis), BatchView(out,channel_axis)
+    n_slices = len(stack)
+    profile = current_profile()
+
+    def load(i):
+        with stage("copy",profile=profile):
+            return np.asarray(stack[i])
+
+    def store(i,result):
+        with stage("copy",profile=profile):
+            stack_out[i] = result
+
+    with tqdm(total=n_slices,desc=desc) as pbar, PrefetchExecutor(desc=desc) as executor:
+        executor.load(0,load,0)
+        for i in range(n_slices):
+            # the next slice is read while this one computes and the previous one is written back
+            if i + 1 < n_slices:
+                executor.load(i + 1,load,i + 1)
+            image = executor.take(i)
+            with stage("compute",slices=1):
+                result = slice_func(image)
+            completed = executor.store(i,store,i,result)
+            if i + 1 == n_slices:
+                completed += executor.drain()
+            for j in completed:
+                pbar.update(1)
+                yield j, j + 1
+
+def can_process_in_place(data,dtype,desc:str="")->bool:
+    """Check whether results of dtype can be written into data itself.
+
+    Args:
+        data (ndarray): input data of the layer
+        dtype (np.dtype): dtype of the operation's results
+        desc (str): description used in the message shown when a new layer has to be created instead
+
+    Returns:
+        True if data is a writeable in memory array that can hold dtype values.
+    """
+    if isinstance(data,np.ndarray) and data.flags.writeable and np.can_cast(dtype,data.dtype,casting="same_kind"):
+        return True
+    show_info(f"{desc}: in-place processing needs writeable {np.dtype(dtype)} data, creating a new layer instead")
+    return False
+
+def run_generator(gen,cancelled=None):
+    """Run a streaming generator to completion and return its return value.
+
+    Args:
+        gen (generator): streaming operation generator
+        cancelled (threading.Event or None): if set between two batches the generator is closed and None is returned
+    """
+    while True:
+        if cancelled is not None and cancelled.is_set():
+            gen.close()
+            return None
+        try:
+            next(gen)
+        except StopIteration as e:
+            return e.value
+
+def stream_to_viewer(worker,desc:str=""):
+    """Connect a streaming thread worker to the viewer and start it.
+
+    The worker's generator yields its preallocated output layer first and again after every completed batch.
+    The layer is added to the viewer on the first yield and refreshed (at most every REFRESH_INTERVAL seconds)
+    afterwards. If the worker is cancelled the partially filled layer is removed so its memory can be released.
+    Layers that are already in the viewer (updated in place) are refreshed once when the worker finishes and are
+    never removed, slices processed before a cancellation keep their new values.
+
+    Args:
+        worker (GeneratorWorker): worker created by a generator function decorated with thread_worker
+        desc (str): operation description used in the cancellation message
+
+    Returns:
+        The started worker.
+    """
+    state = {"layer": None, "refreshed": 0.0, "existing": False}
+
+    def on_yielded(layer):
+        if state["layer"] is None:
+            state["layer"] = layer
+            state["existing"] = layer in viewer.layers
+            if not state["existing"]:
+                viewer.add_layer(layer)
+        elif not state["existing"] and time.perf_counter() - state["refreshed"] > REFRESH_INTERVAL:
+            layer.refresh()
+        state["refreshed"] = time.perf_counter()
+
+    def on_returned(layer):
+        if layer is None:
+            return
+        if state["layer"] is None and layer not in viewer.layers:
+            viewer.add_layer(layer)
+        else:
+            layer.refresh()
+        state["layer"] = None
+
+    def on_aborted():
+        layer = state["layer"]
+        state["layer"] = None
+        if layer is not None and state["existing"]:
+            layer.refresh()
+        elif layer is not None and layer in viewer.layers:
+            viewer.layers.remove(layer)
+        del layer
+        if torch.device(device).type == "cuda":
+            torch.cuda.empty_cache()
+        show_info(f"{desc} was cancelled")
+
+    worker.yielded.connect(on_yielded)
+    worker.returned.connect(on_returned)
+    worker.aborted.connect(on_aborted)
+    worker.finished.connect(lambda: _running.discard(worker))
+    _running.add(worker)
+    worker.start()
+
+    return worker
+
+def stream_results_to_viewer(worker,desc:str=""):
+    """Connect a thread worker that yields finished result layers to the viewer and start it.
+
+    Every yielded layer is added to the viewer as soon as it arrives, layers already in the viewer (processed in
+    place) are refreshed instead.
+
+    Args:
+        worker (GeneratorWorker): worker created by a generator function decorated with thread_worker
+        desc (str): operation description used in the cancellation message
+
+    Returns:
+        The started worker.
+    """
+    def on_yielded(layer):
+        if layer in viewer.layers:
+            layer.refresh()
+        else:
+            viewer.add_layer(layer)
+
+    worker.yielded.connect(on_yielded)
+    worker.aborted.connect(lambda: show_info(f"{desc} was cancelled"))
+    worker.finished.connect(lambda: _running.discard(worker))
+    _running.add(worker)
+    worker.start()
+
+    return worker
+
+def cancel_operations():
+    """Request cancellation of all running streaming operations.
+
+    Workers stop after the batch they are currently processing and their partial output layers are removed.
+    Operations still waiting in the job queue are cancelled before they start.
+    """
+    get_scheduler().cancel_queued()
+    if not _running:
+        show_info("No operations are running")
+    for worker in list(_running):
+        worker.quit()
@@ -0,0 +1,229 @@
+"""
+This module contains code for evaluating a grid of parameter settings in a single batched pass
+"""
+import itertools
+
+import numpy as np
+from napari.layers import Image, Layer
+from napari.qt.threading import thread_worker
+from napari.utils.notifications import show_info
+from napari_cool_tools_io import memory_stats, torch
+from torch.nn import functional as F
+
+from napari_cool_tools_img_proc._axes import SPATIAL_DIMS, channel_axis_of
+from napari_cool_tools_img_proc._filters import KnBorderType
+from napari_cool_tools_img_proc._kernels import (
+    gaussian_kernel1d,
+    torchvision_sigma,
+)
+from napari_cool_tools_img_proc._memory import iter_chunks
+from napari_cool_tools_img_proc._normalization import (
+    normalize_in_range_pt_func,
+)
+from napari_cool_tools_img_proc._profiling import profiled, stage
+from napari_cool_tools_img_proc._scheduler import scheduled
+from napari_cool_tools_img_proc._streaming import (
+    run_generator,
+    stream_to_viewer,
+)
+
+
+def parse_values(text:str,value_type=float)->list:
+    """Parse a comma separated list of parameter values e.g. '1, 2.5, 4'."""
+    return [value_type(v) for v in str(text).replace(";",",").split(",") if v.strip()]
+
+def parameter_grid(**values)->list:
+    """Every combination of the given parameter values as a list of dictionaries."""
+    names = list(values)
+    return [dict(zip(names,combo)) for combo in itertools.product(*values.values())]
+
+def stack_kernels(kernels:list)->torch.Tensor:
+    """Stack 1D kernels of different (odd) lengths into a (K,kmax) tensor, centered and zero padded."""
+    k_max = max(len(k) for k in kernels)
+    stacked = torch.zeros((len(kernels),k_max),dtype=kernels[0].dtype,device=kernels[0].device)
+    for i, k in enumerate(kernels):
+        offset = (k_max - len(k)) // 2
+        stacked[i,offset:offset + len(k)] = k
+    return stacked
+
+def stacked_gaussian_blur(batch,kernels:torch.Tensor,border_type:str='reflect',separable:bool=True):
+    """Blur every slice of a batch with several gaussian kernels at once.
+
+    Kernels are stacked along the channel dimension so the input is padded once and all blurs are computed by
+    the same convolution call.
+
+    Args:
+        batch (torch.Tensor): (B,H,W) tensor of B-scans
+        kernels (torch.Tensor): (K,kmax) stacked 1D kernels from stack_kernels
+        border_type (str): padding mode applied prior to convolution 'constant', 'reflect', 'replicate' or 'circular'
+        separable (bool): run as composition of 2 1D convolutions
+
+    Returns:
+        (B,K,H,W) tensor holding one blurred copy of the batch per kernel
+    """
+    n_kernels, k_max = kernels.shape
+    pad = k_max // 2
+    kernels = kernels.to(batch.dtype)
+    padded = F.pad(batch.unsqueeze(1),(pad,pad,pad,pad),mode=border_type)
+    if separable:
+        blurred = F.conv2d(padded,kernels.view(n_kernels,1,1,k_max))
+        return F.conv2d(blurred,kernels.view(n_kernels,1,k_max,1),groups=n_kernels)
+
+    kernels_2d = kernels[:,:,None] * kernels[:,None,:]
+    return F.conv2d(padded,kernels_2d.unsqueeze(1))
+
+def torchvision_gaussian_kernel1d(kernel_size:int)->torch.Tensor:
+    """1D gaussian kernel matching torchvision gaussian_blur when sigma is derived from the kernel size."""
+    return gaussian_kernel1d(kernel_size,torchvision_sigma(kernel_size))
+
+def gaussian_blur_sweep(img:Image,kernel_sizes:str="3,5,7",sigmas:str="1.0,2.0",border_type:KnBorderType=KnBorderType.reflect,separable:bool=True):
+    """Gaussian blur evaluated for every combination of kernel size and sigma.
+
+    Args:
+        img (Image): Image/Volume to be blurred.
+        kernel_sizes (str): comma separated odd kernel sizes
+        sigmas (str): comma separated standard deviations of the kernel
+        border_type (KnBorderType(Enum)): padding mode applied prior to convolution options = 'constant', 'reflect', 'replicate' or 'circular'
+        separable (bool): run as composition of 2 1D convolutions
+    """
+    settings = parameter_grid(kernel_size=parse_values(kernel_sizes,int),sigma=parse_values(sigmas))
+    worker = sweep_thread(img=img,op="gaussian_blur",settings=settings,border_type=border_type.value,separable=separable)
+    stream_to_viewer(worker,"Gaussian Blur Sweep")
+
+def sharpen_um_sweep(img:Image,kernel_sizes:str="3,5,7",sigmas:str="1.0,2.0"):
+    """Unsharp mask evaluated for every combination of kernel size and sigma.
+
+    Args:
+        img (Image): Image/Volume to be sharpened.
+        kernel_sizes (str): comma separated odd kernel sizes
+        sigmas (str): comma separated standard deviations of the blur kernel
+    """
+    settings = parameter_grid(kernel_size=parse_values(kernel_sizes,int),sigma=parse_values(sigmas))
+    worker = sweep_thread(img=img,op="unsharp",settings=settings)
+    stream_to_viewer(worker,"Unsharp Mask Sweep")
+
+def diff_of_gaus_sweep(img:Image,low_sigmas:str="1.0,2.0",high_sigmas:str="10.0,20.0",truncate:float=4.0):
+    """Band-pass (difference of gaussians) evaluated for every combination of low and high sigma.
+
+    Args:
+        img (Image): Image/Volume to be filtered.
+        low_sigmas (str): comma separated standard deviations for lower intensity gaussian filter
+        high_sigmas (str): comma separated standard deviations for higher intensity gaussian filter
+        truncate (float): number of standard deviations to filter
+    """
+    settings = parameter_grid(low_sigma=parse_values(low_sigmas),high_sigma=parse_values(high_sigmas))
+    worker = sweep_thread(img=img,op="dog",settings=settings,truncate=truncate)
+    stream_to_viewer(worker,"Band-pass Sweep")
+
+def clahe_sweep(img:Image,clip_limits:str="10,20,40",norm_min:float=0,norm_max:float=1):
+    """Kornia CLAHE evaluated for every clip limit.
+
+    Args:
+        img (Image): Image/Volume to be equalized.
+        clip_limits (str): comma separated clip limits
+        norm_min (float): minimum of the range the data is normalized to before equalization
+        norm_max (float): maximum of the range the data is normalized to before equalization
+    """
+    settings = parameter_grid(clip_limit=parse_values(clip_limits))
+    worker = sweep_thread(img=img,op="clahe",settings=settings,norm_min=norm_min,norm_max=norm_max)
+    stream_to_viewer(worker,"CLAHE Sweep")
+
+@thread_worker(progress=True)
+def sweep_thread(img:Image,op:str,settings:list,**kwargs)->Layer:
+    ''''''
+    show_info('Parameter sweep thread has started')
+    output = yield from sweep_gen(img=img,op=op,settings=settings,**kwargs)
+    torch.cuda.empty_cache()
+    memory_stats()
+    show_info('Parameter sweep thread has completed')
+    return output
+
+def sweep_func(img:Image,op:str,settings:list,**kwargs)->Layer:
+    """Non streaming version of sweep_gen"""
+    return run_generator(sweep_gen(img=img,op=op,settings=settings,**kwargs))
+
+@profiled("Parameter Sweep")
+@scheduled("torch","Parameter Sweep")
+def sweep_gen(img:Image,op:str,settings:list,border_type:str='reflect',separable:bool=True,truncate:float=4.0,norm_min:float=0,norm_max:float=1):
+    """Evaluate an operation for a list of parameter settings loading each batch of the input only once.
+
+    Args:
+        img (Image): Image/Volume to be processed.
+        op (str): 'gaussian_blur', 'unsharp', 'dog' or 'clahe'
+        settings (list): parameter dictionaries, keys kernel_size and sigma (gaussian_blur, unsharp),
+                         low_sigma and high_sigma (dog) or clip_limit (clahe)
+        border_type (str): padding mode used by gaussian_blur
+        separable (bool): run gaussian_blur as composition of 2 1D convolutions
+        truncate (float): number of standard deviations to filter used by dog
+        norm_min (float): minimum of the range the data is normalized to before clahe
+        norm_max (float): maximum of the range the data is normalized to before clahe
+
+    Yields:
+        Output layer, first when it is allocated and again after every completed batch of slices.
+
+    Returns:
+        Image Layer with one entry along a new leading axis per setting with '_<op>_sweep' suffix added to name,
+        the settings are stored in the layer metadata under 'sweep'.
+    """
+    from kornia.enhance import equalize_clahe
+
+    data = img.data
+
+    try:
+        assert data.ndim >= SPATIAL_DIMS, "Only works for data of at least 2 dimensions"
+        assert len(settings) > 0, "At least one parameter setting is required"
+    except AssertionError as e:
+        print("An error Occured:", str(e))
+    else:
+        n_settings = len(settings)
+
+        if op in ("gaussian_blur","unsharp"):
+            kernels = stack_kernels([gaussian_kernel1d(s["kernel_size"],s["sigma"]) for s in settings])
+            kernel_size = kernels.shape[1]
+            border = border_type if op == "gaussian_blur" else "reflect"
+
+            def sweep_batch(batch):
+                blurred = stacked_gaussian_blur(batch,kernels,border,separable or op == "unsharp")
+                if op == "unsharp":
+                    blurred = 2 * batch.unsqueeze(1) - blurred
+                return blurred.permute(0,2,3,1)
+
+        elif op == "dog":
+            # every distinct kernel is computed once even if it is shared by several settings
+            sizes = sorted({2 * round(truncate * s[k]) + 1 for s in settings for k in ("low_sigma","high_sigma")})
+            index = {size: i for i, size in enumerate(sizes)}
+            kernels = stack_kernels([torchvision_gaussian_kernel1d(size) for size in sizes])
+            kernel_size = kernels.shape[1]
+            low = [index[2 * round(truncate * s["low_sigma"]) + 1] for s in settings]
+            high = [index[2 * round(truncate * s["high_sigma"]) + 1] for s in settings]
+
+            def sweep_batch(batch):
+                blurred = stacked_gaussian_blur(batch,kernels,"reflect",True)
+                diff_gaus = blurred[:,low] - blurred[:,high]
+                d_min = diff_gaus.amin(dim=(-2,-1),keepdim=True)
+                d_max = diff_gaus.amax(dim=(-2,-1),keepdim=True)
+                return ((diff_gaus - d_min) / (d_max - d_min)).permute(0,2,3,1)
+
+        elif op == "clahe":
+            data = normalize_in_range_pt_func(img,norm_min,norm_max,in_place=False).data
+            kernel_size = 1
+
+            def sweep_batch(batch):
+                batch = batch.unsqueeze(1)
+                return torch.cat([equalize_clahe(batch,s["clip_limit"]) for s in settings],dim=1).permute(0,2,3,1)
+
+        else:
+            raise ValueError(f"Parameter sweep is not available for operation {op}")
+
+        out_data = np.empty((n_settings,) + data.shape,dtype=np.result_type(data.dtype,np.float32))
+        add_kwargs = {"name": f"{img.name}_{op}_sweep", "metadata": {"sweep": settings}}
+        with stage("layer"):
+            layer = Layer.create(out_data,add_kwargs,"image")
+        yield layer
+
+        show_info(f"Parameter sweep: evaluating {n_settings} settings of {op}")
+        halo = None if op == "clahe" else kernel_size // 2
+        for _ in iter_chunks(data,sweep_batch,op,np.moveaxis(out_data,0,-1),kernel_size=kernel_size,halo=halo,desc=f"{op} sweep",outputs=n_settings,channel_axis=channel_axis_of(img)):
+            yield layer
+
+        return layer
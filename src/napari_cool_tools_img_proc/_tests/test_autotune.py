@@ -0,0 +1,109 @@
+import json
+import time
+
+import numpy as np
+import pytest
+
+from napari_cool_tools_img_proc import _autotune
+from napari_cool_tools_img_proc._autotune import (
+    Autotuner,
+    autotune_report,
+    configure_autotune,
+    param_class,
+    select_backend,
+    size_class,
+    tune_key,
+)
+
+
+@pytest.fixture
+def tuner(tmp_path,monkeypatch):
+    tuner = Autotuner(str(tmp_path / "tune" / "autotune.json"))
+    monkeypatch.setattr(_autotune,"_tuner",tuner)
+    return tuner
+
+
+class Candidate:
+    """Candidate counting its calls and taking delay seconds per call."""
+
+    def __init__(self,delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    def __call__(self,sample):
+        self.calls += 1
+        time.sleep(self.delay)
+        return sample
+
+
+def test_bucketing():
+    assert [size_class(n) for n in (1,2,3,500,512,513)] == [1,2,4,512,512,1024]
+    assert param_class(9) == param_class(11) == 8 and param_class(12) == param_class(16) == 16
+    assert param_class(True) == "True" and param_class("reflect") == "reflect" and param_class(0) == 0
+
+    data = np.zeros((20,500,300),np.float32)
+    key = tune_key("dog",data,{"high_sigma": 9.0})
+    assert key.startswith("dog|512x512|n32|float32|high_sigma=8|")
+    # shapes and parameters in the same buckets share a decision
+    assert tune_key("dog",np.zeros((30,400,260),np.float32),{"high_sigma": 11.0}) == key
+    assert tune_key("dog",data,{"high_sigma": 20.0}) != key
+    assert tune_key("dog",data.astype(np.uint8),{"high_sigma": 9.0}) != key
+    # a channel axis is part of the batch, not of the slice size
+    assert tune_key("dog",np.zeros((500,300,3),np.float32),channel_axis=-1).startswith("dog|512x512|n4|")
+
+
+def test_decisions_persist(tuner):
+    data = np.zeros((4,32,32),np.float32)
+    slow, fast = Candidate(0.01), Candidate()
+    assert select_backend("dog",data,{"torch": slow,"fft": fast}) == "fft"
+    assert slow.calls == fast.calls == 1 + _autotune.TUNE_REPEATS
+
+    # reused without timing, in this session and the next one
+    assert select_backend("dog",data,{"torch": slow,"fft": fast}) == "fft"
+    with open(tuner.path) as f:
+        stored = json.load(f)
+    assert list(stored) == [tune_key("dog",data)] and stored[tune_key("dog",data)]["winner"] == "fft"
+    reloaded = Autotuner(tuner.path)
+    assert reloaded.get(tune_key("dog",data))["winner"] == "fft"
+    assert slow.calls == fast.calls == 1 + _autotune.TUNE_REPEATS
+    assert [r["winner"] for r in autotune_report()] == ["fft"]
+
+
+def test_overrides_and_requested_backend(tuner):
+    data = np.zeros((4,32,32),np.float32)
+    candidates = {"torch": Candidate(),"fft": Candidate()}
+    configure_autotune(overrides={"dog": "torch"})
+    assert select_backend("dog",data,candidates) == "torch"
+    assert select_backend("dog",data,candidates,backend="fft") == "fft"
+    with pytest.raises(AssertionError):
+        select_backend("dog",data,candidates,backend="skimage")
+    configure_autotune(overrides={"dog": "auto"})
+    assert tuner.overrides == {}
+    assert sum(c.calls for c in candidates.values()) == 0
+
+    configure_autotune(enabled=False)
+    assert select_backend("dog",data,candidates) == "torch"
+    assert sum(c.calls for c in candidates.values()) == 0 and tuner.get(tune_key("dog",data)) is None
+
+
+def test_failing_candidate_and_clear(tuner):
+    data = np.zeros((4,32,32),np.float32)
+
+    def broken(sample):
+        raise RuntimeError("not supported")
+
+    assert select_backend("dog",data,{"torch": broken,"fft": Candidate()}) == "fft"
+    assert tuner.get(tune_key("dog",data))["timings_ms"].keys() == {"fft"}
+
+    tuner.clear()
+    assert tuner.get(tune_key("dog",data)) is None and autotune_report() == []
+    assert not Autotuner(tuner.path).get(tune_key("dog",data))
+
+
+def test_unreadable_decision_file(tmp_path):
+    path = tmp_path / "autotune.json"
+    path.write_text("{not json")
+    tuner = Autotuner(str(path))
+    assert tuner.get("key") is None
+    tuner.put("key","fft",{"fft": 1.0})
+    assert Autotuner(str(path)).get("key")["winner"] == "fft"
@@ -0,0 +1,150 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from napari.layers import Image
+
+from napari_cool_tools_img_proc._cache import (
+    ResultCache,
+    cache_stats,
+    cached,
+    clear_cache,
+    configure_cache,
+    content_hash,
+)
+from napari_cool_tools_img_proc._streaming import run_generator
+
+calls = []
+
+
+@cached("test_double")
+def double_gen(img:Image,factor:float=2.0,in_place:bool=False):
+    calls.append(factor)
+    if in_place:
+        img.data *= factor
+        yield img
+        return img
+    layer = Image(img.data * factor,name=f"{img.name}_double",metadata={"factor": factor})
+    yield layer
+    return layer
+
+
+@pytest.fixture
+def shared_cache():
+    configure_cache(memory_limit=2**30,disk_dir="",enabled=True)
+    clear_cache()
+    calls.clear()
+    yield
+    configure_cache(enabled=False)
+    clear_cache()
+
+
+def test_content_hash_ignores_memory_layout():
+    data = np.random.default_rng(0).random((4,20,30)).astype(np.float32)
+    assert content_hash(data[:,::2]) == content_hash(np.ascontiguousarray(data[:,::2]))
+    assert content_hash(data) != content_hash(data[::-1])
+
+
+def test_memory_and_disk_hits_return_copies(tmp_path):
+    cache = ResultCache(memory_limit=10**6,disk_dir=str(tmp_path))
+    data = np.arange(12,dtype=np.float32).reshape(3,4)
+    cache.put("key",data,"_out","image",{"sigma": 1.5})
+
+    for _ in range(2):
+        hit, suffix, layer_type, metadata = cache.get("key")
+        np.testing.assert_array_equal(hit,data)
+        assert (suffix,layer_type,metadata) == ("_out","image",{"sigma": 1.5})
+        hit[:] = -1
+
+    cache.clear()
+    cache.put("key",data,"_out","image",{"sigma": 1.5})
+    cache.memory_limit = 0
+    cache._evict_memory()
+    hit, *_info, metadata = cache.get("key")
+    hit[:] = -1
+    np.testing.assert_array_equal(cache.get("key")[0],data)
+    assert metadata == {"sigma": 1.5}
+    assert cache.stats()["hits_disk"] == 2 and cache.stats()["misses"] == 0
+    assert cache.get("other") is None
+
+
+def test_broken_disk_entries_are_misses(tmp_path):
+    cache = ResultCache(memory_limit=0,disk_dir=str(tmp_path))
+    data = np.ones((4,4),np.float32)
+    # an array left behind without its metadata, e.g. by a crashed writer
+    np.save(tmp_path / "orphan.npy",data)
+    cache.put("corrupt",data,"","image")
+    (tmp_path / "corrupt.npy").write_bytes(b"not an array")
+    assert cache.get("orphan") is None and cache.get("corrupt") is None
+    assert cache.stats()["misses"] == 2
+
+
+def test_concurrent_disk_access(tmp_path):
+    data = [np.full((32,32),i,np.float32) for i in range(8)]
+    # room for about 3 entries so writers keep evicting each other's files
+    cache = ResultCache(memory_limit=0,disk_dir=str(tmp_path),disk_limit=3 * (data[0].nbytes + 200))
+    errors = []
+
+    def worker(offset):
+        try:
+            for n in range(40):
+                i = (n + offset) % len(data)
+                cache.put(f"key{i}",data[i],"","image")
+                entry = cache.get(f"key{(i + 3) % len(data)}")
+                if entry is not None:
+                    assert entry[0][0,0] == (i + 3) % len(data)
+        except (AssertionError,OSError,ValueError) as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker,args=(offset,)) for offset in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert not [f for f in os.listdir(tmp_path) if f.endswith(".tmp")]
+    assert cache.stats()["disk_bytes"] <= cache.disk_limit
+
+
+def test_memory_tier_evicts_least_recently_used():
+    data = np.zeros((10,10),np.float32)
+    cache = ResultCache(memory_limit=2 * data.nbytes)
+    for key in ("a","b"):
+        cache.put(key,data,"","image")
+    cache.get("a")
+    cache.put("c",data,"","image")
+    assert cache.get("b") is None and cache.get("a") is not None and cache.get("c") is not None
+
+
+def test_cached_is_opt_in():
+    configure_cache(enabled=False)
+    calls.clear()
+    img = Image(np.ones((8,8),np.float32),name="x")
+    for _ in range(2):
+        run_generator(double_gen(img))
+    assert calls == [2.0,2.0]
+
+
+def test_cached_hit(shared_cache):
+    img = Image(np.random.default_rng(1).random((8,8)).astype(np.float32),name="x")
+    first = run_generator(double_gen(img))
+    second = run_generator(double_gen(Image(img.data.copy(),name="x")))
+    assert calls == [2.0]
+    assert second is not first and second.name == "x_double" and second.metadata == {"factor": 2.0}
+    np.testing.assert_array_equal(second.data,first.data)
+
+    second.data[:] = 0
+    np.testing.assert_array_equal(run_generator(double_gen(img)).data,first.data)
+    run_generator(double_gen(img,factor=3.0))
+    assert calls == [2.0,3.0]
+    assert cache_stats()["hits_memory"] == 2
+
+
+def test_cached_bypasses_in_place(shared_cache):
+    img = Image(np.ones((8,8),np.float32),name="x")
+    run_generator(double_gen(img,in_place=True))
+    run_generator(double_gen(img,in_place=True))
+    assert calls == [2.0,2.0]
+    np.testing.assert_array_equal(img.data,4)
+    assert cache_stats()["memory_entries"] == 0
@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+from napari.layers import Image
+
+from napari_cool_tools_img_proc._denoise import (
+    denoise_nl_means_func,
+    diff_of_gaus_func,
+    nl_means_batch,
+    torchvision_diff_of_gaus_2d_data_func,
+)
+from napari_cool_tools_img_proc._memory import memory_budget
+
+
+@pytest.mark.parametrize("truncate",[2.0,4.0])
+def test_diff_of_gaus_batches_match_single_slices(truncate):
+    data = np.random.default_rng(0).random((3,60,50)).astype(np.float32)
+    ref = np.stack([torchvision_diff_of_gaus_2d_data_func(image,1.0,3.0,truncate=truncate) for image in data])
+    np.testing.assert_allclose(diff_of_gaus_func(Image(data,name="x"),1.0,3.0,truncate=truncate,pt=True).data,ref,atol=1e-5)
+    with memory_budget(50 * 4 * 30 * 8):
+        np.testing.assert_allclose(diff_of_gaus_func(Image(data,name="x"),1.0,3.0,truncate=truncate,pt=True).data,ref,atol=1e-5)
+
+
+def nl_means_reference(data,patch_size=5,patch_distance=6,h=0.1,sigma=0.0,patch_slices=1):
+    """Brute force non-local means comparing every patch offset of every shift, reflected at the borders."""
+    x = data.astype(np.float64)
+    half, reach = patch_size // 2, patch_distance
+    context = half + reach
+    n, height, width = x.shape
+    padded = np.pad(x,((0,0),(context,context),(context,context)),mode="reflect")
+
+    def window(dy,dx):
+        return padded[:,context + dy:context + dy + height,context + dx:context + dx + width]
+
+    numerator, weights = np.zeros_like(x), np.zeros_like(x)
+    for dy in range(-reach,reach + 1):
+        for dx in range(-reach,reach + 1):
+            distance = np.zeros_like(x)
+            for a in range(-half,half + 1):
+                for c in range(-half,half + 1):
+                    distance += (window(a,c) - window(dy + a,dx + c))**2
+            distance /= patch_size**2
+            if patch_slices > 1:
+                distance = np.pad(distance,((patch_slices // 2,patch_slices // 2),(0,0),(0,0)),mode="reflect")
+                distance = sum(distance[k:k + n] for k in range(patch_slices)) / patch_slices
+            weight = np.exp(-np.maximum(distance - 2 * sigma**2,0) / h**2)
+            numerator += weight * window(dy,dx)
+            weights += weight
+    return numerator / weights
+
+
+@pytest.mark.parametrize("kwargs",[{},{"patch_size": 3,"patch_distance": 4,"sigma": 0.05,"h": 0.2},{"patch_slices": 3}])
+def test_nl_means_batch_matches_brute_force(kwargs):
+    data = np.random.default_rng(0).random((4,30,36)).astype(np.float32)
+    result = nl_means_batch(torch.from_numpy(data),**kwargs).numpy()
+    np.testing.assert_allclose(result,nl_means_reference(data,**kwargs),atol=1e-5)
+
+
+def test_denoise_nl_means_tiled_volume():
+    rng = np.random.default_rng(1)
+    data = (np.linspace(0,1,40)[None,None] + rng.normal(0,0.1,(6,32,40))).astype(np.float32)
+    kwargs = {"patch_size": 3,"patch_distance": 2,"h": 0.15,"patch_slices": 3}
+    ref = nl_means_reference(data,**kwargs)
+
+    np.testing.assert_allclose(denoise_nl_means_func(Image(data,name="x"),**kwargs).data,ref,atol=1e-5)
+    # batches of a few slices with their neighbours, then row tiles of single slices
+    for budget in (40 * 4 * 16 * 200,40 * 4 * 16 * 60):
+        with memory_budget(budget):
+            result = denoise_nl_means_func(Image(data,name="x"),**kwargs)
+        assert result.name == "x_NLM"
+        np.testing.assert_allclose(result.data,ref,atol=1e-5)
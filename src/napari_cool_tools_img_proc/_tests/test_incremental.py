@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from napari.layers import Image
+
+from napari_cool_tools_img_proc import _incremental
+from napari_cool_tools_img_proc._incremental import (
+    dirty_ranges,
+    forget_runs,
+    incremental,
+    untracked,
+)
+from napari_cool_tools_img_proc._streaming import run_generator
+
+calls = []
+
+
+@incremental("test_smooth",halo=1)
+def smooth_gen(img:Image,weight:float=0.5):
+    """Average of every slice with its neighbours along axis 0, edges replicated."""
+    data = img.data
+    calls.append(len(data))
+    padded = np.concatenate([data[:1],data,data[-1:]])
+    layer = Image(weight * data + (1 - weight) / 2 * (padded[:-2] + padded[2:]),name=f"{img.name}_smooth")
+    yield layer
+    return layer
+
+
+@pytest.fixture
+def fake_viewer(monkeypatch):
+    viewer = SimpleNamespace(layers=[])
+    monkeypatch.setattr(_incremental,"viewer",viewer)
+    calls.clear()
+    yield viewer
+    forget_runs()
+
+
+def reference(data,weight=0.5):
+    padded = np.pad(data,((1,1),(0,0),(0,0)),mode="edge")
+    return weight * data + (1 - weight) / 2 * (padded[:-2] + padded[2:])
+
+
+def test_dirty_ranges():
+    assert dirty_ranges([],1,10) == []
+    assert dirty_ranges([0,5],0,10) == [(0,1),(5,6)]
+    assert dirty_ranges([0,5],1,10) == [(0,2),(4,7)]
+    assert dirty_ranges([3,5,9],1,10) == [(2,7),(8,10)]
+
+
+def test_recomputes_changed_slices(fake_viewer):
+    img = Image(np.random.default_rng(0).random((12,16,16)).astype(np.float32),name="x")
+    out = run_generator(smooth_gen(img))
+    fake_viewer.layers.append(out)
+    assert calls == [12]
+
+    img.data[5] += 1
+    img.data[11] = 0
+    again = run_generator(smooth_gen(img))
+    assert again is out
+    # slices 4-6 read 3-7, slices 10-11 read 9-11
+    assert calls == [12,5,3]
+    np.testing.assert_allclose(out.data,reference(img.data),atol=1e-6)
+
+    run_generator(smooth_gen(img))
+    assert calls == [12,5,3]
+
+
+def test_full_recompute(fake_viewer):
+    img = Image(np.random.default_rng(1).random((6,8,8)).astype(np.float32),name="x")
+    out = run_generator(smooth_gen(img))
+    # not in the viewer
+    assert run_generator(smooth_gen(img)) is not out
+    fake_viewer.layers.append(out)
+    # other parameters
+    assert run_generator(smooth_gen(img,weight=0.25)) is not out
+    with untracked():
+        assert run_generator(smooth_gen(img)) is not out
+    assert calls == [6,6,6,6]
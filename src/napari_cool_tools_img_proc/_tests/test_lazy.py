@@ -0,0 +1,132 @@
+import threading
+import time
+
+import numpy as np
+from napari.layers import Image
+
+from napari_cool_tools_img_proc._denoise import (
+    denoise_tv_func,
+    denoise_tv_lazy_gen,
+)
+from napari_cool_tools_img_proc._equalization import (
+    clahe_lazy_gen,
+    clahe_pt_func,
+)
+from napari_cool_tools_img_proc._filters import (
+    filter_bilateral_lazy_gen,
+    filter_bilateral_pt_func,
+)
+from napari_cool_tools_img_proc._lazy import LazySliceArray, lazy_result_gen
+from napari_cool_tools_img_proc._streaming import run_generator
+
+
+class SlowDouble:
+    """Slice function recording the threads it runs on."""
+
+    def __init__(self,delay=0.02):
+        self.delay = delay
+        self.threads = []
+
+    def __call__(self,image):
+        self.threads.append(threading.current_thread().name)
+        time.sleep(self.delay)
+        return image * 2
+
+
+def volume(shape=(6,16,12)):
+    return np.random.default_rng(0).random(shape).astype(np.float32)
+
+
+def test_slice_indices():
+    lazy = LazySliceArray(volume((2,3,16,12)),SlowDouble(0),np.float32)
+    assert list(lazy._slice_indices((1,2))) == [5]
+    assert list(lazy._slice_indices((0,slice(None),4))) == [0,1,2]
+    assert list(lazy._slice_indices((Ellipsis,3,4))) == list(range(6))
+    assert list(lazy._slice_indices(1)) == [3,4,5]
+
+
+def test_reads_are_computed_by_the_fill():
+    data = volume()
+    func = SlowDouble()
+    lazy = LazySliceArray(data,func,np.float32)
+    fill = threading.Thread(target=lambda: list(lazy.iter_fill("test")),name="fill")
+    fill.start()
+    time.sleep(0.01)
+    # the fill starts at slice 0, the read of the last slice jumps the queue
+    np.testing.assert_array_equal(lazy[5],data[5] * 2)
+    assert func.threads.index("fill") == 0 and len(func.threads) < len(data)
+    fill.join()
+
+    assert set(func.threads) == {"fill"} and len(func.threads) == len(data)
+    assert lazy.complete
+    np.testing.assert_array_equal(np.asarray(lazy),data * 2)
+
+
+def test_concurrent_reads_during_fill():
+    data = volume((12,16,12))
+    func = SlowDouble(0.005)
+    gen = lazy_result_gen(Image(data,name="x"),func,"x_double",np.float32,"test")
+    layer = next(gen)
+    results = {}
+
+    def reader(indices):
+        for i in indices:
+            results[i] = np.array(layer.data[i])
+
+    readers = [threading.Thread(target=reader,args=(indices,),name=f"reader{n}")
+               for n, indices in enumerate([[11,3,7],[0,11,5],[9,9,2]])]
+    for t in readers:
+        t.start()
+    for _ in gen:
+        pass
+    for t in readers:
+        t.join()
+
+    assert sorted(results) == [0,2,3,5,7,9,11] and set(func.threads) == {threading.current_thread().name}
+    assert len(func.threads) == len(data)
+    for i, result in results.items():
+        np.testing.assert_array_equal(result,data[i] * 2)
+
+
+def test_reads_after_the_fill_stopped():
+    data = volume()
+    func = SlowDouble(0)
+    gen = lazy_result_gen(Image(data,name="x"),func,"x_double",np.float32,"test")
+    layer = next(gen)
+    next(gen)
+    next(gen)
+    gen.close()
+    computed = len(func.threads)
+    assert 0 < computed < len(data)
+
+    # reads on other threads never compute, slices that are missing read as zeros
+    results = []
+    reader = threading.Thread(target=lambda: results.append(np.array(layer.data[:])))
+    reader.start()
+    reader.join()
+    assert len(func.threads) == computed
+    done = results[0].reshape(len(data),-1).any(axis=1)
+    assert done.sum() == computed
+    np.testing.assert_array_equal(results[0][done],data[done] * 2)
+    np.testing.assert_array_equal(results[0][~done],0)
+
+    # converting the whole array computes the rest
+    np.testing.assert_array_equal(np.asarray(layer.data),data * 2)
+    assert layer.data.complete and len(func.threads) == len(data)
+
+
+def test_lazy_result_matches_eager():
+    data = volume()
+    layer = run_generator(lazy_result_gen(Image(data,name="x"),SlowDouble(0),"x_double",np.float32,"test",contrast_limits=(0,2)))
+    assert layer.name == "x_double" and layer.data.complete
+    np.testing.assert_array_equal(np.asarray(layer.data),data * 2)
+
+
+def test_lazy_operations_match_eager():
+    data = volume((4,32,36))
+    lazy = run_generator(clahe_lazy_gen(Image(data,name="x"),pt_K=True)).data
+    np.testing.assert_allclose(np.asarray(lazy),clahe_pt_func(Image(data,name="x"),clip_limit=0.01).data,atol=1e-5)
+    lazy = run_generator(denoise_tv_lazy_gen(Image(data,name="x"))).data
+    np.testing.assert_allclose(np.asarray(lazy),denoise_tv_func(data),atol=1e-6)
+    lazy = run_generator(filter_bilateral_lazy_gen(Image(data,name="x"))).data
+    np.testing.assert_allclose(np.asarray(lazy),filter_bilateral_pt_func(Image(data,name="x")).data,atol=1e-5)
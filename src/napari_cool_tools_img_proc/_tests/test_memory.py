@@ -0,0 +1,65 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from kornia.filters import gaussian_blur2d
+
+from napari_cool_tools_img_proc._filters import filter_gaussian_blur_kn
+from napari_cool_tools_img_proc._memory import (
+    apply_in_chunks,
+    choose_batch_size,
+    is_out_of_memory_error,
+    memory_budget,
+)
+
+
+def box_mean(batch):
+    return F.avg_pool2d(F.pad(batch[:,None],(1,1,1,1),mode="reflect"),3,1).squeeze(1)
+
+
+def test_gaussian_blur_tiled_matches_untiled():
+    data = np.random.default_rng(0).random((7,64,50)).astype(np.float32)
+    ref = gaussian_blur2d(torch.tensor(data)[:,None],(5,5),(1.5,1.5)).squeeze(1).numpy()
+
+    np.testing.assert_allclose(filter_gaussian_blur_kn(data,5,1.5),ref,atol=1e-5)
+    # small enough for a few slices per batch, then for a few rows per tile
+    for budget in (64 * 50 * 4 * 4 * 3,2000):
+        with memory_budget(budget):
+            np.testing.assert_allclose(filter_gaussian_blur_kn(data,5,1.5),ref,atol=1e-5)
+
+
+def test_apply_in_chunks_row_tiles():
+    data = np.random.default_rng(1).random((2,3,40,30)).astype(np.float32)
+    ref = box_mean(torch.tensor(data.reshape(-1,40,30))).numpy().reshape(data.shape)
+    shapes = []
+
+    def func(batch):
+        shapes.append(tuple(batch.shape))
+        return box_mean(batch)
+
+    with memory_budget(1500):
+        out = apply_in_chunks(data,func,"gaussian_blur",kernel_size=3,halo=1,desc="test")
+    assert max(s[1] for s in shapes) < 40, "budget should split slices into row tiles"
+    np.testing.assert_allclose(out,ref,atol=1e-6)
+
+
+def test_apply_in_chunks_out_of_memory_backoff():
+    data = np.random.default_rng(2).random((8,16,16)).astype(np.float32)
+    sizes = []
+
+    def func(batch):
+        sizes.append(batch.shape[0])
+        if batch.shape[0] > 2:
+            raise RuntimeError("CUDA out of memory")
+        return batch * 2
+
+    with memory_budget(10**9):
+        assert choose_batch_size("gaussian_blur",data.shape) >= len(data)
+        out = apply_in_chunks(data,func,"gaussian_blur",desc="test")
+    assert sizes[0] == len(data) and max(sizes[sizes.index(2):]) == 2
+    np.testing.assert_allclose(out,data * 2)
+
+
+def test_is_out_of_memory_error():
+    assert is_out_of_memory_error(RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB"))
+    assert is_out_of_memory_error(MemoryError())
+    assert not is_out_of_memory_error(RuntimeError("shape mismatch"))
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+import torch
+from skimage.measure import block_reduce
+
+from napari_cool_tools_img_proc._nn_tools_2D import (
+    PatchDataset,
+    PatchExtractor,
+    VirtualPad,
+)
+
+MODES = ["constant","edge","linear_ramp","maximum","mean","median","minimum","reflect","symmetric","wrap"]
+
+
+@pytest.mark.parametrize("dtype",[np.float32,np.uint8])
+@pytest.mark.parametrize("mode",MODES)
+@pytest.mark.parametrize("pad_width",[((3,5),(2,4)),((15,20),(0,12)),((0,0),(7,1))])
+def test_virtual_pad_matches_np_pad(dtype,mode,pad_width):
+    data = (np.random.default_rng(0).random((2,13,11)) * 200).astype(dtype)
+    ref = np.stack([np.pad(image,pad_width,mode) for image in data])
+    padded = VirtualPad(data,pad_width,mode)
+    assert padded.shape == ref.shape
+
+    np.testing.assert_array_equal(padded.read(0,2,(0,ref.shape[1]),(0,ref.shape[2])),ref)
+    np.testing.assert_array_equal(padded.read(1,2,(2,ref.shape[1] - 1),(1,6))[0],ref[1,2:-1,1:6])
+
+
+def test_patches_match_padded_pooled_image():
+    data = np.random.default_rng(1).random((2,3,50,41)).astype(np.float32)
+    pad_width = ((4,4),(3,3))
+    extractor = PatchExtractor(data,patch_size=(16,12),overlap=4,pad_width=pad_width,mode="reflect",block_size=2,pooling="max")
+    ref = np.stack([block_reduce(np.pad(image,pad_width,"reflect"),block_size=2,func=np.max) for image in data.reshape(-1,50,41)])
+    assert extractor.shape == ref.shape
+
+    stitcher = extractor.stitcher()
+    covered = np.zeros(ref.shape,dtype=bool)
+    for patches, positions in extractor.iter_batches(5):
+        for patch, (b, y, x) in zip(patches,positions):
+            np.testing.assert_array_equal(patch,ref[b,y:y + 16,x:x + 12])
+            covered[b,y:y + 16,x:x + 12] = True
+        stitcher.add(patches * 2,positions)
+    assert covered.all()
+
+    np.testing.assert_allclose(stitcher.result(crop=False).reshape(ref.shape),2 * ref,rtol=1e-6)
+    cropped = stitcher.result()
+    assert cropped.shape == (2,3,25,21)
+    np.testing.assert_allclose(cropped.reshape(6,25,21),2 * ref[:,2:27,1:22],rtol=1e-6)
+
+
+def test_patch_dataset_and_channel_stitching():
+    data = np.random.default_rng(2).random((3,50,41)).astype(np.float32)
+    extractor = PatchExtractor(data,patch_size=16,overlap=5,block_size=2,pooling="avg")
+    ref = np.stack([block_reduce(image,block_size=2,func=np.mean) for image in data])
+
+    stitcher = extractor.stitcher(channels=2)
+    for patch, (b, y, x) in torch.utils.data.DataLoader(PatchDataset(extractor),batch_size=7):
+        stitcher.add(torch.stack([patch[:,0],-patch[:,0]],1),list(zip(b.tolist(),y.tolist(),x.tolist())))
+    result = stitcher.result()
+    assert result.shape == (3,2,25,21)
+    np.testing.assert_allclose(result[:,0],ref,rtol=1e-5)
+    np.testing.assert_allclose(result[:,1],-ref,rtol=1e-5)
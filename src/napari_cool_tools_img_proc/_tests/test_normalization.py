@@ -0,0 +1,41 @@
+import numpy as np
+from napari.layers import Image
+from scipy.ndimage import uniform_filter
+
+from napari_cool_tools_img_proc._memory import memory_budget
+from napari_cool_tools_img_proc._normalization import normalize_local_func
+
+
+def local_z_scores(data,window_size,min_std=1e-6):
+    x = data.astype(np.float64)
+    size = (1,window_size,window_size)
+    mean = uniform_filter(x,size,mode="mirror")
+    variance = uniform_filter(x * x,size,mode="mirror") - mean * mean
+    return (x - mean) / np.sqrt(np.maximum(variance,0)).clip(min_std)
+
+
+def attenuated_stack(shape=(3,90,70)):
+    rng = np.random.default_rng(0)
+    return (rng.random(shape) * 1000 * np.linspace(1,0.05,shape[1])[:,None]).astype(np.float32)
+
+
+def test_normalize_local_matches_scipy():
+    data = attenuated_stack()
+    for window_size in (5,31):
+        z = local_z_scores(data,window_size)
+        np.testing.assert_allclose(normalize_local_func(Image(data,name="x"),window_size,clip=0).data,z,atol=1e-3)
+        clipped = normalize_local_func(Image(data,name="x"),window_size).data
+        np.testing.assert_allclose(clipped,np.clip((z + 3) / 6,0,1),atol=1e-3)
+        assert clipped.min() >= 0 and clipped.max() <= 1
+
+
+def test_normalize_local_tiled_and_in_place():
+    data = attenuated_stack()
+    ref = normalize_local_func(Image(data,name="x"),31).data
+    with memory_budget(70 * 4 * 10 * 40):
+        np.testing.assert_allclose(normalize_local_func(Image(data,name="x"),31).data,ref,atol=1e-5)
+
+    copy = data.copy()
+    img = Image(copy,name="x")
+    assert normalize_local_func(img,31,in_place=True) is img
+    np.testing.assert_allclose(copy,ref,atol=1e-5)
@@ -0,0 +1,108 @@
+import numpy as np
+import pytest
+import torch
+from kornia.enhance import adjust_gamma, adjust_log
+
+from napari_cool_tools_img_proc import _pointwise
+from napari_cool_tools_img_proc._pointwise import (
+    PointwiseChain,
+    configure_fusion,
+)
+
+
+@pytest.fixture
+def data():
+    return (np.random.default_rng(0).random((4,32,40)) * 300).astype(np.float32)
+
+
+@pytest.fixture
+def eager_only(monkeypatch):
+    monkeypatch.setattr(_pointwise,"COMPILE",False)
+
+
+@pytest.fixture
+def compile_everything(monkeypatch):
+    """Compile every chain, with empty compiled and failed chain registries."""
+    monkeypatch.setattr(_pointwise,"_compiled",{})
+    monkeypatch.setattr(_pointwise,"_failed",set())
+    monkeypatch.setattr(_pointwise,"COMPILE",_pointwise.COMPILE)
+    monkeypatch.setattr(_pointwise,"COMPILE_MIN_ELEMENTS",_pointwise.COMPILE_MIN_ELEMENTS)
+    configure_fusion(use_compile=True,compile_min_elements=1)
+
+
+def test_chain_matches_unfused(data,eager_only):
+    x = torch.from_numpy(data)
+    # per slice ranges broadcasting against the batch
+    x_min, x_max = x.amin(dim=(1,2),keepdim=True), x.amax(dim=(1,2),keepdim=True)
+    norm = (x - x_min) / (x_max - x_min)
+
+    fused = PointwiseChain().normalize(x_min,x_max)(x)
+    torch.testing.assert_close(fused,norm)
+    assert (fused.amin(dim=(1,2)) == 0).all() and (fused.amax(dim=(1,2)) == 1).all()
+
+    # kornia clips gamma corrected values to range 0-1, so the gain stays 1
+    fused = PointwiseChain().normalize(x_min,x_max).gamma(0.5).log(1.5)(x)
+    torch.testing.assert_close(fused,adjust_log(adjust_gamma(norm,0.5),1.5,clip_output=False))
+    fused = PointwiseChain().normalize(x_min,x_max,-1.0,1.0).log(2.0,inv=True)(x)
+    torch.testing.assert_close(fused,adjust_log(norm * 2 - 1,2.0,inv=True,clip_output=False))
+
+    fused = PointwiseChain().normalize(50.0,250.0,clip=True).affine(2.0,-1.0)(x)
+    torch.testing.assert_close(fused,torch.clamp((x - 50) / 200,0,1) * 2 - 1)
+
+
+def test_apply_matches_numpy(data,eager_only):
+    d_min, d_max = float(data.min()), float(data.max())
+    ref = np.log2(1 + 2.0 * ((data - d_min) / (d_max - d_min)) ** 0.5)
+    out = PointwiseChain().normalize(d_min,d_max).gamma(0.5,2.0).log().apply(data)
+    np.testing.assert_allclose(out,ref,rtol=1e-6)
+    assert out.dtype == np.float32
+
+    # integer data is processed as float32, output arrays are written to
+    out = np.empty(data.shape,np.float32)
+    result = PointwiseChain().normalize(0.0,300.0,clip=True).apply(data.astype(np.uint16),out)
+    assert result is out
+    np.testing.assert_allclose(out,np.clip(data.astype(np.uint16) / 300,0,1),rtol=1e-6)
+    np.testing.assert_array_equal(PointwiseChain().apply(data),data)
+
+
+def test_failed_compilation_runs_eagerly(data,compile_everything,monkeypatch):
+    compiles, messages = [], []
+
+    def broken_compile(func,**kwargs):
+        compiles.append(func)
+
+        def compiled(*args):
+            raise RuntimeError("no working C compiler found")
+        return compiled
+
+    monkeypatch.setattr(torch,"compile",broken_compile)
+    monkeypatch.setattr(_pointwise,"show_info",messages.append)
+    x = torch.from_numpy(data)
+    chain = PointwiseChain().normalize(0.0,300.0).gamma(0.5)
+    torch.testing.assert_close(chain(x),torch.pow(x / 300,0.5))
+    assert ("normalize","gamma") in _pointwise._failed and len(messages) == 1
+
+    # failed chains are not compiled again
+    torch.testing.assert_close(PointwiseChain().normalize(0.0,100.0).gamma(2.0)(x),torch.pow(x / 100,2.0))
+    assert len(compiles) == 1 and len(messages) == 1
+
+
+def test_out_of_memory_is_not_a_compilation_failure(data,compile_everything,monkeypatch):
+    def compiled(*args):
+        raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+
+    monkeypatch.setattr(torch,"compile",lambda func,**kwargs: compiled)
+    with pytest.raises(RuntimeError,match="out of memory"):
+        PointwiseChain().log()(torch.from_numpy(data))
+    assert not _pointwise._failed
+
+
+def test_small_batches_and_disabled_compilation_run_eagerly(data,compile_everything,monkeypatch):
+    def fail_compile(func,**kwargs):
+        raise AssertionError("chain should not be compiled")
+
+    monkeypatch.setattr(torch,"compile",fail_compile)
+    configure_fusion(compile_min_elements=data.size + 1)
+    PointwiseChain().log()(torch.from_numpy(data))
+    configure_fusion(use_compile=False,compile_min_elements=1)
+    PointwiseChain().log()(torch.from_numpy(data))
@@ -0,0 +1,25 @@
+import numpy as np
+from napari.layers import Image
+
+from napari_cool_tools_img_proc import _pool
+from napari_cool_tools_img_proc._pool import iter_apply_to_layers
+
+
+def double_gen(img:Image,factor:float=2.0):
+    if img.name == "broken":
+        raise ValueError("unsupported data")
+    layer = Image(img.data * factor,name=f"{img.name}_double")
+    yield layer
+    return layer
+
+
+def test_failed_layers_are_reported(monkeypatch):
+    messages = []
+    monkeypatch.setattr(_pool,"show_info",messages.append)
+    data = np.ones((2,8,8),np.float32)
+    layers = [Image(data,name="a"),Image(data,name="broken"),Image(data,name="b")]
+    outputs = list(iter_apply_to_layers(double_gen,layers,"Double",factor=3.0))
+    assert sorted(layer.name for layer in outputs) == ["a_double","b_double"]
+    for layer in outputs:
+        np.testing.assert_array_equal(layer.data,3)
+    assert messages == ["Double failed for layer broken: unsupported data"]
@@ -0,0 +1,98 @@
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from napari_cool_tools_img_proc._prefetch import PrefetchExecutor
+from napari_cool_tools_img_proc._streaming import iter_slices
+
+
+def pipeline(data,depth,store_error_at=None):
+    """Slice loop like iter_slices, recording the threads every stage ran on."""
+    out = np.zeros_like(data)
+    threads = {"load": set(),"store": set()}
+    completed = []
+
+    def load(i):
+        threads["load"].add(threading.current_thread().name)
+        time.sleep(0.002)
+        return data[i].copy()
+
+    def store(i,result):
+        threads["store"].add(threading.current_thread().name)
+        if i == store_error_at:
+            raise OSError(f"could not write slice {i}")
+        time.sleep(0.002)
+        out[i] = result
+
+    with PrefetchExecutor(depth,desc="test") as executor:
+        executor.load(0,load,0)
+        for i in range(len(data)):
+            if i + 1 < len(data):
+                executor.load(i + 1,load,i + 1)
+            result = executor.take(i) * 2 + 1
+            completed += executor.store(i,store,i,result)
+        completed += executor.drain()
+    return out, completed, threads
+
+
+@pytest.mark.parametrize("depth",[0,1,3])
+def test_results_match_sequential_loop(depth):
+    data = np.random.default_rng(0).random((10,8,8)).astype(np.float32)
+    out, completed, threads = pipeline(data,depth)
+    np.testing.assert_array_equal(out,data * 2 + 1)
+    assert completed == list(range(len(data)))
+    main = threading.current_thread().name
+    if depth == 0:
+        assert threads == {"load": {main},"store": {main}}
+    else:
+        assert main not in threads["load"] | threads["store"]
+
+
+def test_iter_slices_matches_sequential_loop():
+    data = np.random.default_rng(1).random((2,5,8,8)).astype(np.float32)
+    out = np.empty_like(data)
+    ranges = list(iter_slices(data,np.sqrt,out,desc="test"))
+    assert sorted(ranges) == [(i,i + 1) for i in range(10)]
+    np.testing.assert_array_equal(out,np.sqrt(data))
+
+
+@pytest.mark.parametrize("store_error_at",[3,9])
+def test_failed_store_is_raised(store_error_at):
+    data = np.zeros((10,4,4),np.float32)
+    with pytest.raises(OSError,match=f"slice {store_error_at}"):
+        pipeline(data,2,store_error_at)
+
+
+def fail_later(message):
+    time.sleep(0.05)
+    raise OSError(message)
+
+
+def test_failed_store_is_raised_on_close():
+    executor = PrefetchExecutor(2,desc="test")
+    executor.store(0,lambda: None)
+    # still pending when the executor is closed
+    assert 1 not in executor.store(1,fail_later,"disk full")
+    with pytest.raises(OSError,match="disk full"):
+        executor.close()
+
+
+def test_close_after_error_keeps_the_original_error():
+    executor = PrefetchExecutor(2,desc="test")
+    with pytest.raises(ValueError,match="compute failed"), executor:
+        executor.store(0,fail_later,"disk full")
+        raise ValueError("compute failed")
+
+
+def test_take_order_and_cancel_loads():
+    executor = PrefetchExecutor(1,desc="test")
+    executor.load(0,lambda: 0)
+    executor.load(1,lambda: 1)
+    with pytest.raises(AssertionError):
+        executor.take(1)
+    executor.cancel_loads()
+    executor.load(2,lambda: 2)
+    assert executor.take(2) == 2
+    executor.close()
@@ -0,0 +1,70 @@
+import numpy as np
+from napari.layers import Image, Labels
+from scipy.ndimage import uniform_filter
+
+from napari_cool_tools_img_proc._roi import roi_boxes, roi_mask, roi_restricted
+from napari_cool_tools_img_proc._streaming import run_generator
+
+boxes_run = []
+
+
+@roi_restricted(halo=lambda args: args["size"] // 2,desc="Box Mean",slice_halo=lambda args: args["slice_size"] // 2)
+def box_mean_gen(img:Image,size:int=3,slice_size:int=1,in_place:bool=False):
+    data = img.data
+    boxes_run.append(data.shape)
+    out = uniform_filter(data,(slice_size,size,size)[-data.ndim:],mode="nearest")
+    if in_place:
+        data[...] = out
+        out = data
+    layer = Image(out,name=f"{img.name}_BM")
+    yield layer
+    return layer
+
+
+def test_roi_boxes_halo_and_merging():
+    mask = np.zeros((30,40),dtype=bool)
+    mask[2:5,3:6] = True
+    mask[20:25,30:38] = True
+    assert roi_boxes(mask,(30,40)) == [(slice(2,5),slice(3,6)),(slice(20,25),slice(30,38))]
+    # grown boxes are clipped to the data
+    assert roi_boxes(mask,(30,40),halo=3) == [(slice(0,8),slice(0,9)),(slice(17,28),slice(27,40))]
+    # boxes overlapping once grown are merged, a 2D mask applies to every slice
+    assert roi_boxes(mask,(2,30,40),halo=13) == [(slice(0,2),slice(0,30),slice(0,40))]
+    assert roi_boxes(np.zeros((30,40),dtype=bool),(30,40),halo=3) == []
+
+
+def test_roi_boxes_slice_halo():
+    mask = np.zeros((10,30,40),dtype=bool)
+    mask[4,10:12,10:12] = True
+    mask[8,10:12,10:12] = True
+    assert roi_boxes(mask,(10,30,40),halo=1) == [(slice(4,5),slice(9,13),slice(9,13)),(slice(8,9),slice(9,13),slice(9,13))]
+    assert roi_boxes(mask,(10,30,40),halo=1,slice_halo=2) == [(slice(2,10),slice(9,13),slice(9,13))]
+    # a 2D mask needs no slice halo
+    assert roi_boxes(mask[4],(10,30,40),slice_halo=2) == [(slice(0,10),slice(10,12),slice(10,12))]
+
+
+def test_roi_mask_from_labels():
+    labels = np.zeros((20,30),dtype=np.int32)
+    labels[5:10,5:10] = 2
+    np.testing.assert_array_equal(roi_mask(Labels(labels),(3,20,30)),labels > 0)
+
+
+def test_roi_restricted_matches_full_run():
+    data = np.random.default_rng(0).random((8,40,50)).astype(np.float32)
+    labels = np.zeros(data.shape,dtype=np.int32)
+    labels[3,5:12,8:20] = 1
+    labels[5:7,25:35,30:45] = 1
+    mask = labels > 0
+    full = uniform_filter(data,(3,5,5),mode="nearest")
+
+    boxes_run.clear()
+    result = run_generator(box_mean_gen(Image(data.copy(),name="x"),5,3,roi=Labels(labels)))
+    assert result.name == "x_BM_ROI" and len(boxes_run) == 2
+    assert sum(np.prod(shape) for shape in boxes_run) < data.size / 4
+    np.testing.assert_allclose(result.data[mask],full[mask],atol=1e-6)
+    np.testing.assert_array_equal(result.data[~mask],data[~mask])
+
+    img = Image(data.copy(),name="x")
+    assert run_generator(box_mean_gen(img,5,3,in_place=True,roi=Labels(labels))) is img
+    np.testing.assert_array_equal(img.data,result.data)
+    assert run_generator(box_mean_gen(img,5,3,roi=Labels(np.zeros_like(labels)))) is None
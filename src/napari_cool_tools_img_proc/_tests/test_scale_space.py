@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+from napari.layers import Image
+from scipy.ndimage import gaussian_filter
+
+from napari_cool_tools_img_proc._scale_space import (
+    diff_of_gaus_bands_func,
+    scale_space_bands,
+)
+
+SIGMAS = [0,1,2,4,8]
+
+
+def volume(shape=(3,96,80)):
+    return np.random.default_rng(0).random(shape).astype(np.float32)
+
+
+def reference_bands(data,sigmas):
+    """Differences of consecutive gaussian_filter blurs of every slice, torch 'reflect' is scipy 'mirror'."""
+    blurs = [np.stack([gaussian_filter(s.astype(np.float64),sigma,mode="mirror",truncate=4.0) for s in data])
+             for sigma in sigmas]
+    return np.stack([low - high for low, high in zip(blurs[:-1],blurs[1:])],axis=-1)
+
+
+def test_bands_match_gaussian_filter():
+    data = volume()
+    # levels are blurred incrementally, so this only holds while truncation is negligible
+    bands = scale_space_bands(torch.from_numpy(data),SIGMAS,normalize=False).numpy()
+    assert bands.shape == data.shape + (len(SIGMAS) - 1,)
+    np.testing.assert_allclose(bands,reference_bands(data,SIGMAS),atol=5e-5)
+
+
+def test_octave_bands_match_gaussian_filter():
+    data = volume()
+    bands = scale_space_bands(torch.from_numpy(data),SIGMAS,octaves=True,normalize=False).numpy()
+    ref = reference_bands(data,SIGMAS)
+    # levels up to OCTAVE_SIGMA are computed at full resolution
+    np.testing.assert_allclose(bands[...,:3],ref[...,:3],atol=5e-5)
+    # larger sigmas come from a downsampled level and are only close to the direct blur
+    error = np.sqrt(((bands - ref)**2).mean(axis=(0,1,2)) / (ref**2).mean(axis=(0,1,2)))
+    assert (error < 0.05).all()
+
+
+def test_diff_of_gaus_bands_layer():
+    data = volume((2,40,36))
+    layer = diff_of_gaus_bands_func(Image(data,name="x"),[4,1,2],normalize=False)
+    assert layer.name == "x_DoG_bands" and layer.metadata["bands"] == [(1.0,2.0),(2.0,4.0)]
+    np.testing.assert_allclose(layer.data,np.moveaxis(reference_bands(data,[1,2,4]),-1,0),atol=5e-5)
+
+    layer = diff_of_gaus_bands_func(Image(data,name="x"),[1,2,4])
+    assert layer.data.shape == (2,) + data.shape
+    np.testing.assert_allclose(layer.data.min(axis=(2,3)),0,atol=1e-6)
+    np.testing.assert_allclose(layer.data.max(axis=(2,3)),1,atol=1e-6)
@@ -0,0 +1,108 @@
+import threading
+import time
+
+import pytest
+
+from napari_cool_tools_img_proc import _scheduler
+from napari_cool_tools_img_proc._memory import get_memory_budget
+from napari_cool_tools_img_proc._scheduler import (
+    BATCH_PRIORITY,
+    INTERACTIVE_PRIORITY,
+    JobScheduler,
+    job_priority,
+    job_slot,
+    pooled_budget,
+    scheduled,
+)
+from napari_cool_tools_img_proc._streaming import run_generator
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    sched = JobScheduler(limits={"cpu": 2,"gpu": 1})
+    monkeypatch.setattr(_scheduler,"_scheduler",sched)
+    return sched
+
+
+def wait_queued(sched,n):
+    deadline = time.time() + 5
+    while sum(1 for job in sched.status() if job["state"] == "queued") < n:
+        assert time.time() < deadline, "jobs were not queued"
+        time.sleep(0.005)
+
+
+def run_jobs(sched,jobs,backend="gpu"):
+    """Queue jobs (desc, priority) one after the other behind a running job, return the order they start in."""
+    order = []
+
+    def run(desc,priority):
+        job = sched.acquire(desc,backend,priority)
+        if job is not None:
+            order.append(desc)
+            sched.release(job)
+
+    blocker = sched.acquire("blocker",backend)
+    threads = []
+    for n, (desc, priority) in enumerate(jobs):
+        threads.append(threading.Thread(target=run,args=(desc,priority)))
+        threads[-1].start()
+        wait_queued(sched,n + 1)
+    sched.release(blocker)
+    for t in threads:
+        t.join()
+    return order
+
+
+def test_priority_order(scheduler):
+    order = run_jobs(scheduler,[("batch1",BATCH_PRIORITY),("batch2",BATCH_PRIORITY),("interactive",INTERACTIVE_PRIORITY)])
+    assert order == ["interactive","batch1","batch2"]
+    assert scheduler.status() == []
+
+
+def test_backend_limits(scheduler):
+    running = []
+    peak = {"cpu": 0,"gpu": 0}
+    lock = threading.Lock()
+
+    @scheduled(lambda args: args["backend"],"test")
+    def work_gen(backend:str):
+        with lock:
+            running.append(backend)
+            peak[backend] = max(peak[backend],running.count(backend))
+        time.sleep(0.02)
+        with lock:
+            running.remove(backend)
+        yield backend
+        return backend
+
+    threads = [threading.Thread(target=run_generator,args=(work_gen(backend),)) for backend in ["cpu","gpu"] * 4]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert peak == {"cpu": 2,"gpu": 1}
+
+
+def test_cancel_queued(scheduler):
+    results = []
+    blocker = scheduler.acquire("blocker","gpu")
+    t = threading.Thread(target=lambda: results.append(scheduler.acquire("queued","gpu")))
+    t.start()
+    wait_queued(scheduler,1)
+    scheduler.cancel_queued()
+    t.join()
+    scheduler.release(blocker)
+    assert results == [None] and scheduler.status() == []
+
+
+def test_nested_slots_and_pooled_budget(scheduler):
+    with job_priority(BATCH_PRIORITY), pooled_budget(12000,4):
+        with job_slot("outer","cpu") as granted:
+            assert granted and get_memory_budget() == 6000
+            # a nested slot reuses the outer one instead of waiting for a second slot
+            with job_slot("inner","gpu") as inner:
+                assert inner and len(scheduler.status()) == 1
+            assert scheduler.status()[0]["priority"] == BATCH_PRIORITY
+        with job_slot("outer","gpu"):
+            assert get_memory_budget() == 12000
+    assert scheduler.status() == []
@@ -0,0 +1,66 @@
+import numpy as np
+
+from napari_cool_tools_img_proc._memory import memory_budget
+from napari_cool_tools_img_proc._statistics import (
+    QuantileSketch,
+    compute_sketch,
+    value_range,
+)
+
+QUANTILES = [0.001,0.01,0.1,0.25,0.5,0.75,0.9,0.99,0.999]
+
+
+def assert_relative_accuracy(sketch,data,accuracy):
+    estimate = sketch.quantile(QUANTILES)
+    exact = np.quantile(data,QUANTILES,method="lower")
+    assert np.all(np.abs(estimate - exact) <= accuracy * np.abs(exact) + 1e-12)
+
+
+def test_sketch_relative_accuracy():
+    rng = np.random.default_rng(0)
+    data = np.concatenate([rng.normal(100,15,20000),-rng.lognormal(0,2,5000),np.zeros(100),[1e6]])
+    for accuracy in (0.01,0.001):
+        sketch = QuantileSketch(accuracy).update(data)
+        assert_relative_accuracy(sketch,data,accuracy)
+        assert sketch.quantile(0) == data.min() and sketch.quantile(1) == data.max()
+
+
+def test_sketch_ignores_nan():
+    sketch = QuantileSketch().update(np.array([np.nan,1.0,2.0,np.nan,3.0]))
+    assert sketch.total == 3
+    assert abs(sketch.quantile(0.5) - 2) <= 2e-3
+
+
+def test_sketch_infinite_values_only_set_min_and_max():
+    sketch = QuantileSketch().update([1.0,2.0,np.inf])
+    assert sketch.total == 2 and sketch.max == np.inf and sketch.quantile(1) == np.inf
+    assert abs(sketch.quantile(0.5) - 1) <= 2e-3
+    sketch.merge(QuantileSketch().update(np.array([-np.inf,3.0],np.float32)))
+    assert sketch.total == 3 and (sketch.min,sketch.max) == (-np.inf,np.inf)
+    assert abs(sketch.quantile(0.5) - 2) <= 4e-3
+
+    data = np.random.default_rng(3).normal(0,1,(4,20,20)).astype(np.float32)
+    data[0,0,:3] = [np.inf,-np.inf,np.nan]
+    low, high = value_range(data,0.01,0.99)
+    assert np.isfinite([low,high]).all() and low < 0 < high
+
+
+def test_merged_sketch_matches_single_pass():
+    data = np.random.default_rng(1).gamma(2.0,50.0,(16,40,30)).astype(np.float32)
+    single = compute_sketch(data)
+    with memory_budget(40 * 30 * 8 * 2 * 3):
+        blocked = compute_sketch(data)
+        merged = compute_sketch(data,workers=3)
+    for sketch in (blocked,merged):
+        assert sketch.total == data.size
+        np.testing.assert_array_equal(sketch.quantile(QUANTILES),single.quantile(QUANTILES))
+    assert_relative_accuracy(merged,data,1e-3)
+
+
+def test_value_range():
+    data = np.random.default_rng(2).normal(0,1,(10,50,50)).astype(np.float32)
+    assert value_range(data) == (float(data.min()),float(data.max()))
+    low, high = value_range(data,0.01,0.99)
+    exact = np.quantile(data,[0.01,0.99],method="lower")
+    np.testing.assert_allclose([low,high],exact,rtol=1e-3)
+    assert data.min() < low < high < data.max()
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+from napari.layers import Image
+
+from napari_cool_tools_img_proc._denoise import diff_of_gaus_func
+from napari_cool_tools_img_proc._equalization import clahe_pt_func
+from napari_cool_tools_img_proc._filters import (
+    filter_gaussian_blur_kn,
+    sharpen_um_pt_func,
+)
+from napari_cool_tools_img_proc._memory import memory_budget
+from napari_cool_tools_img_proc._sweep import (
+    parameter_grid,
+    parse_values,
+    sweep_func,
+)
+
+
+@pytest.fixture
+def img():
+    return Image(np.random.default_rng(0).random((6,64,50)).astype(np.float32),name="x")
+
+
+def test_parse_values_and_grid():
+    assert parse_values("1, 2.5;4") == [1.0,2.5,4.0]
+    assert parse_values("3,5,",int) == [3,5]
+    assert parameter_grid(a=[1,2],b=[3]) == [{"a": 1,"b": 3},{"a": 2,"b": 3}]
+
+
+@pytest.mark.parametrize("border_type",["reflect","constant","replicate","circular"])
+@pytest.mark.parametrize("separable",[True,False])
+def test_gaussian_blur_sweep_matches_separate_runs(img,border_type,separable):
+    settings = parameter_grid(kernel_size=[3,5,9],sigma=[1.0,2.0])
+    sweep = sweep_func(img,"gaussian_blur",settings,border_type=border_type,separable=separable)
+    assert sweep.data.shape == (len(settings),) + img.data.shape and sweep.metadata["sweep"] == settings
+    for result, s in zip(sweep.data,settings):
+        np.testing.assert_allclose(result,filter_gaussian_blur_kn(img.data,s["kernel_size"],s["sigma"],border_type,separable),atol=1e-6)
+
+
+def test_gaussian_blur_sweep_tiled(img):
+    settings = parameter_grid(kernel_size=[3,9],sigma=[1.0,3.0])
+    with memory_budget(64 * 50 * 4 * 12):
+        sweep = sweep_func(img,"gaussian_blur",settings)
+    for result, s in zip(sweep.data,settings):
+        np.testing.assert_allclose(result,filter_gaussian_blur_kn(img.data,s["kernel_size"],s["sigma"]),atol=1e-6)
+
+
+def test_unsharp_sweep_matches_separate_runs(img):
+    settings = parameter_grid(kernel_size=[3,5],sigma=[1.0,2.0])
+    sweep = sweep_func(img,"unsharp",settings)
+    for result, s in zip(sweep.data,settings):
+        np.testing.assert_allclose(result,sharpen_um_pt_func(img,s["kernel_size"],s["sigma"],s["sigma"]).data,atol=1e-5)
+
+
+@pytest.mark.parametrize("truncate",[2.0,4.0])
+def test_dog_sweep_matches_separate_runs(img,truncate):
+    settings = parameter_grid(low_sigma=[1.0,2.0],high_sigma=[3.0,5.0])
+    sweep = sweep_func(img,"dog",settings,truncate=truncate)
+    for result, s in zip(sweep.data,settings):
+        ref = diff_of_gaus_func(img,s["low_sigma"],s["high_sigma"],truncate=truncate,pt=True).data
+        np.testing.assert_allclose(result,ref,atol=1e-5)
+
+
+def test_clahe_sweep_matches_separate_runs(img):
+    settings = parameter_grid(clip_limit=[10.0,40.0])
+    sweep = sweep_func(img,"clahe",settings)
+    for result, s in zip(sweep.data,settings):
+        np.testing.assert_allclose(result,clahe_pt_func(img,clip_limit=s["clip_limit"]).data,atol=1e-5)